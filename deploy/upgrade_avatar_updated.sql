@@ -0,0 +1,8 @@
+-- Adds yagra_image.avatar_updated to a database created from an older
+-- yagra_scheme.sql, it is the Last-Modified time of /image/<email_md5>.
+
+ALTER TABLE `yagra_image`
+  ADD COLUMN `avatar_updated` datetime DEFAULT NULL COMMENT 'when the image became the avatar of email_md5'
+  AFTER `md5`;
+
+UPDATE `yagra_image` SET `avatar_updated` = `created` WHERE `email_md5` != '';
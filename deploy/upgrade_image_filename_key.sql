@@ -0,0 +1,5 @@
+-- Indexes yagra_image.filename in a database created from an older
+-- yagra_scheme.sql, the images of the "content" storage share their file
+-- and its references are counted by filename.
+
+ALTER TABLE `yagra_image` ADD KEY `filename` (`filename`);
@@ -0,0 +1,7 @@
+-- Adds yagra_image.ready to a database created from an older
+-- yagra_scheme.sql, it is set once the resized derivatives of an image have
+-- been generated. Run ``python main.py derivatives backfill`` afterwards.
+
+ALTER TABLE `yagra_image`
+  ADD COLUMN `ready` tinyint(1) NOT NULL DEFAULT '0' COMMENT 'resized derivatives have been generated'
+  AFTER `avatar_updated`;
@@ -0,0 +1,8 @@
+-- Adds yagra_image.size to a database created from an older
+-- yagra_scheme.sql, the avatars are sent without looking at their files.
+-- The size of the existing images is read from their files until
+-- ``python main.py storage migrate`` has filled it in.
+
+ALTER TABLE `yagra_image`
+  ADD COLUMN `size` int(10) unsigned DEFAULT NULL COMMENT 'bytes of the image'
+  AFTER `ready`;
@@ -29,7 +29,11 @@ CREATE TABLE `yagra_image` (
   `created` datetime NOT NULL,
   `email_md5` varchar(32) COLLATE utf8_unicode_ci NOT NULL,
   `md5` varchar(64) COLLATE utf8_unicode_ci NOT NULL,
-  PRIMARY KEY (`imgid`)
+  `avatar_updated` datetime DEFAULT NULL COMMENT 'when the image became the avatar of email_md5',
+  `ready` tinyint(1) NOT NULL DEFAULT '0' COMMENT 'resized derivatives have been generated',
+  `size` int(10) unsigned DEFAULT NULL COMMENT 'bytes of the image',
+  PRIMARY KEY (`imgid`),
+  KEY `filename` (`filename`)
 ) ENGINE=InnoDB AUTO_INCREMENT=31 DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -39,6 +39,8 @@ WORKDIR \${TMPDIR}
 RUN cp -r avatar-host-py/src/* \${WEBBASE}
 WORKDIR \${WEBBASE}
 RUN cp config.py.example config.py
+# versions of the static URLs, pages are rendered without reading the files
+RUN python main.py static-versions
 
 # apache configuration
 ADD ./conf/apache_yagra.conf \${APACHE_CONF_DIR}/sites-available/yagra.conf
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Reports where the time of a CGI request to main.py goes.
+
+Python 2 has no ``-X importtime``, so this wraps ``__import__`` to time
+every module import (self and cumulative, like importtime does), then runs
+main.main() for one request the way Apache would:
+
+    $ (python script/startup_report.py /about; echo;
+       python script/startup_report.py /image/<md5>) > docs/startup_report.txt
+
+The request runs without a database, so pick a path that does not need
+one (/about, /, /user/login); an /image/<md5> request fails at its database
+lookup, after importing what serving avatars needs. The config module is
+replaced by a stub.
+"""
+
+import os
+import sys
+import time
+import types
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def child(path):
+    import __builtin__
+
+    records = []
+    stack = []
+    real_import = __builtin__.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        known = set(sys.modules)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return real_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            new = [m for m in sys.modules
+                   if m not in known and sys.modules[m] is not None]
+            if new:
+                # name may be relative to the importing package
+                package = (globals or {}).get("__name__", "")
+                if "__path__" not in (globals or {}):
+                    package = package.rpartition(".")[0]
+                matches = [m for m in (package + "." + name, name)
+                           if m in new]
+                records.append((elapsed - children, elapsed, len(stack),
+                                (matches or [min(new, key=len)])[0]))
+
+    config = types.ModuleType("config")
+    config.user_defined_config = {
+        "app_log": {"redirect_path": os.devnull},
+        "upload_path": "/tmp",
+        "db": {"host": "", "port": 3306, "user": "", "password": "",
+               "dbname": ""},
+    }
+    sys.modules["config"] = config
+    os.environ.update({
+        "GATEWAY_INTERFACE": "CGI/1.1",
+        "REQUEST_METHOD": "GET",
+        "REQUEST_URI": path,
+        "QUERY_STRING": "",
+        "HTTP_HOST": "localhost",
+        "REMOTE_ADDR": "127.0.0.1",
+    })
+    sys.path.insert(0, SRC)
+    os.chdir(SRC)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    start = time.time()
+    __builtin__.__import__ = timed_import
+    try:
+        import main
+        imported = time.time()
+        main.main()
+    finally:
+        __builtin__.__import__ = real_import
+        sys.stdout = stdout
+    finished = time.time()
+
+    print "import main: %8.1f ms" % ((imported - start) * 1000)
+    print "main():      %8.1f ms" % ((finished - imported) * 1000)
+    print "modules:     %8d" % len([m for m in sys.modules.values() if m])
+    print
+    print "%10s | %10s | module" % ("self [us]", "cumul [us]")
+    for self_time, cumulative, depth, module in records:
+        print "%10d | %10d | %s%s" % (self_time * 1e6, cumulative * 1e6,
+                                     "  " * depth, module)
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        return child(sys.argv[2])
+    path = sys.argv[1] if len(sys.argv) > 1 else "/about"
+    print "# CGI cold start for GET %s, python %s" % (
+        path, sys.version.split()[0])
+    print
+    sys.stdout.flush()
+    # a fresh interpreter, so nothing is imported yet
+    subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                           "--child", path])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An on-disk hash table from email_md5 to the avatar image.
+
+Every worker process memory maps the file, so /image/<email_md5> is
+answered without a MySQL round trip. The file is made by
+``python main.py avatar-index rebuild`` and then kept up to date by the
+`ImageDAO` changes (see `model.image.add_avatar_listener`); until it exists,
+or when a record is caught while it is rewritten, the avatars are looked up
+in the database. See `common.hashfile` for the file format.
+"""
+
+import os
+import time
+import datetime
+import struct
+import binascii
+
+from typhoon.log import app_log
+from common.hashfile import HashFile, HashFileError
+from common.storage import get_storage
+from common.variants import FORMATS, image_format
+from model.image import add_avatar_listener
+
+# the index can not answer, the database has to
+AvatarIndexError = HashFileError
+
+
+class AvatarRecord(object):
+
+    """The avatar image of an email_md5, as stored in the index."""
+
+    __slots__ = ["filename", "md5", "ready", "last_modified", "size",
+                 "format"]
+
+    def __init__(self, filename, md5, ready, last_modified, size,
+                 format=None):
+        self.filename = filename
+        self.md5 = md5
+        self.ready = ready
+        self.last_modified = last_modified
+        self.size = size
+        self.format = format
+
+    @property
+    def etag(self):
+        """A strong ETag, the MD5 of the content is the same on every
+        node and after the files are copied or restored.
+        """
+        return '"{0}"'.format(self.md5)
+
+    def values(self):
+        fmt_code = FORMATS.index(self.format) + 1 \
+            if self.format in FORMATS else 0
+        return (int(bool(self.ready)), fmt_code, int(self.last_modified),
+                self.size, binascii.unhexlify(self.md5), str(self.filename))
+
+    @classmethod
+    def from_values(cls, values):
+        ready, fmt_code, last_modified, size, md5, filename = values
+        return cls(filename.rstrip("\0"), binascii.hexlify(md5), bool(ready),
+                   last_modified, size,
+                   FORMATS[fmt_code - 1] if fmt_code else None)
+
+
+class AvatarIndex(HashFile):
+
+    MAGIC = "YAGRAIDX"
+
+    # 1 stored the inode based ETag, a rebuild replaces those files
+    VERSION = 2
+
+    # ready, format, last modified, size, image md5, filename (as long as
+    # the column of yagra_image)
+    RECORD = struct.Struct("!16sBBBxIQ16s128sI")
+
+    def lookup(self, email_md5):
+        """Returns the `AvatarRecord` of ``email_md5``, or None if it has
+        no avatar. Raises `AvatarIndexError` if the index can not tell.
+        """
+        values = self.get(email_md5)
+        return AvatarRecord.from_values(values) if values else None
+
+    def update(self, email_md5, record):
+        """Stores ``record`` for ``email_md5``, or removes it if None.
+
+        Does nothing if the index has not been built yet.
+        """
+        self.put(email_md5, record.values() if record else None)
+
+
+def get_avatar_index_path(settings):
+    return settings.get("avatar_index_path") or os.path.join(
+        settings["upload_path"], ".avatars.idx")
+
+
+# per process, see get_avatar_index
+_avatar_index = None
+
+
+def get_avatar_index(settings):
+    """The `AvatarIndex` of the "avatar_index_path" setting, ".avatars.idx"
+    in "upload_path" by default, or None if the "avatar_index" setting is
+    off.
+
+    The first call registers the listener keeping the index up to date with
+    the avatar changes of this process, processes changing avatars have to
+    call it before.
+    """
+    global _avatar_index
+    if not settings.get("avatar_index", True):
+        return None
+    if _avatar_index is None:
+        _avatar_index = AvatarIndex(get_avatar_index_path(settings))
+
+        def update(email_md5, image):
+            record = None
+            if image is not None:
+                record = make_record(settings, image)
+            _avatar_index.update(email_md5, record)
+        add_avatar_listener(update)
+    return _avatar_index
+
+
+def make_record(settings, image):
+    """Makes the `AvatarRecord` of an `ImageModel`. The size of the images
+    uploaded before yagra_image.size is read from the storage, raises
+    OSError if their file is missing.
+    """
+    size = image.size
+    if size is None:
+        size = get_storage(settings).size(image.filename)
+    # "Last-Modified" is not the modified time of file, it's the
+    # timestamp that certain image is set as avatar.
+    avatar_updated = image.avatar_updated or image.created
+    return AvatarRecord(image.filename, image.md5, image.ready,
+                        time.mktime(avatar_updated.timetuple()), size,
+                        image_format(image.filename))
+
+
+def _avatar_items(settings, image_dao, batch_size, updated_since=None):
+    items = []
+    last_imgid = 0
+    while True:
+        images = image_dao.get_avatar_images(last_imgid, batch_size,
+                                             updated_since)
+        if not images:
+            break
+        last_imgid = images[-1].imgid
+        for image in images:
+            try:
+                record = make_record(settings, image)
+            except OSError as e:
+                app_log.error("avatar of %s left out: %s", image.email_md5, e)
+                continue
+            items.append((image.email_md5, record))
+    return items
+
+
+def rebuild(settings, image_dao, batch_size=1000):
+    """Writes the index and the email filter (see `common.emailfilter`) of
+    every avatar in the database, returns the number of avatars.
+    """
+    from common.emailfilter import EmailFilter, get_email_filter_path
+
+    # a few seconds back, for the clocks of the web servers
+    started = datetime.datetime.now().replace(microsecond=0) - \
+        datetime.timedelta(seconds=10)
+    items = _avatar_items(settings, image_dao, batch_size)
+    index = email_filter = None
+    if settings.get("avatar_index", True):
+        index = AvatarIndex(get_avatar_index_path(settings))
+        index.build((email_md5, record.values())
+                    for email_md5, record in items)
+    if settings.get("avatar_filter", True):
+        email_filter = EmailFilter(get_email_filter_path(settings))
+        EmailFilter.build(email_filter.path,
+                          [email_md5 for email_md5, _ in items])
+    # avatars set while the database was read went to the replaced files
+    for email_md5, record in _avatar_items(settings, image_dao, batch_size,
+                                           started):
+        if index is not None:
+            index.update(email_md5, record)
+        if email_filter is not None:
+            email_filter.add(email_md5)
+    return len(items)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A tree of the avatars by email_md5, for the front server to send
+/image/<email_md5> without running Python.
+
+Below the "avatar_tree_path" setting, ``ab/<email_md5>.<format>`` is a
+symbolic link to the avatar file of every email_md5 starting with ``ab``, a
+copy for packed images which have no file of their own. An email without
+avatar has no entry, so the front server sends the default image. Requests
+with a size, and those whose Accept header allows a transcoded format, are
+still passed to `handler.image.AccessHandlerV1`. The front server can not
+send the ETag and Last-Modified of the application, it sends the entries
+without validators, see docker/conf/nginx_yagra.conf.
+
+``python main.py avatar-tree rebuild`` makes the tree from the database,
+the `ImageDAO` changes of the processes keep it up to date. An entry is
+replaced by renaming a new one over it, the front server never sees a
+missing avatar.
+"""
+
+import os
+import errno
+import tempfile
+
+from typhoon.log import app_log
+from common.storage import get_storage
+from common.variants import FORMATS, image_format
+from model.image import add_avatar_listener
+
+
+class AvatarTree(object):
+
+    def __init__(self, path, storage):
+        self.path = path
+        self.storage = storage
+
+    def entry_path(self, email_md5, fmt):
+        email_md5 = email_md5.lower()
+        return os.path.join(self.path, email_md5[:2],
+                            "{0}.{1}".format(email_md5, fmt))
+
+    def update(self, email_md5, image):
+        """Points the entry of ``email_md5`` to ``image``, or removes it if
+        None.
+        """
+        fmt = image_format(image.filename) if image is not None else None
+        if fmt is not None:
+            self._replace(self.entry_path(email_md5, fmt), image.filename)
+        # the entries of the previous avatar in another format
+        for other in FORMATS:
+            if other != fmt:
+                try:
+                    os.unlink(self.entry_path(email_md5, other))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _replace(self, path, filename):
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        target = self.storage.path(filename)
+        fd, tmp_path = tempfile.mkstemp(prefix=".entry-", dir=dirname)
+        try:
+            if target is None:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.storage.read(filename))
+                os.chmod(tmp_path, 0644)
+            else:
+                os.close(fd)
+                os.unlink(tmp_path)
+                os.symlink(os.path.relpath(target, dirname), tmp_path)
+            os.rename(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def rebuild(self, image_dao, batch_size=1000):
+        """Makes the entries of every avatar in the database and removes
+        the others. Returns the number of avatars.
+        """
+        entries = set()
+        last_imgid = 0
+        while True:
+            images = image_dao.get_avatar_images(last_imgid, batch_size)
+            if not images:
+                break
+            last_imgid = images[-1].imgid
+            for image in images:
+                fmt = image_format(image.filename)
+                if fmt is None:
+                    continue
+                path = self.entry_path(image.email_md5, fmt)
+                try:
+                    self._replace(path, image.filename)
+                except EnvironmentError as e:
+                    app_log.error("avatar of %s left out: %s",
+                                  image.email_md5, e)
+                    continue
+                entries.add(path)
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                # entries of avatars set meanwhile are newer than the walk
+                if path not in entries and not filename.startswith("."):
+                    self._remove_stale(path, image_dao)
+        return len(entries)
+
+    def _remove_stale(self, path, image_dao):
+        email_md5 = os.path.basename(path).split(".")[0]
+        image = image_dao.get_image_by_emailmd5(email_md5)
+        if image is None or \
+                path != self.entry_path(email_md5,
+                                        image_format(image.filename)):
+            os.unlink(path)
+
+
+# per process, see get_avatar_tree
+_avatar_tree = None
+
+
+def get_avatar_tree(settings):
+    """The `AvatarTree` of the "avatar_tree_path" setting, or None if it
+    is not set.
+
+    The first call registers the listener keeping the tree up to date with
+    the avatar changes of this process, processes changing avatars have to
+    call it before.
+    """
+    global _avatar_tree
+    path = settings.get("avatar_tree_path")
+    if not path:
+        return None
+    if _avatar_tree is None:
+        _avatar_tree = AvatarTree(path, get_storage(settings))
+        add_avatar_listener(_avatar_tree.update)
+    return _avatar_tree
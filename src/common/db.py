@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import MySQLdb
+import time
+import threading
+
+from typhoon.concurrent import ThreadPoolExecutor
+
+# A connection idle for longer than this is pinged before it is used again,
+# see Connection._get_cursor.
+IDLE_PING_SECONDS = 60
 
 
 def singleton(cls, *args, **kw):
@@ -14,8 +21,7 @@ def singleton(cls, *args, **kw):
     return _singleton
 
 
-@singleton
-class DB():
+class Connection():
 
     def __init__(self, host, port, user, password, dbname):
         self.host = host
@@ -26,9 +32,13 @@ class DB():
 
         self.conn = self._get_connection()
         self._cursor = None
+        self._last_used = time.time()
 
     def _get_connection(self):
-        return MySQLdb.Connect(
+        # imported here, requests that never query pay nothing for it
+        import MySQLdb
+
+        conn = MySQLdb.Connect(
             host=self.host,
             port=self.port,
             user=self.user,
@@ -36,23 +46,47 @@ class DB():
             db=self.dbname,
             charset='utf8'
         )
+        # Without autocommit the first SELECT opens a REPEATABLE READ snapshot
+        # that a persistent worker would keep reading from across requests.
+        # Multi statement writes start their own transaction, see
+        # update_without_commit.
+        conn.autocommit(True)
+        return conn
+
+    def _get_cursor(self):
+        """Returns a new cursor, reconnecting if the connection is gone.
+
+        In persistent (WSGI) workers the connection outlives the request and
+        MySQL may close it after wait_timeout, so an idle connection is
+        pinged first. A CGI process never waits long enough to pay for it.
+        """
+        import MySQLdb
+
+        now = time.time()
+        if now - self._last_used > IDLE_PING_SECONDS:
+            try:
+                self.conn.ping()
+            except MySQLdb.OperationalError:
+                self.conn = self._get_connection()
+        self._last_used = now
+        return self.conn.cursor()
 
     def query(self, sql_stmt, params):
-        cursor = self.conn.cursor()
+        cursor = self._get_cursor()
         cursor.execute(sql_stmt, params)
         data = cursor.fetchall()
         cursor.close()
         return data
 
     def query_one(self, sql_stmt, params):
-        cursor = self.conn.cursor()
+        cursor = self._get_cursor()
         cursor.execute(sql_stmt, params)
         data = cursor.fetchone()
         cursor.close()
         return data
 
     def update(self, sql_stmt, params):
-        cursor = self.conn.cursor()
+        cursor = self._get_cursor()
         result = cursor.execute(sql_stmt, params)
         lastrowid = cursor.lastrowid
         self.conn.commit()
@@ -60,7 +94,9 @@ class DB():
         return result, lastrowid
 
     def update_without_commit(self, sql_stmt, params):
-        self._cursor = self._cursor or self.conn.cursor()
+        if self._cursor is None:
+            self._cursor = self._get_cursor()
+            self._cursor.execute("START TRANSACTION")
         result = self._cursor.execute(sql_stmt, params)
         lastrowid = self._cursor.lastrowid
         return result, lastrowid
@@ -69,3 +105,49 @@ class DB():
         self.conn.commit()
         self._cursor.close()
         self._cursor = None
+
+
+# the connection shared by all DAOs of a process
+DB = singleton(Connection)
+
+
+@singleton
+class AsyncDB(object):
+
+    """Asynchronous variant of `DB` for coroutine handlers.
+
+    Queries run on a thread pool where every thread has its own
+    `Connection`, the methods return a `typhoon.concurrent.Future`::
+
+        row = yield AsyncDB(**db_config).query_one(sql_stmt, params)
+    """
+
+    def __init__(self, host, port, user, password, dbname, max_workers=8):
+        self._connect_args = dict(host=host, port=port, user=user,
+                                  password=password, dbname=dbname)
+        self._local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def _get_thread_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Connection(**self._connect_args)
+        return conn
+
+    def run(self, func, *args, **kwargs):
+        """Runs ``func(connection, *args, **kwargs)`` on the pool.
+
+        Use this for several statements that must share a connection, eg.
+        the ``update_without_commit``/``commit`` transactions of the DAOs.
+        """
+        return self.executor.submit(
+            lambda: func(self._get_thread_connection(), *args, **kwargs))
+
+    def query(self, sql_stmt, params):
+        return self.run(Connection.query, sql_stmt, params)
+
+    def query_one(self, sql_stmt, params):
+        return self.run(Connection.query_one, sql_stmt, params)
+
+    def update(self, sql_stmt, params):
+        return self.run(Connection.update, sql_stmt, params)
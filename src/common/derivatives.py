@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Generates the resized derivatives of uploaded images outside of the
+requests, see ``python main.py derivatives -h``.
+
+`UploadHandler` queues every new image in the `JobQueue` of the
+"job_queue_path" setting and returns, ``derivatives worker`` runs a pool of
+processes taking the jobs, and ``derivatives backfill`` makes the
+derivatives of all the existing images. An image is marked ready in
+yagra_image once all its sizes exist.
+"""
+
+import time
+import signal
+import hashlib
+import multiprocessing
+from contextlib import closing
+
+from typhoon.log import app_log
+from common.db import Connection
+from common.jobqueue import get_job_queue
+from common.storage import get_storage
+from common.avatarindex import get_avatar_index
+from common.variants import (get_variant_cache, image_format, can_save,
+                             DEFAULT_SIZES, TRANSCODE_FORMATS)
+from model.image import ImageDAO
+
+# seconds an idle worker waits before looking for new jobs
+POLL_INTERVAL = 1.0
+
+
+def make_derivatives(settings, image_path, md5, source=None, force=False):
+    """Makes every size of the "avatar_sizes" setting in the format of the
+    image, and in each "avatar_transcode_formats" PIL can write, full size
+    included. Returns False if one of them could not be made.
+
+    ``source`` is a file object of the image, read instead of
+    ``image_path`` if given, eg. for packed images. Existing derivatives
+    are kept unless ``force`` is set.
+    """
+    fmt = image_format(image_path)
+    if fmt is None:
+        app_log.warning("no derivatives for %s, unknown format", image_path)
+        return False
+    if source is not None:
+        image_path = source
+    cache = get_variant_cache(settings)
+    sizes = settings.get("avatar_sizes", DEFAULT_SIZES)
+    variants = [(size, fmt) for size in sizes]
+    for transcode in settings.get("avatar_transcode_formats",
+                                  TRANSCODE_FORMATS):
+        if transcode == fmt:
+            continue
+        if not can_save(transcode):
+            app_log.warning("PIL can not write %s images", transcode)
+            continue
+        variants.extend((size, transcode) for size in (None, ) + tuple(sizes))
+    return all([cache.get(image_path, md5, size, variant_fmt, force)
+                is not None for size, variant_fmt in variants])
+
+
+# set in every pool process by _init_process
+_settings = None
+_image_dao = None
+_force = False
+
+
+def _init_process(settings, force=False):
+    global _settings, _image_dao, _force
+    # the parent handles Ctrl-C for the whole pool and stops it on SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _settings = settings
+    _force = force
+    # a connection of its own, not the one of the parent process
+    _image_dao = ImageDAO(settings["db"], db=Connection(**settings["db"]))
+    # the avatar index tells if an avatar is ready
+    get_avatar_index(settings)
+
+
+def process_image(imgid):
+    """Makes the derivatives of an image and marks it ready.
+
+    Returns False if they could not be made and the job should be retried.
+    """
+    try:
+        image = _image_dao.get_image_by_id(imgid)
+        if image is None:
+            # deleted since it was queued
+            return True
+        with closing(get_storage(_settings).open(image.filename)) as source:
+            if not make_derivatives(_settings, image.filename, image.md5,
+                                    source, _force):
+                return False
+        _image_dao.set_image_ready(imgid, image.email_md5)
+    except Exception:
+        app_log.exception("derivatives of image %s failed", imgid)
+        return False
+    return True
+
+
+def _work(settings):
+    _init_process(settings)
+    queue = get_job_queue(settings)
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        job_id, imgid = job
+        if process_image(imgid):
+            queue.done(job_id)
+        else:
+            queue.release(job_id)
+
+
+def run_workers(settings, processes):
+    """Runs ``processes`` workers on the job queue until interrupted or
+    terminated.
+    """
+    signal.signal(signal.SIGTERM, _raise_exit)
+    workers = []
+    for _ in range(processes):
+        worker = multiprocessing.Process(target=_work, args=(settings, ))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    try:
+        while True:
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    app_log.warning("derivative worker %d exited with %s, "
+                                    "restarting", worker.pid,
+                                    worker.exitcode)
+                    workers[i] = multiprocessing.Process(
+                        target=_work, args=(settings, ))
+                    workers[i].daemon = True
+                    workers[i].start()
+            time.sleep(POLL_INTERVAL)
+    except (KeyboardInterrupt, SystemExit):
+        for worker in workers:
+            worker.terminate()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def backfill(settings, processes, default_avatar=None, batch_size=1000,
+             force=False):
+    """Makes the missing derivatives of every image, and of
+    ``default_avatar``, on a pool of ``processes``. Returns the number of
+    failed images.
+
+    With ``force`` all of them are made again, eg. after the resizing
+    changed; each one is replaced in place and served until then.
+    """
+    if default_avatar is not None:
+        with open(default_avatar, "rb") as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        make_derivatives(settings, default_avatar, md5, force=force)
+
+    # the pool forks first, only the parent uses the shared connection
+    pool = multiprocessing.Pool(processes, _init_process, (settings, force))
+    image_dao = ImageDAO(settings["db"])
+    done = failed = 0
+    last_imgid = 0
+    try:
+        while True:
+            imgids = image_dao.get_image_ids(last_imgid, batch_size)
+            if not imgids:
+                break
+            last_imgid = imgids[-1]
+            for ok in pool.imap_unordered(process_image, imgids, 8):
+                done += 1
+                failed += not ok
+            app_log.info("derivatives: %d images done, %d failed", done,
+                         failed)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+    return failed
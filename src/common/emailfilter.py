@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A Bloom filter of the email_md5 having an avatar.
+
+Most of the requests are for emails that never registered, the filter
+answers them with the default image without looking anything up.
+
+The filter is a file made by ``python main.py avatar-index rebuild`` and
+mapped by every process. The `ImageDAO` changes of a process set the bits of
+new avatars in the shared mapping, the other processes see them at once.
+Bits are never cleared: an email whose avatar went away stays in the filter
+until the next rebuild, which also sizes the filter for the current number
+of avatars, so run it periodically (eg. from cron).
+"""
+
+import os
+import mmap
+import errno
+import fcntl
+import struct
+import binascii
+import tempfile
+
+from model.image import add_avatar_listener
+
+MAGIC = "YAGRABLM"
+VERSION = 1
+
+# magic, version, number of bits, number of hashes, replaced flag
+HEADER = struct.Struct("!8sIQII8x")
+
+# about 1% false positives up to the capacity the filter is built for
+BITS_PER_EMAIL = 10
+HASHES = 7
+
+MIN_CAPACITY = 100000
+
+
+def _positions(email_md5, bits, hashes):
+    """The bits of ``email_md5``, or None if it is not a MD5 hex digest.
+
+    The email_md5 is already a hash, its two halves are used for double
+    hashing.
+    """
+    try:
+        key = binascii.unhexlify(email_md5)
+    except TypeError:
+        return None
+    if len(key) != 16:
+        return None
+    h1, h2 = struct.unpack("!QQ", key)
+    h2 |= 1
+    return [(h1 + i * h2) % bits for i in xrange(hashes)]
+
+
+class EmailFilter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._bits = self._hashes = 0
+
+    def _open(self):
+        if self._map is not None:
+            if HEADER.unpack_from(self._map, 0)[4] == 0:
+                return True
+            # replaced by a rebuild
+            self._map.close()
+            self._map = None
+        try:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error):
+            return False
+        magic, version, self._bits, self._hashes, _ = HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            self._map = None
+            return False
+        return True
+
+    def might_contain(self, email_md5):
+        """False if ``email_md5`` has no avatar for sure.
+
+        True when it may have one, or when there is no filter yet.
+        """
+        if not self._open():
+            return True
+        positions = _positions(email_md5, self._bits, self._hashes)
+        if positions is None:
+            return False
+        for pos in positions:
+            byte = ord(self._map[HEADER.size + (pos >> 3)])
+            if not byte & 1 << (pos & 7):
+                return False
+        return True
+
+    def add(self, email_md5):
+        """Adds ``email_md5``, if the filter has been built.
+
+        Raises IOError if the filter can not be written, a filter missing
+        an avatar would answer the default image for it.
+        """
+        try:
+            f = open(self.path, "r+b")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _, _, bits, hashes, replaced = HEADER.unpack(f.read(HEADER.size))
+            if replaced:
+                return self.add(email_md5)
+            positions = _positions(email_md5, bits, hashes)
+            if positions is None:
+                return
+            shared = mmap.mmap(f.fileno(), 0)
+            try:
+                for pos in positions:
+                    offset = HEADER.size + (pos >> 3)
+                    shared[offset] = chr(ord(shared[offset]) | 1 << (pos & 7))
+            finally:
+                shared.close()
+
+    @classmethod
+    def build(cls, path, email_md5s, capacity=None):
+        """Writes a filter of ``email_md5s`` sized for ``capacity`` emails,
+        twice their number by default, replacing the current one.
+        """
+        email_md5s = list(email_md5s)
+        capacity = max(capacity or 2 * len(email_md5s), MIN_CAPACITY)
+        bits = capacity * BITS_PER_EMAIL
+        table = bytearray(HEADER.size + (bits + 7) // 8)
+        HEADER.pack_into(table, 0, MAGIC, VERSION, bits, HASHES, 0)
+        for email_md5 in email_md5s:
+            for pos in _positions(email_md5, bits, HASHES) or ():
+                table[HEADER.size + (pos >> 3)] |= 1 << (pos & 7)
+
+        old = None
+        try:
+            old = open(path, "r+b")
+            fcntl.flock(old, fcntl.LOCK_EX)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".filter-",
+                                            dir=os.path.dirname(path) or ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(table)
+                # mkstemp makes it 0600, readable by its owner only
+                os.chmod(tmp_path, 0644)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+            if old is not None:
+                # tell readers and waiting writers of the old file to reopen
+                old.seek(24)
+                old.write(struct.pack("!I", 1))
+        finally:
+            if old is not None:
+                old.close()
+        return len(email_md5s)
+
+
+def get_email_filter_path(settings):
+    return settings.get("avatar_filter_path") or os.path.join(
+        settings["upload_path"], ".avatars.bloom")
+
+
+# per process, see get_email_filter
+_email_filter = None
+
+
+def get_email_filter(settings):
+    """The `EmailFilter` of the "avatar_filter_path" setting,
+    ".avatars.bloom" in "upload_path" by default, or None if the
+    "avatar_filter" setting is off.
+
+    The first call registers the listener adding the new avatars of this
+    process to the filter, processes changing avatars have to call it
+    before.
+    """
+    global _email_filter
+    if not settings.get("avatar_filter", True):
+        return None
+    if _email_filter is None:
+        _email_filter = EmailFilter(get_email_filter_path(settings))
+
+        def add(email_md5, image):
+            if image is not None:
+                _email_filter.add(email_md5)
+        add_avatar_listener(add)
+    return _email_filter
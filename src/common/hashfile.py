@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A hash table in a file, of fixed size records keyed by a MD5 digest.
+
+Readers memory map the file, so a lookup is a few slices of shared memory
+and no system call. Layout: a `HEADER`, then ``slots`` records of the
+`HashFile.RECORD` of the subclass (open addressing with linear probing, at
+most half of the slots are used), starting with the 16 bytes of the key and
+a state byte, ending with the CRC32 of the rest of the record. A reader
+catching a record while it is rewritten gets a mismatch and a
+`HashFileError`.
+
+Writers hold an exclusive flock on the file. To grow, the table is written
+to a new file renamed over the old one, which is then flagged as replaced
+so readers reopen the path.
+"""
+
+import os
+import mmap
+import zlib
+import errno
+import fcntl
+import struct
+import binascii
+import tempfile
+
+# magic, version, number of slots, used slots, replaced flag
+HEADER = struct.Struct("!8sIIII8x")
+USED_OFFSET = 16
+REPLACED_OFFSET = 20
+
+EMPTY, USED, DELETED = 0, 1, 2
+
+MIN_SLOTS = 1024
+
+
+class HashFileError(Exception):
+    """The file can not answer, eg. it does not exist."""
+    pass
+
+
+def _key(hexdigest):
+    try:
+        key = binascii.unhexlify(hexdigest)
+    except TypeError:
+        return None
+    return key if len(key) == 16 else None
+
+
+def _first_slot(key, slots):
+    return struct.unpack("!Q", key[:8])[0] % slots
+
+
+class HashFile(object):
+
+    """Subclasses set `MAGIC` and `RECORD`, a struct of the key ("16s"), the
+    state ("B"), their values and the CRC32 ("I").
+    """
+
+    MAGIC = None
+    VERSION = 1
+    RECORD = None
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._slots = 0
+
+    def _pack(self, key, values):
+        data = self.RECORD.pack(key, USED, *(tuple(values) + (0, )))
+        return data[:-4] + struct.pack("!I", zlib.crc32(data[:-4]) &
+                                       0xffffffff)
+
+    def _unpack(self, data):
+        fields = self.RECORD.unpack(data)
+        if zlib.crc32(data[:-4]) & 0xffffffff != fields[-1]:
+            raise HashFileError("record being written")
+        return fields[2:-1]
+
+    def _open(self):
+        if self._map is not None:
+            if HEADER.unpack_from(self._map, 0)[4] == 0:
+                return
+            # replaced by a bigger table
+            self._map.close()
+            self._map = None
+        try:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error) as e:
+            raise HashFileError(str(e))
+        magic, version, self._slots, _, _ = HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self._map.close()
+            self._map = None
+            raise HashFileError("not a {0} file: {1}".format(
+                self.__class__.__name__, self.path))
+
+    def get(self, hexdigest):
+        """Returns the values of the record of ``hexdigest``, or None.
+
+        Raises `HashFileError` if the file can not tell.
+        """
+        key = _key(hexdigest)
+        if key is None:
+            return None
+        self._open()
+        size = self.RECORD.size
+        slot = _first_slot(key, self._slots)
+        for _ in xrange(self._slots):
+            offset = HEADER.size + slot * size
+            data = self._map[offset:offset + size]
+            state = ord(data[16])
+            if state == EMPTY:
+                return None
+            if state == USED and data[:16] == key:
+                return self._unpack(data)
+            slot = (slot + 1) % self._slots
+        return None
+
+    def put(self, hexdigest, values):
+        """Stores the record of ``hexdigest``, or removes it if ``values``
+        is None.
+
+        Does nothing if the file has not been built yet, or by another
+        version, raises IOError if it can not be written.
+        """
+        key = _key(hexdigest)
+        if key is None:
+            return
+        try:
+            f = open(self.path, "r+b")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        size = self.RECORD.size
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            magic, version, slots, used, replaced = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != self.MAGIC or version != self.VERSION:
+                # made by another version, unused until it is rebuilt
+                return
+            if replaced:
+                # grown by another process since it was opened
+                return self.put(hexdigest, values)
+            found = free = None
+            slot = _first_slot(key, slots)
+            for _ in xrange(slots):
+                offset = HEADER.size + slot * size
+                f.seek(offset)
+                data = f.read(size)
+                state = ord(data[16])
+                if state == EMPTY:
+                    if free is None:
+                        free = offset
+                    break
+                if state == DELETED:
+                    if free is None:
+                        free = offset
+                elif data[:16] == key:
+                    found = offset
+                    break
+                slot = (slot + 1) % slots
+            if values is None:
+                if found is not None:
+                    f.seek(found + 16)
+                    f.write(chr(DELETED))
+                    _write_header_field(f, USED_OFFSET, used - 1)
+                return
+            if found is None:
+                found = free
+                used += 1
+                _write_header_field(f, USED_OFFSET, used)
+            f.seek(found)
+            f.write(self._pack(key, values))
+            f.flush()
+            if used * 2 > slots:
+                self._grow(f, slots * 2)
+
+    def _grow(self, f, slots):
+        self._write_table(slots, list(self._records(f)))
+        # tell readers and waiting writers of the old file to reopen
+        _write_header_field(f, REPLACED_OFFSET, 1)
+        f.flush()
+
+    def _records(self, f):
+        """Yields ``(key, data)`` of the used records of ``f``."""
+        size = self.RECORD.size
+        f.seek(0)
+        content = f.read()
+        for offset in xrange(HEADER.size, len(content) - size + 1, size):
+            data = content[offset:offset + size]
+            if ord(data[16]) == USED:
+                yield data[:16], data
+
+    def items(self):
+        """Returns ``(hexdigest, values)`` of every record, or an empty
+        list if the file has not been built yet.
+        """
+        try:
+            f = open(self.path, "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return [(binascii.hexlify(key), self._unpack(data))
+                    for key, data in self._records(f)]
+
+    def build(self, items):
+        """Writes a new file of the ``(hexdigest, values)`` of ``items``,
+        replacing the current one. Returns the number of records.
+        """
+        records = [(_key(hexdigest), self._pack(_key(hexdigest), values))
+                   for hexdigest, values in items]
+        slots = MIN_SLOTS
+        while len(records) * 2 > slots:
+            slots *= 2
+        old = None
+        try:
+            old = open(self.path, "r+b")
+            fcntl.flock(old, fcntl.LOCK_EX)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            self._write_table(slots, records)
+            if old is not None:
+                _write_header_field(old, REPLACED_OFFSET, 1)
+        finally:
+            if old is not None:
+                old.close()
+        return len(records)
+
+    def _write_table(self, slots, records):
+        """Writes a table of ``slots`` with the packed ``(key, data)``
+        records and renames it to the path.
+        """
+        size = self.RECORD.size
+        table = bytearray(HEADER.size + slots * size)
+        HEADER.pack_into(table, 0, self.MAGIC, self.VERSION, slots,
+                         len(records), 0)
+        for key, data in records:
+            slot = _first_slot(key, slots)
+            while table[HEADER.size + slot * size + 16] != EMPTY:
+                slot = (slot + 1) % slots
+            offset = HEADER.size + slot * size
+            table[offset:offset + size] = data
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".index-", dir=os.path.dirname(self.path) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(table)
+            # mkstemp makes it 0600, readable by its owner only
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def _write_header_field(f, offset, value):
+    f.seek(offset)
+    f.write(struct.pack("!I", value))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A job queue in a local SQLite file, shared by the web processes that
+add jobs and the worker processes that run them.
+
+A claimed job stays in the table until it is done; if its worker dies the
+job can be claimed again once its lease has expired. A failed job is retried
+later and later, and dropped after `MAX_ATTEMPTS`.
+"""
+
+import os
+import time
+
+from typhoon.log import app_log
+
+# seconds a claimed job belongs to its worker
+DEFAULT_LEASE = 300
+
+MAX_ATTEMPTS = 5
+
+# seconds before a failed job is retried, times the attempts made
+RETRY_DELAY = 30
+
+
+def get_job_queue(settings):
+    """The queue of the "job_queue_path" setting, ".jobs.sqlite" in
+    "upload_path" by default.
+    """
+    path = settings.get("job_queue_path") or os.path.join(
+        settings["upload_path"], ".jobs.sqlite")
+    return JobQueue(path)
+
+
+class JobQueue(object):
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = path
+        self.lease = lease
+        self._conn = None
+
+    def _get_connection(self):
+        # opened on first use, so a queue made before os.fork is not shared
+        if self._conn is None:
+            import sqlite3
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                imgid INTEGER NOT NULL,
+                created REAL NOT NULL,
+                claimed REAL,
+                attempts INTEGER NOT NULL DEFAULT 0)""")
+        return self._conn
+
+    def put(self, imgid):
+        conn = self._get_connection()
+        conn.execute("INSERT INTO jobs (imgid, created) VALUES (?, ?)",
+                     (imgid, time.time()))
+
+    def claim(self):
+        """Returns ``(job_id, imgid)`` of the oldest available job, or None.
+        """
+        conn = self._get_connection()
+        now = time.time()
+        # IMMEDIATE takes the write lock first, so two workers never get
+        # the same job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # jobs whose worker died on their last attempt
+            for job_id, imgid in conn.execute(
+                    """SELECT id, imgid FROM jobs
+                    WHERE claimed < ? AND attempts >= ?""",
+                    (now - self.lease, MAX_ATTEMPTS)).fetchall():
+                self._drop(job_id, imgid)
+            row = conn.execute(
+                """SELECT id, imgid FROM jobs
+                WHERE (claimed IS NULL OR claimed < ?) AND attempts < ?
+                ORDER BY id LIMIT 1""",
+                (now - self.lease, MAX_ATTEMPTS)).fetchone()
+            if row is not None:
+                conn.execute("""UPDATE jobs SET claimed = ?,
+                    attempts = attempts + 1 WHERE id = ?""", (now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def done(self, job_id):
+        self._get_connection().execute("DELETE FROM jobs WHERE id = ?",
+                                       (job_id, ))
+
+    def release(self, job_id):
+        """Makes a failed job available again after `RETRY_DELAY` seconds per
+        attempt made, or drops it after `MAX_ATTEMPTS`.
+        """
+        conn = self._get_connection()
+        row = conn.execute("SELECT imgid, attempts FROM jobs WHERE id = ?",
+                           (job_id, )).fetchone()
+        if row is None:
+            return
+        imgid, attempts = row
+        if attempts >= MAX_ATTEMPTS:
+            self._drop(job_id, imgid)
+            return
+        # the job stays claimed, its lease ends when it should be retried
+        conn.execute("UPDATE jobs SET claimed = ? WHERE id = ?",
+                     (time.time() - self.lease + RETRY_DELAY * attempts,
+                      job_id))
+
+    def _drop(self, job_id, imgid):
+        app_log.error("job %s of image %s failed %d times, dropped", job_id,
+                      imgid, MAX_ATTEMPTS)
+        self._get_connection().execute("DELETE FROM jobs WHERE id = ?",
+                                       (job_id, ))
+
+    def pending(self):
+        return self._get_connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE attempts < ?",
+            (MAX_ATTEMPTS, )).fetchone()[0]
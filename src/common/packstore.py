@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Images packed in large segment files, for the "packed" storage.
+
+Most avatars are a few KB, as files each one costs an inode, a directory
+entry, an open() and a stat() per request. Here they are appended to the
+``seg-<n>`` files of a directory, up to `SEGMENT_SIZE` bytes each, and
+found with the `PackIndex` of the directory: the MD5 of an image gives its
+segment, offset and size. Readers map the index and the segments, reading a
+packed image is a lookup and a slice of shared memory.
+
+Appends are serialized by a flock on the ".lock" file of the directory.
+`PackStore.compact` drops the images no row references anymore and copies
+the live ones out of mostly unused segments, which are then removed.
+"""
+
+import os
+import mmap
+import time
+import errno
+import fcntl
+import struct
+
+from common.hashfile import HashFile, HashFileError
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# seconds an image stays in the pack after it was last stored, even if no
+# row references it, for the uploads adding their row meanwhile
+COMPACT_GRACE = 3600
+
+
+class PackIndex(HashFile):
+
+    MAGIC = "YAGRAPAK"
+
+    # segment, offset, size, last stored
+    RECORD = struct.Struct("!16sBxxxIQIII")
+
+
+class PackStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(os.path.join(path, "index"))
+        # segment number -> mmap, per process
+        self._segments = {}
+
+    def segment_path(self, number):
+        return os.path.join(self.path, "seg-{0:06d}".format(number))
+
+    def _get(self, md5):
+        try:
+            return self.index.get(md5)
+        except HashFileError as e:
+            raise OSError(errno.ENOENT, str(e), self.index.path)
+
+    def locate(self, md5):
+        """Returns ``(segment path, offset, size)`` of an image, or None.
+
+        Raises OSError if the index can not tell.
+        """
+        values = self._get(md5)
+        if values is None:
+            return None
+        number, offset, size, _ = values
+        return self.segment_path(number), offset, size
+
+    def read(self, md5):
+        """Returns the content of an image, or None if it is not packed."""
+        values = self._get(md5)
+        if values is None:
+            return None
+        number, offset, size, _ = values
+        segment = self._segments.get(number)
+        if segment is None or len(segment) < offset + size:
+            # segments only grow, until compacted away
+            if segment is not None:
+                segment.close()
+            with open(self.segment_path(number), "rb") as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._segments[number] = segment
+        return segment[offset:offset + size]
+
+    def _lock(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        lock = open(os.path.join(self.path, ".lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(self.index.path):
+            self.index.build([])
+        return lock
+
+    def _last_segment(self):
+        numbers = [int(name[4:]) for name in os.listdir(self.path)
+                   if name.startswith("seg-")]
+        return max(numbers) if numbers else 1
+
+    def _append(self, data):
+        """Appends ``data`` to the last segment, the lock being held.
+        Returns ``(segment, offset)``.
+        """
+        number = self._last_segment()
+        path = self.segment_path(number)
+        if os.path.exists(path) and \
+                os.path.getsize(path) + len(data) > SEGMENT_SIZE:
+            number += 1
+            path = self.segment_path(number)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return number, offset
+
+    def put(self, md5, data):
+        """Packs the image of content ``data``, unless it is already."""
+        with self._lock():
+            values = self.index.get(md5)
+            if values is None:
+                number, offset = self._append(data)
+                size = len(data)
+            else:
+                number, offset, size, _ = values
+            # a compaction keeps it until its row has been added
+            self.index.put(md5, (number, offset, size, int(time.time())))
+
+    def compact(self, live_md5s, threshold=0.5):
+        """Removes the images not in ``live_md5s`` and rewrites the
+        segments whose live images take less than ``threshold`` of their
+        size. Returns the number of bytes reclaimed.
+        """
+        live_md5s = set(live_md5s)
+        reclaimed = 0
+        with self._lock():
+            last = self._last_segment()
+            live = {}
+            now = time.time()
+            for md5, values in self.index.items():
+                number, offset, size, stored = values
+                if md5 not in live_md5s and stored < now - COMPACT_GRACE:
+                    self.index.put(md5, None)
+                else:
+                    live.setdefault(number, []).append((md5, values))
+            for name in sorted(os.listdir(self.path)):
+                if not name.startswith("seg-"):
+                    continue
+                number = int(name[4:])
+                path = self.segment_path(number)
+                if number == last:
+                    continue
+                total = os.path.getsize(path)
+                images = live.get(number, [])
+                if sum(values[2] for _, values in images) >= \
+                        threshold * total:
+                    continue
+                with open(path, "rb") as f:
+                    for md5, (_, offset, size, stored) in images:
+                        f.seek(offset)
+                        new_number, new_offset = self._append(f.read(size))
+                        self.index.put(md5, (new_number, new_offset, size,
+                                             stored))
+                # readers still mapping it keep their copy until they remap
+                os.unlink(path)
+                reclaimed += total - sum(values[2] for _, values in images)
+        return reclaimed
@@ -4,7 +4,6 @@
 import datetime
 import pickle
 import hashlib
-import uuid
 import hmac
 import base64
 
@@ -121,6 +120,7 @@ class SessionManager(object):
             session.session_id, self.session_timeout, session_data)
 
     def _generate_session_id(self):
+        import uuid
         return hashlib.sha256(self.secret + str(uuid.uuid4())).hexdigest()
 
     def _calculate_hmac(self, session_id):
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Where uploaded images are kept, chosen with the "image_storage" setting.
+
+Images are files below "upload_path", yagra_image.filename holds their path
+relative to it, so every layout is served by the same /upload/ location and
+rows of different layouts live side by side.
+
+* "flat": ``<random name>.<ext>``, one file per upload, the historical
+  layout;
+* "content": ``<md5>.<ext>``, named by the MD5 of the content, an image
+  uploaded by many users is stored once and referenced by all their
+  yagra_image rows;
+* "packed": ``.pack/<md5>.<ext>``, the images are not files of their own
+  but are appended to the segment files of `common.packstore`, and shared
+  like "content" ones. `UploadFileHandler` serves their /upload/ URLs.
+
+Both names are hex digests, the "image_storage_levels" setting spreads the
+files in that many levels of directories named by their first digits
+(``ab/cd/abcd<...>.<ext>`` for 2 levels), so no directory gets too big.
+It is 0 for "flat" and 2 for "content" by default.
+
+``python main.py storage migrate`` moves the existing uploads to the
+layout of the settings, see `migrate`.
+"""
+
+import os
+import errno
+import tempfile
+from StringIO import StringIO
+
+from typhoon.log import app_log
+from typhoon.util import default_file_mode
+from common.utils import random_image_name
+
+
+# directory of the packed images in "upload_path", and prefix of their names
+PACK_DIR = ".pack"
+
+
+class FileStorage(object):
+
+    """The "flat" layout.
+
+    Every storage reads the images of all the layouts, the rows of an older
+    one are served until they are migrated.
+    """
+
+    DEFAULT_LEVELS = 0
+
+    def __init__(self, root, levels=None):
+        self.root = root
+        self.levels = self.DEFAULT_LEVELS if levels is None else levels
+        self._pack = None
+
+    @property
+    def pack(self):
+        """The `PackStore` of the packed images, opened when first used."""
+        if self._pack is None:
+            from common.packstore import PackStore
+            self._pack = PackStore(os.path.join(self.root, PACK_DIR))
+        return self._pack
+
+    def is_packed(self, name):
+        return name.startswith(PACK_DIR + "/")
+
+    def path(self, name):
+        """The file of ``name``, None for packed images."""
+        if self.is_packed(name):
+            return None
+        return os.path.join(self.root, name)
+
+    def locate(self, name):
+        """Returns ``(path, offset)`` of the file ``name`` is stored in,
+        the offset being None for files of their own.
+
+        Raises OSError if a packed image is missing.
+        """
+        if not self.is_packed(name):
+            return self.path(name), None
+        location = self.pack.locate(_packed_md5(name))
+        if location is None:
+            raise OSError(errno.ENOENT, "not packed", name)
+        return location[:2]
+
+    def size(self, name):
+        """Returns the size of ``name`` in bytes, raises OSError if it is
+        missing.
+        """
+        if not self.is_packed(name):
+            return os.stat(self.path(name)).st_size
+        location = self.pack.locate(_packed_md5(name))
+        if location is None:
+            raise OSError(errno.ENOENT, "not packed", name)
+        return location[2]
+
+    def read(self, name):
+        if not self.is_packed(name):
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        data = self.pack.read(_packed_md5(name))
+        if data is None:
+            raise IOError(errno.ENOENT, "not packed", name)
+        return data
+
+    def open(self, name):
+        """Returns a file object of the content of ``name``."""
+        if not self.is_packed(name):
+            return open(self.path(name), "rb")
+        return StringIO(self.read(name))
+
+    def name_for(self, username, md5, ext):
+        """The name of a new upload of ``username``."""
+        return self._fanout(random_image_name(username) + "." + ext)
+
+    def _fanout(self, filename):
+        dirs = [filename[i * 2:i * 2 + 2] for i in range(self.levels)]
+        return os.path.join(*(dirs + [filename]))
+
+    def migrated_name(self, name, md5):
+        """The name in this layout of the image stored as ``name``, which is
+        ``name`` itself if it is in this layout already.
+        """
+        return self._fanout(os.path.basename(name))
+
+    def save(self, upload_file, name):
+        """Stores an `UploadedFile` as ``name``."""
+        path = self.path(name)
+        _makedirs(os.path.dirname(path))
+        upload_file.save(path)
+
+    def link(self, source, name):
+        """Makes the image of ``source`` available as ``name`` as well, for
+        the migrations. Returns False if ``name`` already existed.
+        """
+        if self.is_packed(name):
+            if self.is_packed(source):
+                return False
+            self.pack.put(_packed_md5(name), self.read(source))
+            return True
+        path = self.path(name)
+        _makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            return False
+        if self.is_packed(source):
+            fd, tmp_path = tempfile.mkstemp(prefix=".upload-",
+                                            dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.read(source))
+                # served by the front server, like the saved uploads
+                os.chmod(tmp_path, default_file_mode())
+                os.rename(tmp_path, path)
+            except Exception:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+            return True
+        try:
+            os.link(self.path(source), path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def remove(self, name):
+        """Removes the image of ``name``, once no row references it. The
+        space of packed images is reclaimed by ``main.py storage compact``.
+        """
+        if not self.is_packed(name):
+            try:
+                os.unlink(self.path(name))
+            except OSError as e:
+                # images sharing a file, removed by the last one moved
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class ContentAddressedStorage(FileStorage):
+
+    """The "content" layout, files are shared by the uploads of the same
+    content, the yagra_image rows naming a file are its references.
+    """
+
+    DEFAULT_LEVELS = 2
+
+    def name_for(self, username, md5, ext):
+        return self._fanout(md5 + "." + ext)
+
+    def migrated_name(self, name, md5):
+        return self.name_for(None, md5, os.path.splitext(name)[1][1:])
+
+    def save(self, upload_file, name):
+        path = self.path(name)
+        if os.path.exists(path):
+            # uploaded before, by this user or another one
+            upload_file.discard()
+            return
+        # a rename, concurrent uploads of the same content all end with the
+        # whole file in place
+        FileStorage.save(self, upload_file, name)
+
+
+def _packed_md5(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+class PackedStorage(FileStorage):
+
+    """The "packed" layout, see `common.packstore`."""
+
+    def name_for(self, username, md5, ext):
+        return PACK_DIR + "/" + md5 + "." + ext
+
+    def migrated_name(self, name, md5):
+        return self.name_for(None, md5, os.path.splitext(name)[1][1:])
+
+    def save(self, upload_file, name):
+        self.pack.put(_packed_md5(name), upload_file.read())
+        upload_file.discard()
+
+
+def _makedirs(path):
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+STORAGES = {
+    "flat": FileStorage,
+    "content": ContentAddressedStorage,
+    "packed": PackedStorage,
+}
+
+# per process, the packed storage keeps its segments mapped
+_storages = {}
+
+
+def get_storage(settings):
+    key = (settings.get("image_storage", "flat"), settings["upload_path"],
+           settings.get("image_storage_levels"))
+    if key not in _storages:
+        _storages[key] = STORAGES[key[0]](key[1], key[2])
+    return _storages[key]
+
+
+# set in every pool process by _init_process
+_storage = None
+_image_dao = None
+
+
+def _init_process(settings):
+    # common.avatarindex and avatartree find the files with get_storage
+    from common.avatarindex import get_avatar_index
+    from common.avatartree import get_avatar_tree
+    from common.db import Connection
+    from model.image import ImageDAO
+    global _storage, _image_dao
+    _storage = get_storage(settings)
+    # a connection of its own, not the one of the parent process
+    _image_dao = ImageDAO(settings["db"], db=Connection(**settings["db"]))
+    # the avatar index and tree follow the moved files
+    get_avatar_index(settings)
+    get_avatar_tree(settings)
+
+
+def migrate_image(imgid):
+    """Moves an image to the layout of the settings, returns False if it
+    failed. The size of the rows older than yagra_image.size is filled in
+    on the way.
+
+    The file is first linked to its new name, then the row is updated, and
+    the old name is only removed once no row references it anymore, so the
+    image is served all along.
+    """
+    try:
+        image = _image_dao.get_image_by_id(imgid)
+        if image is None:
+            return True
+        old_name = image.filename
+        if image.size is None:
+            _image_dao.set_image_size(imgid, _storage.size(old_name),
+                                      image.email_md5)
+        name = _storage.migrated_name(old_name, image.md5)
+        if name == old_name:
+            return True
+        _storage.link(old_name, name)
+        _image_dao.set_image_filename(imgid, name, image.email_md5)
+        if not _image_dao.count_filename_references(old_name):
+            _storage.remove(old_name)
+    except Exception:
+        app_log.exception("moving image %s failed", imgid)
+        return False
+    return True
+
+
+def migrate(settings, processes, batch_size=1000, restart=False):
+    """Moves every image to the layout of the settings on a pool of
+    ``processes``, a batch of ``batch_size`` images at a time, while they
+    are served from either layout. Returns the number of failed images.
+
+    The last imgid of each finished batch is written to the
+    ".storage-migration" file of "upload_path", an interrupted migration
+    goes on from there unless ``restart`` is set.
+    """
+    import multiprocessing
+    from model.image import ImageDAO
+
+    checkpoint = os.path.join(settings["upload_path"], ".storage-migration")
+    last_imgid = 0
+    if not restart:
+        try:
+            with open(checkpoint) as f:
+                last_imgid = int(f.read())
+        except (IOError, ValueError):
+            pass
+
+    # the pool forks first, only the parent uses the shared connection
+    pool = multiprocessing.Pool(processes, _init_process, (settings, ))
+    image_dao = ImageDAO(settings["db"])
+    done = failed = 0
+    try:
+        while True:
+            imgids = image_dao.get_image_ids(last_imgid, batch_size)
+            if not imgids:
+                break
+            for ok in pool.imap_unordered(migrate_image, imgids, 8):
+                done += 1
+                failed += not ok
+            last_imgid = imgids[-1]
+            if not failed:
+                # failed images are retried by the next run
+                with open(checkpoint, "w") as f:
+                    f.write(str(last_imgid))
+            app_log.info("storage migration: %d images done, %d failed",
+                         done, failed)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+    if not failed:
+        try:
+            os.unlink(checkpoint)
+        except OSError:
+            pass
+    return failed
+
+
+def compact(settings, image_dao, threshold=0.5, batch_size=1000):
+    """Reclaims the space of the packed images no row references anymore,
+    returns the number of bytes reclaimed.
+    """
+    storage = get_storage(settings)
+    live_md5s = set()
+    last_imgid = 0
+    while True:
+        rows = image_dao.get_image_filenames(last_imgid, batch_size)
+        if not rows:
+            break
+        last_imgid = rows[-1][0]
+        live_md5s.update(_packed_md5(filename)
+                         for _, filename in rows
+                         if storage.is_packed(filename))
+    return storage.pack.compact(live_md5s, threshold)
@@ -1,24 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import handler.index
-import handler.user
-import handler.image
-
+# Handlers are referenced by name and imported on first match, see URLSpec.
 handlers = [
-    (r"/", handler.index.MainHandler),
+    (r"/", "handler.index.MainHandler"),
 
     # user
-    (r"/user/login", handler.user.LoginHandler),
-    (r"/user/register", handler.user.RegisterHandler),
-    (r"/user/logout", handler.user.LogoutHandler),
+    (r"/user/login", "handler.user.LoginHandler"),
+    (r"/user/register", "handler.user.RegisterHandler"),
+    (r"/user/logout", "handler.user.LogoutHandler"),
 
     # image
-    (r"/image/upload", handler.image.UploadHandler),
-    (r"/image/manage", handler.image.ManageHandler),
-    (r"/image/([0-9a-fA-F]{32})", handler.image.AccessHandlerV1),
-    (r"/image/setavatar", handler.image.SetAvatarHandler),
+    (r"/image/upload", "handler.image.UploadHandler"),
+    (r"/image/manage", "handler.image.ManageHandler"),
+    (r"/image/([0-9a-fA-F]{32})", "handler.image.AccessHandlerV1"),
+    (r"/image/setavatar", "handler.image.SetAvatarHandler"),
+    (r"/image/cache-stats", "handler.image.AvatarCacheStatsHandler"),
+    (r"/upload/(.+)", "handler.image.UploadFileHandler"),
 
     # about
-    (r"/about", handler.index.AboutHandler),
+    (r"/about", "handler.index.AboutHandler"),
 ]
@@ -70,4 +70,13 @@ def get_image_ext(data):
     elif (size >= 2) and data.startswith('\377\330'):
         ext = 'jpeg'
 
+    # WebP is a RIFF container, see "RIFF Container" in the WebP docs
+    elif (size >= 12) and data[:4] == 'RIFF' and data[8:12] == 'WEBP':
+        ext = 'webp'
+
+    # AVIF is an ISO BMFF file starting with an "ftyp" box of brand avif/avis
+    elif (size >= 12) and data[4:8] == 'ftyp' and \
+            data[8:12] in ('avif', 'avis'):
+        ext = 'avif'
+
     return ext
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Resized and transcoded avatar variants.
+
+Sizes are asked for with the Gravatar ``s``/``size`` argument, formats in
+`TRANSCODE_FORMATS` are sent to clients whose Accept header allows them.
+
+Variants are generated with PIL (or Pillow) by the workers of
+`common.derivatives` after an image is uploaded, and kept on disk as
+``<md5[:2]>/<md5>-<size>.<format>`` (``<md5>.<format>`` for full size
+transcodes), ``md5`` being the checksum of the original image, so requests
+only have to send a file. Until its variants exist, or without PIL, the
+original image is served.
+"""
+
+import os
+import errno
+import fcntl
+import tempfile
+
+from typhoon.log import app_log
+from typhoon.util import default_file_mode
+
+# sizes variants are made in, a requested size is rounded up to one of them
+DEFAULT_SIZES = (32, 48, 64, 80, 96, 128, 160, 256)
+
+# formats variants are made of, and sent in
+FORMATS = ("jpeg", "png", "gif", "webp")
+
+CONTENT_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+# formats every image is also transcoded to, for clients that accept them;
+# "avif" needs a PIL with AVIF support (eg. the pillow-avif-plugin)
+TRANSCODE_FORMATS = ("webp", )
+
+_pil_image = None
+
+
+def _import_pil():
+    """Returns the PIL Image module, or False if it is not installed."""
+    global _pil_image
+    if _pil_image is None:
+        try:
+            from PIL import Image
+            _pil_image = Image
+        except ImportError:
+            _pil_image = False
+    return _pil_image
+
+
+def parse_size(value, sizes=DEFAULT_SIZES):
+    """Maps the ``s`` argument to the smallest of ``sizes`` not below it.
+
+    Returns None if ``value`` is missing or invalid, the largest size if it
+    is bigger than all of them.
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return None
+    if size < 1:
+        return None
+    for allowed in sorted(sizes):
+        if allowed >= size:
+            return allowed
+    return max(sizes)
+
+
+def image_format(path):
+    """Returns the format of an image from its extension, or None if
+    variants can not be made of it.
+    """
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    if ext == "jpg":
+        ext = "jpeg"
+    return ext if ext in FORMATS else None
+
+
+def accepted_formats(accept, formats):
+    """Returns the ones of ``formats`` an Accept header explicitly allows.
+
+    Wildcards like ``image/*`` are ignored, browsers send them whatever
+    formats they decode.
+    """
+    accepted = set()
+    for item in (accept or "").split(","):
+        params = item.split(";")
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(params[0].strip().lower())
+    return [fmt for fmt in formats if CONTENT_TYPES.get(fmt) in accepted]
+
+
+def can_save(fmt):
+    """Tells if the installed PIL can write images in ``fmt``."""
+    Image = _import_pil()
+    if not Image:
+        return False
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+
+def resize_image(source_path, f, size, fmt):
+    """Writes ``source_path`` (a path or a file object) cropped to a square
+    of ``size`` pixels to the file object ``f``, or the whole image if
+    ``size`` is None.
+
+    Only the pixels are saved, EXIF data (camera, GPS position...) and other
+    metadata of the upload are left out.
+    """
+    Image = _import_pil()
+    if hasattr(source_path, "seek"):
+        # a file object, read once per variant
+        source_path.seek(0)
+    image = Image.open(source_path)
+    if size is not None:
+        width, height = image.size
+        edge = min(width, height)
+        left, top = (width - edge) // 2, (height - edge) // 2
+        image = image.crop((left, top, left + edge, top + edge))
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif fmt != "gif" and image.mode == "P":
+        image = image.convert("RGBA")
+    if size is not None:
+        image = image.resize((size, size), Image.ANTIALIAS)
+    options = {"quality": 85, "optimize": True} if fmt == "jpeg" else {}
+    image.save(f, fmt.upper(), **options)
+
+
+def get_variant_cache(settings):
+    """Resized avatars are kept in the "avatar_cache_path" setting,
+    ".variants" in "upload_path" by default.
+    """
+    path = settings.get("avatar_cache_path") or os.path.join(
+        settings.get("upload_path"), ".variants")
+    return VariantCache(path)
+
+
+class VariantCache(object):
+
+    """Resized variants of the images, kept below the ``path`` directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def variant_path(self, md5, size, fmt):
+        """``size`` is None for the full size transcode of the image."""
+        if size is None:
+            name = "{0}.{1}".format(md5, fmt)
+        else:
+            name = "{0}-{1}.{2}".format(md5, size, fmt)
+        return os.path.join(self.path, md5[:2], name)
+
+    def get(self, source_path, md5, size, fmt, force=False):
+        """Returns the path of the ``size`` variant of ``source_path``,
+        making it if needed, or again if ``force`` is set.
+
+        Processes asking for a missing variant at the same time wait on a
+        lock file and only the first one resizes. Returns None if the
+        variant can not be made, the original should be sent then.
+        """
+        path = self.variant_path(md5, size, fmt)
+        if not force and os.path.exists(path):
+            return path
+        if not _import_pil():
+            return None
+
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        lock_path = path + ".lock"
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not force and os.path.exists(path):
+                    return path
+                # a forced one replaces the current variant, which is
+                # served until then
+                return self._make(source_path, path, size, fmt)
+            finally:
+                # the variant is in place before the lock file goes away, a
+                # process locking a new lock file finds it when it checks
+                try:
+                    os.unlink(lock_path)
+                except OSError:
+                    pass
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _make(self, source_path, path, size, fmt):
+        fd, tmp_path = tempfile.mkstemp(prefix=".variant-",
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                resize_image(source_path, f, size, fmt)
+            # sent by the front server, see AccessHandlerV1.send_file_by_server
+            os.chmod(tmp_path, default_file_mode())
+            os.rename(tmp_path, path)
+        except Exception as e:
+            app_log.error("making %s failed: %s", path, e)
+            os.unlink(tmp_path)
+            return None
+        return path
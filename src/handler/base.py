@@ -6,7 +6,6 @@ from functools import wraps
 from common.session import Session, SessionManager, MySQLStore
 from model.user import UserDAO
 from typhoon.web import RequestHandler
-from typhoon.template import Loader, DirectorySource, default_parser
 from common.db import DB
 
 
@@ -14,26 +13,36 @@ class BaseHandler(RequestHandler):
 
     def __init__(self, *argc, **kwargs):
         super(BaseHandler, self).__init__(*argc, **kwargs)
-        self.template_loader = Loader(
-            sources=[
-                DirectorySource(
-                    self.application.settings.get("template_path")),
-            ],
-            parser=default_parser,
-        )
+        # compiled templates are cached by the application's loader
+        self.template_loader = self.application.template_loader
 
     def render(self, template_name, **template_vars):
         html = self.render_string(template_name, **template_vars)
         return self.write(html)
 
+    def render_stream(self, template_name, **template_vars):
+        """Like `render`, but the page is sent while it is rendered, so
+        headers and cookies must be set before.
+        """
+        # the first call may set the _xsrf cookie, forms in the page need it
+        self.xsrf_token
+        template = self.template_loader.load(template_name)
+        template.stream(lambda chunk: self.write_iter([chunk]),
+                        **self.get_template_vars(template_vars))
+
     def render_string(self, template_name, **template_vars):
+        return self.template_loader.render(
+            template_name, **self.get_template_vars(template_vars))
+
+    def get_template_vars(self, template_vars):
         template_vars.setdefault("errors", [])
         template_vars.setdefault("notify", [])
         template_vars["request"] = self.request
         template_vars["current_user"] = self.current_user
         template_vars["escaped_xsrf"] = self.escaped_xsrf
+        template_vars["static_url"] = self.static_url
         template_vars.setdefault("active_page", "home")
-        return self.template_loader.render(template_name, **template_vars)
+        return template_vars
 
     def get_login_url(self):
         return "/user/login"
@@ -49,9 +58,11 @@ class BaseHandler(RequestHandler):
         return self.application.settings.get("db")
 
 
-"""As our program only runs one time when a cgi request comes, we dont't need to
-keep a resident session manager. We only create session manager if we needed as
-creating and destroying a db connection is quite excessive.
+"""A session manager is made for the handlers that use the session only, see
+`prepare_session`. It is cheap: the db connection is the one `DB` keeps per
+process, opened by the first request needing it and reused by the following
+ones in the WSGI, prefork, event loop and FastCGI/SCGI modes. Under CGI a
+process serves a single request, which connects only if it needs to.
 """
 
 
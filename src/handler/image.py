@@ -2,26 +2,36 @@
 # -*- coding: utf-8 -*-
 
 import os
-import time
 import hashlib
-import mimetypes
 
 from typhoon.log import app_log
-from typhoon.web import authenticated
-from typhoon.util import format_timestamp
+from typhoon.web import authenticated, StaticFileHandler, HTTPError
+from typhoon.util import format_timestamp, LRUCache
 from base import BaseHandler, prepare_session
-from common.utils import random_image_name, paginator, get_image_ext
-from model.image import ImageDAO
+from common.utils import paginator, get_image_ext
+from common.storage import get_storage
+from common.avatarindex import (get_avatar_index, make_record,
+                                AvatarIndexError)
+from common.emailfilter import get_email_filter
+from common.variants import (get_variant_cache, parse_size, image_format,
+                             accepted_formats, DEFAULT_SIZES, CONTENT_TYPES,
+                             TRANSCODE_FORMATS)
+from model.image import ImageDAO, add_avatar_listener
 
 
-def get_image_fullpath(basepath, filename):
-    """future work, extensible image storage"""
-    return os.path.join(basepath, filename)
+# below the "static_path" setting
+DEFAULT_AVATAR = "img/default.png"
 
 
-def get_upload_image_fullpath(request_handler, filename):
-    basepath = request_handler.application.settings.get("upload_path")
-    return get_image_fullpath(basepath, filename)
+def track_avatar_changes(settings):
+    """Keeps the avatar index, the email filter and the avatar tree up to
+    date with the avatars the DAOs of this process change.
+    """
+    # only the handlers changing avatars need the tree
+    from common.avatartree import get_avatar_tree
+    get_avatar_index(settings)
+    get_email_filter(settings)
+    get_avatar_tree(settings)
 
 
 class UploadHandler(BaseHandler):
@@ -44,41 +54,47 @@ class UploadHandler(BaseHandler):
         user = self.current_user
         upload_file = self.request.upload_files.get("upload")
 
-        if upload_file.filename == "":
+        if upload_file is None or upload_file.filename == "":
             return self.get(errors=["请指定上传的图片"])
-
-        upload_file_data = upload_file.file.read()
+        if upload_file.too_large:
+            return self.get(errors=["图片大小不能超过 {0}KB".format(
+                self.application.settings["max_upload_size"] // 1024)])
 
         # TODO: better image type validation
-        ext_from_header = get_image_ext(upload_file_data)
-        if ext_from_header not in ["jpeg", "gif", "png"]:
-            return self.get(errors=["非法的文件格式"])
-        """
-        _, ext = os.path.splitext(upload_file.filename)
-        if ext.lower() not in ["jpeg", "jpg", "gif", "png"]:
+        ext_from_header = get_image_ext(upload_file.head)
+        if ext_from_header not in ["jpeg", "gif", "png", "webp"]:
             return self.get(errors=["非法的文件格式"])
-        """
-
-        _, ext = os.path.splitext(upload_file.filename)
-        image_name = random_image_name(user.username) + ext
-        image_fullpath = get_upload_image_fullpath(self, image_name)
 
         # if user has upload this image before, we don't keep more copy.
-        md5_checksum = hashlib.md5(upload_file_data).hexdigest()
+        md5_checksum = upload_file.md5
         image_dao = ImageDAO(self.get_db_config())
         image = image_dao.get_image_by_uid_and_md5(user.uid, md5_checksum)
         if image:
             return self.get(notify=["您已经上传过此图片"])
 
-        with open(image_fullpath, "wb") as img_writer:
-            img_writer.write(upload_file_data)
+        # the extension tells the format later on, trust the content rather
+        # than the name the file had on the client
+        storage = get_storage(self.application.settings)
+        image_name = storage.name_for(user.username, md5_checksum,
+                                      ext_from_header)
+        storage.save(upload_file, image_name)
 
         email_md5 = "" if user.avatar else hashlib.md5(user.email).hexdigest()
+        track_avatar_changes(self.application.settings)
         update_avatar = False if user.avatar else True
         create_result, lastrowid = image_dao.create_image(
-            user_id=user.uid, filename=image_name, md5_checksum=md5_checksum, email_md5=email_md5, update_avatar=update_avatar)
+            user_id=user.uid, filename=image_name, md5_checksum=md5_checksum,
+            email_md5=email_md5, update_avatar=update_avatar,
+            size=upload_file.size)
 
         if create_result == 1:
+            # the resized derivatives are made by the workers, see
+            # ``main.py derivatives``
+            try:
+                from common.jobqueue import get_job_queue
+                get_job_queue(self.application.settings).put(lastrowid)
+            except Exception as e:
+                app_log.error("queueing image %s failed: %s", lastrowid, e)
             notify = "上传图片成功"
             if update_avatar:
                 notify += "，并且设置为默认头像"
@@ -87,43 +103,336 @@ class UploadHandler(BaseHandler):
             return self.get(errors=["上传图片失败"])
 
 
+class AvatarEntry(object):
+
+    """What AccessHandlerV1 needs to answer for an avatar, without database
+    or disk access. ``data`` is the content of small files, or None.
+    ``offset`` is where a packed image starts in ``path``, None for files of
+    their own. ``default`` is set for the default image of emails without
+    avatar.
+    """
+
+    __slots__ = ["path", "offset", "content_type", "etag", "last_modified",
+                 "size", "data", "default"]
+
+    def __init__(self, path, content_type, etag, last_modified, size,
+                 data=None, default=False, offset=None):
+        self.path = path
+        self.offset = offset
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.data = data
+        self.default = default
+
+
+# per process, see get_avatar_cache
+_avatar_cache = None
+
+
+def get_avatar_cache(settings):
+    """The LRU cache of `AvatarEntry` of this process, None if the
+    "avatar_cache_max_bytes" setting is 0.
+
+    Entries are dropped when the DAOs of this process change an avatar; a
+    change made by another process shows after "avatar_cache_ttl" seconds.
+    """
+    global _avatar_cache
+    if _avatar_cache is None:
+        max_bytes = settings.get("avatar_cache_max_bytes", 16 * 1024 * 1024)
+        if not max_bytes:
+            return None
+        _avatar_cache = LRUCache(max_bytes, settings.get("avatar_cache_ttl",
+                                                         60))
+        add_avatar_listener(
+            lambda email_md5, image: _avatar_cache.delete_matching(
+                lambda key: key[0] == email_md5))
+    return _avatar_cache
+
+
 class AccessHandlerV1(BaseHandler):
 
+    # files up to this size are kept in the avatar cache
+    MAX_CACHED_DATA = 64 * 1024
+
+    # memory taken by an entry besides its data, roughly
+    ENTRY_OVERHEAD = 512
+
     def get(self, email_md5, **template_vars):
+        settings = self.application.settings
+        # Gravatar style "s" or "size" argument, in pixels
+        avatar_size = parse_size(
+            self.get_argument("s", None) or self.get_argument("size", None),
+            settings.get("avatar_sizes", DEFAULT_SIZES))
+        transcode_formats = settings.get("avatar_transcode_formats",
+                                         TRANSCODE_FORMATS)
+        formats = tuple(accepted_formats(self.request.headers.get("Accept"),
+                                         transcode_formats))
+
+        cache = get_avatar_cache(settings)
+        key = (email_md5.lower(), avatar_size, formats)
+        entry = cache.get(key) if cache is not None else None
+        cached = entry is not None
+        if entry is None:
+            entry = self.lookup_avatar(email_md5, avatar_size, formats)
+            if entry is None:
+                return self.set_status(500)
+            if cache is not None:
+                cache.set(key, entry, self.ENTRY_OVERHEAD + len(
+                    entry.data or ""))
+
+        if transcode_formats:
+            self.set_header("Vary", "Accept")
+        self.set_header("ETag", entry.etag)
+        self.set_header("Last-Modified",
+                        format_timestamp(entry.last_modified))
+        self.set_header("Cache-Control", self.get_cache_control(entry.default))
+        if self.should_return_304(entry.etag, entry.last_modified):
+            return self.set_status(304)
+        self.set_header("Content-Type", entry.content_type)
+
+        if self.request.method == "HEAD":
+            self.set_header("Content-Length", entry.size)
+            return
+        # the front servers can not send a part of a segment
+        if entry.offset is None and self.send_file_by_server(entry.path):
+            return
+        if entry.data is not None:
+            return self.write(entry.data)
+        try:
+            f = open(entry.path, "rb")
+            if entry.offset:
+                f.seek(entry.offset)
+        except IOError as e:
+            if cache is not None:
+                cache.delete(key)
+            if cached:
+                # moved since it was cached, by ``main.py storage migrate``
+                # or with a segment rewritten by ``storage compact``
+                return self.get(email_md5, **template_vars)
+            app_log.error("file %s not found %s", entry.path, e)
+            return self.set_status(500)
+        self.set_header("Content-Length", entry.size)
+        with f:
+            self.write_iter(_read_chunks(f, entry.size))
+
+    def lookup_avatar(self, email_md5, avatar_size, formats):
+        """Builds the `AvatarEntry` of ``email_md5`` from the avatar index,
+        or the database, and the files. Returns None if they are missing.
+        """
+        storage = get_storage(self.application.settings)
+        try:
+            record = self.find_avatar(email_md5)
+            if record:
+                image_fullpath, offset = storage.locate(record.filename)
+        except OSError as e:
+            app_log.error("avatar of %s not found %s", email_md5, e)
+            return None
+        data = None
+        if record:
+            etag, size = record.etag, record.size
+            md5_checksum = record.md5
+            last_modified = record.last_modified
+        else:
+            # the default image is kept in memory by the static file cache
+            image_fullpath = os.path.join(
+                os.path.abspath(self.application.settings["static_path"]),
+                DEFAULT_AVATAR)
+            entry = StaticFileHandler.get_entry(image_fullpath)
+            if entry is None:
+                app_log.error("file %s not found", image_fullpath)
+                return None
+            etag, size, data = entry.etag, entry.size, entry.data
+            md5_checksum = entry.etag.strip('"')
+            last_modified = entry.mtime
+            offset = None
+
+        # The variants are made by the derivative workers
+        # (common.derivatives), the original is sent until they are ready.
+        fmt = image_format(record.filename if record else image_fullpath)
+        if fmt is not None and (record is None or record.ready):
+            variant = self.choose_variant(md5_checksum, avatar_size, fmt,
+                                          list(formats))
+            # a full size transcode is only worth it when it is smaller
+            if variant is not None and (avatar_size or variant[1] < size):
+                image_fullpath, size, variant_fmt = variant
+                data = offset = None
+                etag = variant_etag(etag, avatar_size,
+                                    variant_fmt if variant_fmt != fmt
+                                    else None)
+                fmt = variant_fmt
+
+        if data is None and size <= self.MAX_CACHED_DATA and \
+                (offset is not None or
+                 not self.application.settings.get("x_sendfile")):
+            try:
+                if offset is not None:
+                    # a slice of the mapped segment
+                    data = storage.read(record.filename)
+                else:
+                    with open(image_fullpath, "rb") as f:
+                        data = f.read()
+            except EnvironmentError as e:
+                app_log.error("file %s not found %s", image_fullpath, e)
+                return None
+        return AvatarEntry(image_fullpath,
+                           CONTENT_TYPES.get(fmt, "image/jpeg"), etag,
+                           last_modified, size, data, default=record is None,
+                           offset=offset)
+
+    def find_avatar(self, email_md5):
+        """Returns the `AvatarRecord` of ``email_md5``, or None if it has
+        no avatar. The database is only asked when neither the email filter
+        nor the avatar index can tell.
+        """
+        settings = self.application.settings
+        email_filter = get_email_filter(settings)
+        if email_filter is not None and \
+                not email_filter.might_contain(email_md5):
+            return None
+        index = get_avatar_index(settings)
+        if index is not None:
+            try:
+                return index.lookup(email_md5)
+            except AvatarIndexError:
+                pass
         image_dao = ImageDAO(self.get_db_config())
         image = image_dao.get_image_by_emailmd5(email_md5)
-        if image:
-            image_fullpath = get_upload_image_fullpath(self, image.filename)
+        return make_record(settings, image) if image else None
+
+    def choose_variant(self, md5_checksum, avatar_size, fmt, formats):
+        """Returns ``(path, size, format)`` of the smallest existing variant
+        of ``avatar_size`` pixels (None for full size), in ``fmt`` or in one
+        of the transcode ``formats`` the client accepts, or None.
+        """
+        if avatar_size is not None:
+            formats.append(fmt)
+        cache = get_variant_cache(self.application.settings)
+        best = None
+        for variant_fmt in formats:
+            path = cache.variant_path(md5_checksum, avatar_size, variant_fmt)
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            if best is None or size < best[1]:
+                best = (path, size, variant_fmt)
+        return best
+
+    def get_cache_control(self, default=False):
+        """Builds Cache-Control from the "avatar_max_age" and
+        "avatar_stale_while_revalidate" settings, in seconds.
+
+        The ``default`` image sent for emails without avatar is kept
+        "avatar_default_max_age" seconds instead, an email registering an
+        avatar shows the default image that long to the caches that saw it.
+        """
+        settings = self.application.settings
+        if default:
+            max_age = settings.get("avatar_default_max_age", 3600)
         else:
-            image_fullpath = get_image_fullpath("static/img", "default.png")
+            max_age = settings.get("avatar_max_age", 300)
+        cache_control = "public, max-age={0}".format(max_age)
+        stale = settings.get("avatar_stale_while_revalidate")
+        if stale:
+            cache_control += ", stale-while-revalidate={0}".format(stale)
+        return cache_control
+
+    def send_file_by_server(self, image_fullpath):
+        """Lets the front server send the file, according to the
+        "x_sendfile" setting:
+
+        * "nginx": ``X-Accel-Redirect`` to the "x_accel_upload_prefix"
+          location (an ``internal`` location aliased to "upload_path") for
+          files in "upload_path", like resized variants in the default
+          cache, the default image is redirected to its /static URL;
+        * "apache": ``X-Sendfile`` with the absolute path, for mod_xsendfile.
+
+        Returns False if the setting is off.
+        """
+        settings = self.application.settings
+        mode = settings.get("x_sendfile")
+        if mode == "nginx":
+            upload_path = os.path.abspath(settings.get("upload_path"))
+            image_fullpath = os.path.abspath(image_fullpath)
+            if image_fullpath.startswith(upload_path + os.sep):
+                prefix = settings.get("x_accel_upload_prefix", "/_upload/")
+                relpath = os.path.relpath(image_fullpath, upload_path)
+                uri = prefix.rstrip("/") + "/" + relpath.replace(os.sep, "/")
+            elif image_fullpath == os.path.join(
+                    os.path.abspath(settings["static_path"]), DEFAULT_AVATAR):
+                uri = settings.get(
+                    "static_url_prefix", "/static/") + DEFAULT_AVATAR
+            else:
+                return False
+            self.set_header("X-Accel-Redirect", uri)
+        elif mode == "apache":
+            self.set_header("X-Sendfile", os.path.abspath(image_fullpath))
+        else:
+            return False
+        return True
 
-        try:
-            f = open(image_fullpath, "rb")
-            img = f.read()
-            self.write(img)
-            self.set_header("Content-Length", len(img))
 
-            fs = os.stat(image_fullpath)
-            etag = "{0}-{1}-{2}".format(fs.st_ino,
-                                        int(fs.st_mtime),
-                                        fs.st_size)
+def _read_chunks(f, size, chunk_size=65536):
+    while size > 0:
+        chunk = f.read(min(chunk_size, size))
+        if not chunk:
+            break
+        size -= len(chunk)
+        yield chunk
 
-            if etag is None:
-                return self.set_status(500)
-            if self.request.headers.get("If-None-Match") == etag:
-                return self.set_status(304)
-            else:
-                self.set_header("ETag", etag)
-                # "Last-Modified" is not the modified time of file, it's the
-                # timestamp that certain image is set as avatar.
-                self.set_header("Last-Modified", format_timestamp(time.time()))
-
-            _, ext = os.path.splitext(image_fullpath)
-            mimetype = mimetypes.types_map.get(ext, "image/jpeg")
-            self.set_header("Content-Type", mimetype)
-        except IOError as e:
-            app_log.error("file %s not found %s", image_fullpath, e)
-            self.set_status(500)
+
+def variant_etag(etag, size=None, fmt=None):
+    """The ETag of the ``size`` pixels variant of an image, transcoded to
+    ``fmt``.
+    """
+    suffix = ""
+    if size is not None:
+        suffix += "-s{0}".format(size)
+    if fmt is not None:
+        suffix += "-" + fmt
+    if etag.endswith('"'):
+        return etag[:-1] + suffix + '"'
+    return etag + suffix
+
+
+class AvatarCacheStatsHandler(BaseHandler):
+
+    """Counters of the avatar cache of the process serving the request, as
+    JSON. Answers 404 unless the "avatar_cache_stats" setting is on.
+    """
+
+    def get(self):
+        if not self.application.settings.get("avatar_cache_stats"):
+            raise HTTPError(404)
+        cache = get_avatar_cache(self.application.settings)
+        self.write(cache.stats() if cache is not None else {})
+
+
+class UploadFileHandler(BaseHandler):
+
+    """Serves the /upload/ URLs of packed images, the front server sends
+    the ones that are files and passes the others here.
+    """
+
+    def get(self, filename):
+        storage = get_storage(self.application.settings)
+        if not storage.is_packed(filename):
+            raise HTTPError(404)
+        try:
+            data = storage.read(filename)
+        except EnvironmentError:
+            raise HTTPError(404)
+        fmt = image_format(filename)
+        # named by their content, they never change
+        etag = '"{0}"'.format(os.path.splitext(os.path.basename(filename))[0])
+        self.set_header("ETag", etag)
+        self.set_header("Cache-Control", "public, max-age=31536000")
+        if self.should_return_304(etag, None):
+            return self.set_status(304)
+        self.set_header("Content-Type", CONTENT_TYPES.get(fmt, "image/jpeg"))
+        self.write(data)
 
 
 class AccessHandlerV2(BaseHandler):
@@ -167,7 +476,7 @@ class ManageHandler(BaseHandler):
         template_vars.update({"images": own_images, "count": own_images_count})
         template_vars.update({"active_page": "manage"})
 
-        return self.render("image/manage.html", **template_vars)
+        return self.render_stream("image/manage.html", **template_vars)
 
 
 class SetAvatarHandler(BaseHandler):
@@ -188,6 +497,7 @@ class SetAvatarHandler(BaseHandler):
             self.write({"status": "ok", "msg": "这就是您当前的头像，无需更换"})
             return
 
+        track_avatar_changes(self.application.settings)
         image_dao.update_user_avatar(user.uid, image.imgid,
                                      hashlib.md5(user.email).hexdigest())
 
@@ -1,17 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import cgitb
-cgitb.enable()
-
 import os
+import sys
 
 from config import user_defined_config
 from common.urls import handlers
 from typhoon.web import Application
 
 
-def main():
+def get_settings():
     settings = {
         "app_log": {
             "redirect_path": "/var/log/yagra/app.log",
@@ -24,14 +22,212 @@ def main():
         "secure_key": "A0j*fCdxi#&vn5Ly",
         "session_timeout": 86400 * 15,
         "check_xsrf_cookie": True,
+        "compress_response": True,
+        "max_upload_size": 3 * 1024 * 1024,
     }
     assert isinstance(user_defined_config, dict)
     for k, v in user_defined_config.iteritems():
         settings[k] = v
-    app = Application(handlers, **settings)
+    return settings
+
+
+def make_app():
+    return Application(handlers, **get_settings())
+
+
+def serve(argv):
+    """Runs the built-in prefork HTTP server, see ``main.py serve -h``."""
+    import argparse
+    from typhoon.httpserver import serve_prefork
+
+    parser = argparse.ArgumentParser(prog="main.py serve")
+    parser.add_argument("--server",
+                        choices=["http", "async", "fastcgi", "scgi"],
+                        default="http",
+                        help="http: blocking, one request at a time per "
+                        "worker; async: event loop, many connections per "
+                        "worker; fastcgi/scgi: event loop responders for "
+                        "nginx fastcgi_pass/scgi_pass")
+    parser.add_argument("--address", default="",
+                        help="address to bind, default all interfaces")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes, default one per "
+                        "CPU")
+    parser.add_argument("--max-requests", type=int, default=0,
+                        help="recycle a worker after this many requests, "
+                        "default never")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="let every worker bind its own SO_REUSEPORT "
+                        "socket instead of sharing one")
+    args = parser.parse_args(argv)
+
+    # Everything here is shared by the forked workers, the database
+    # connection is only opened by the first query inside a worker.
+    app = make_app()
+    if app.template_loader is not None:
+        app.template_loader.preload()
+    server_class = None
+    if args.server == "async":
+        from typhoon.asyncserver import AsyncHTTPServer
+        server_class = AsyncHTTPServer
+    elif args.server == "fastcgi":
+        from typhoon.fastcgi import FastCGIServer
+        server_class = FastCGIServer
+    elif args.server == "scgi":
+        from typhoon.fastcgi import SCGIServer
+        server_class = SCGIServer
+    serve_prefork(app, args.port, args.address, num_processes=args.workers,
+                  max_requests=args.max_requests, reuse_port=args.reuse_port,
+                  server_class=server_class)
+
+
+def derivatives(argv):
+    """Makes the resized avatars, see ``main.py derivatives -h``."""
+    import argparse
+    import multiprocessing
+    from common import derivatives
+    from handler.image import DEFAULT_AVATAR
+
+    parser = argparse.ArgumentParser(prog="main.py derivatives")
+    parser.add_argument("command", choices=["worker", "backfill"],
+                        help="worker: make the derivatives of uploaded "
+                        "images as they are queued; backfill: make the "
+                        "missing ones of all the images and the default "
+                        "avatar")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="number of worker processes, default one per "
+                        "CPU")
+    parser.add_argument("--force", action="store_true",
+                        help="backfill: make the existing derivatives "
+                        "again too, eg. after the resizing changed")
+    args = parser.parse_args(argv)
+
+    settings = make_app().settings
+    processes = args.processes or multiprocessing.cpu_count()
+    if args.command == "worker":
+        derivatives.run_workers(settings, processes)
+    else:
+        default_avatar = os.path.join(settings["static_path"],
+                                      DEFAULT_AVATAR)
+        return 1 if derivatives.backfill(settings, processes,
+                                         default_avatar,
+                                         force=args.force) else 0
+
+
+def avatar_index(argv):
+    """Manages the avatar index, see ``main.py avatar-index -h``."""
+    import argparse
+    from typhoon.log import app_log
+    from common import avatarindex
+    from model.image import ImageDAO
+
+    parser = argparse.ArgumentParser(prog="main.py avatar-index")
+    parser.add_argument("command", choices=["rebuild"],
+                        help="rebuild: write the index of all the avatars "
+                        "in the database")
+    parser.parse_args(argv)
+
+    settings = make_app().settings
+    count = avatarindex.rebuild(settings, ImageDAO(settings["db"]))
+    app_log.info("%d avatars in %s", count,
+                 avatarindex.get_avatar_index_path(settings))
+
+
+def avatar_tree(argv):
+    """Manages the avatar tree, see ``main.py avatar-tree -h``."""
+    import argparse
+    from typhoon.log import app_log
+    from common.avatartree import get_avatar_tree
+    from model.image import ImageDAO
+
+    parser = argparse.ArgumentParser(prog="main.py avatar-tree")
+    parser.add_argument("command", choices=["rebuild"],
+                        help="rebuild: link every avatar of the database in "
+                        "the \"avatar_tree_path\" setting")
+    parser.parse_args(argv)
+
+    settings = make_app().settings
+    tree = get_avatar_tree(settings)
+    if tree is None:
+        app_log.error("the \"avatar_tree_path\" setting is not set")
+        return 1
+    count = tree.rebuild(ImageDAO(settings["db"]))
+    app_log.info("%d avatars in %s", count, tree.path)
+
+
+def storage(argv):
+    """Manages the uploaded images, see ``main.py storage -h``."""
+    import argparse
+    import multiprocessing
+    from typhoon.log import app_log
+    from common.storage import migrate, compact
+    from model.image import ImageDAO
+
+    parser = argparse.ArgumentParser(prog="main.py storage")
+    parser.add_argument("command", choices=["migrate", "compact"],
+                        help="migrate: move the uploads to the layout of "
+                        "the \"image_storage\" and \"image_storage_levels\" "
+                        "settings, while they are served, and fill in the "
+                        "size of older images; compact: reclaim "
+                        "the space of the packed images no longer used")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="number of migration processes, default one "
+                        "per CPU")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--restart", action="store_true",
+                        help="start the migration from the first image "
+                        "instead of where an interrupted one stopped")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="rewrite the segments whose images in use take "
+                        "less than this part of their size, default 0.5")
+    args = parser.parse_args(argv)
+
+    settings = make_app().settings
+    if args.command == "compact":
+        reclaimed = compact(settings, ImageDAO(settings["db"]),
+                            args.threshold, args.batch_size)
+        app_log.info("%d bytes reclaimed", reclaimed)
+        return
+    processes = args.processes or multiprocessing.cpu_count()
+    return 1 if migrate(settings, processes, args.batch_size,
+                        args.restart) else 0
+
+
+def static_versions(argv):
+    """Writes the versions of the static URLs, run at deploy."""
+    from typhoon.log import app_log
+    from typhoon.web import write_static_versions
+
+    static_path = make_app().settings["static_path"]
+    count = write_static_versions(static_path)
+    app_log.info("versions of %d files in %s", count, static_path)
+
+
+def main():
+    # Apache passes a query string without "=" as command line arguments to
+    # CGI scripts, so never treat a CGI request as a command.
+    if "GATEWAY_INTERFACE" not in os.environ:
+        if sys.argv[1:2] == ["serve"]:
+            return serve(sys.argv[2:])
+        if sys.argv[1:2] == ["derivatives"]:
+            return derivatives(sys.argv[2:])
+        if sys.argv[1:2] == ["avatar-index"]:
+            return avatar_index(sys.argv[2:])
+        if sys.argv[1:2] == ["avatar-tree"]:
+            return avatar_tree(sys.argv[2:])
+        if sys.argv[1:2] == ["storage"]:
+            return storage(sys.argv[2:])
+        if sys.argv[1:2] == ["static-versions"]:
+            return static_versions(sys.argv[2:])
+    app = make_app()
+    if app.settings.get("debug"):
+        # cgitb alone costs more to import than serving most requests
+        import cgitb
+        cgitb.enable()
     app.run()
 
 
 if __name__ == "__main__":
 
-    main()
+    sys.exit(main())
@@ -1,17 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from common.db import DB
+from common.db import DB, AsyncDB
 
 
 class BaseDAO(object):
 
-    def __init__(self, db_config):
+    def __init__(self, db_config, db=None):
         super(BaseDAO, self).__init__()
-        self.db = DB(
+        self.db = db or DB(
             host=db_config["host"],
             port=db_config["port"],
             user=db_config["user"],
             password=db_config["password"],
             dbname=db_config["dbname"],
         )
+
+
+class AsyncDAO(object):
+
+    """Runs the methods of a DAO on the thread pool of `AsyncDB`.
+
+    Every method returns a future instead of its result, eg. in a coroutine
+    handler::
+
+        image_dao = AsyncDAO(ImageDAO, self.get_db_config())
+        image = yield image_dao.get_image_by_emailmd5(email_md5)
+    """
+
+    def __init__(self, dao_class, db_config):
+        self.dao_class = dao_class
+        self.db_config = db_config
+        self.async_db = AsyncDB(
+            host=db_config["host"],
+            port=db_config["port"],
+            user=db_config["user"],
+            password=db_config["password"],
+            dbname=db_config["dbname"],
+        )
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            def run(conn):
+                dao = self.dao_class(self.db_config, db=conn)
+                return getattr(dao, name)(*args, **kwargs)
+            return self.async_db.run(run)
+        return method
@@ -2,9 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import time
+import datetime
 
+from typhoon.log import app_log
 from model.base import BaseDAO
 
+# callbacks of add_avatar_listener
+_avatar_listeners = []
+
+
+def add_avatar_listener(callback):
+    """Registers ``callback(email_md5, image)``, called once the image
+    linked to ``email_md5`` changed, with the `ImageModel` now linked to it
+    (as returned by `ImageDAO.get_image_by_emailmd5`) or None.
+
+    Only the changes made by the DAOs of this process are seen, caches of
+    other processes have to expire by themselves.
+    """
+    _avatar_listeners.append(callback)
+
 
 class ImageModel(object):
 
@@ -19,29 +35,49 @@ class ImageModel(object):
 class ImageDAO(BaseDAO):
     # FIXME: access to both yagra_image table and yagra_user table
 
+    def _avatar_changed(self, email_md5):
+        if not _avatar_listeners:
+            return
+        image = self.get_image_by_emailmd5(email_md5)
+        for callback in _avatar_listeners:
+            try:
+                callback(email_md5, image)
+            except Exception:
+                app_log.exception("avatar listener %r failed", callback)
+
     def create_image(self, user_id, filename, md5_checksum, email_md5,
-                     update_avatar):
+                     update_avatar, size=None):
         insert_sql_stmt = """INSERT INTO yagra_image
-                    (user_id, filename, md5, created, email_md5)
-                    VALUES (%s, %s, %s, %s, %s)
+                    (user_id, filename, md5, created, email_md5,
+                     avatar_updated, size)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
                     """
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
         insert_params = (
             user_id,
             filename,
             md5_checksum,
-            time.strftime('%Y-%m-%d %H:%M:%S'),
-            email_md5)
+            now,
+            email_md5,
+            now if email_md5 else None,
+            size)
         update_sql_stmt = """UPDATE yagra_user
                     SET avatar = %s where uid = %s"""
         if not update_avatar:
-            return self.db.update(insert_sql_stmt, insert_params)
+            result = self.db.update(insert_sql_stmt, insert_params)
+            if email_md5:
+                self._avatar_changed(email_md5)
+            return result
         else:
             _, lastrowid = self.db.update_without_commit(insert_sql_stmt,
                                                          insert_params)
             update_params = (lastrowid, user_id)
-            result, lastrowid = self.db.update_without_commit(
+            # lastrowid stays the id of the new image
+            result, _ = self.db.update_without_commit(
                 update_sql_stmt, update_params)
             self.db.commit()
+            if email_md5:
+                self._avatar_changed(email_md5)
             return result, lastrowid
 
     def update_user_avatar(self, user_id, imgid, email_md5):
@@ -52,9 +88,10 @@ class ImageDAO(BaseDAO):
         self.db.update_without_commit(unlink_stmt, unlink_params)
 
         # set new avatar linked with email_md5
-        link_stmt = """UPDATE yagra_image SET email_md5 = %s
+        link_stmt = """UPDATE yagra_image
+                SET email_md5 = %s, avatar_updated = %s
                 WHERE imgid = %s"""
-        link_params = (email_md5, imgid)
+        link_params = (email_md5, time.strftime('%Y-%m-%d %H:%M:%S'), imgid)
         self.db.update_without_commit(link_stmt, link_params)
 
         avatar_stmt = """UPDATE yagra_user SET avatar = %s
@@ -63,19 +100,22 @@ class ImageDAO(BaseDAO):
         self.db.update_without_commit(avatar_stmt, avatar_params)
 
         self.db.commit()
+        self._avatar_changed(email_md5)
 
     def get_image_by_id(self, image_id):
         sql_stmt = """
-                SELECT imgid, user_id, filename, created, md5, email_md5
+                SELECT imgid, user_id, filename, created, md5, email_md5,
+                    size
                 FROM yagra_image
                 WHERE imgid = %s
                 """
         params = (image_id, )
         raw = self.db.query_one(sql_stmt, params)
         if raw:
-            imgid, user_id, filename, created, md5, email_md5 = raw
+            imgid, user_id, filename, created, md5, email_md5, size = raw
             return ImageModel(imgid=imgid, user_id=user_id, filename=filename,
-                              created=created, md5=md5, email_md5=email_md5,)
+                              created=created, md5=md5, email_md5=email_md5,
+                              size=size)
         return None
 
     def get_image_by_uid_and_md5(self, user_id, md5_checksum):
@@ -94,18 +134,106 @@ class ImageDAO(BaseDAO):
 
     def get_image_by_emailmd5(self, email_md5):
         sql_stmt = """
-                SELECT imgid, user_id, filename, created, md5, email_md5
+                SELECT imgid, user_id, filename, created, md5, email_md5,
+                    avatar_updated, ready, size
                 FROM yagra_image
                 where email_md5 = %s
                 """
         params = (email_md5, )
         raw = self.db.query_one(sql_stmt, params)
         if raw:
-            imgid, user_id, filename, created, md5, email_md5 = raw
+            (imgid, user_id, filename, created, md5, email_md5,
+             avatar_updated, ready, size) = raw
             return ImageModel(imgid=imgid, user_id=user_id, filename=filename,
-                              created=created, md5=md5, email_md5=email_md5,)
+                              created=created, md5=md5, email_md5=email_md5,
+                              avatar_updated=avatar_updated, ready=ready,
+                              size=size)
         return None
 
+    def set_image_ready(self, imgid, email_md5=None):
+        """``email_md5`` is the one the image is linked to, if any."""
+        sql_stmt = """UPDATE yagra_image SET ready = 1 WHERE imgid = %s"""
+        params = (imgid, )
+        result = self.db.update(sql_stmt, params)
+        if email_md5:
+            self._avatar_changed(email_md5)
+        return result
+
+    def set_image_filename(self, imgid, filename, email_md5=None):
+        """Points the image to another file, ``email_md5`` is the one it is
+        linked to, if any.
+        """
+        sql_stmt = """UPDATE yagra_image SET filename = %s
+                WHERE imgid = %s"""
+        params = (filename, imgid)
+        result = self.db.update(sql_stmt, params)
+        if email_md5:
+            self._avatar_changed(email_md5)
+        return result
+
+    def set_image_size(self, imgid, size, email_md5=None):
+        """Stores the size of an image uploaded before yagra_image.size,
+        ``email_md5`` is the one it is linked to, if any.
+        """
+        sql_stmt = """UPDATE yagra_image SET size = %s WHERE imgid = %s"""
+        params = (size, imgid)
+        result = self.db.update(sql_stmt, params)
+        if email_md5:
+            self._avatar_changed(email_md5)
+        return result
+
+    def get_image_filenames(self, after=0, limit=1000):
+        """Returns up to ``limit`` ``(imgid, filename)`` of the images with
+        an imgid greater than ``after``, in order.
+        """
+        sql_stmt = """SELECT imgid, filename FROM yagra_image
+                WHERE imgid > %s ORDER BY imgid LIMIT %s"""
+        params = (after, limit)
+        return list(self.db.query(sql_stmt, params))
+
+    def count_filename_references(self, filename):
+        """The number of images stored in the file ``filename``."""
+        sql_stmt = """SELECT COUNT(*) FROM yagra_image
+                WHERE filename = %s"""
+        params = (filename, )
+        raw = self.db.query_one(sql_stmt, params)
+        return 0 if raw is None else raw[0]
+
+    def get_avatar_images(self, after=0, limit=1000, updated_since=None):
+        """Returns up to ``limit`` of the images linked to an email_md5,
+        with an imgid greater than ``after``, in order. Only the ones that
+        became avatars from ``updated_since`` on, if given.
+        """
+        sql_stmt = """
+                SELECT imgid, user_id, filename, created, md5, email_md5,
+                    avatar_updated, ready, size
+                FROM yagra_image
+                WHERE imgid > %s AND email_md5 != ''
+                    AND avatar_updated >= %s
+                ORDER BY imgid LIMIT %s
+                """
+        params = (after, updated_since or datetime.datetime(1970, 1, 1),
+                  limit)
+        images = []
+        for row in self.db.query(sql_stmt, params):
+            (imgid, user_id, filename, created, md5, email_md5,
+             avatar_updated, ready, size) = row
+            images.append(
+                ImageModel(imgid=imgid, user_id=user_id, filename=filename,
+                           created=created, md5=md5, email_md5=email_md5,
+                           avatar_updated=avatar_updated, ready=ready,
+                           size=size))
+        return images
+
+    def get_image_ids(self, after=0, limit=1000):
+        """Returns up to ``limit`` image ids greater than ``after``, in
+        order, to go through every image in batches.
+        """
+        sql_stmt = """SELECT imgid FROM yagra_image WHERE imgid > %s
+                ORDER BY imgid LIMIT %s"""
+        params = (after, limit)
+        return [row[0] for row in self.db.query(sql_stmt, params)]
+
     def get_own_image_count(self, user_id):
         sql_stmt = """SELECT COUNT(*) FROM yagra_image
                 WHERE user_id = %s"""
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An event loop based HTTP/1.1 server for typhoon applications.
+
+All connections of a process are multiplexed on one `IOLoop`, so idle
+keep-alive clients and slow uploads only cost a socket. Handlers written
+as coroutines (`typhoon.gen.coroutine`) give the loop back while they wait
+on `AsyncDB` queries; plain handlers still work but block the loop for the
+time they run.
+
+`AsyncServer` and `AsyncConnection` hold the socket handling shared with
+the FastCGI and SCGI servers in `typhoon.fastcgi`.
+"""
+
+import time
+import errno
+import signal
+import socket
+import collections
+from StringIO import StringIO
+
+from typhoon.log import app_log
+from typhoon.ioloop import IOLoop
+from typhoon.cgiutil import request_from_environ
+from typhoon.httpserver import (read_request_head, make_environ,
+                                HTTPParseError, MAX_HEADER_LINE,
+                                MAX_HEADERS)
+
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+_ERRNO_CONNRESET = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+MAX_HEADER_SIZE = MAX_HEADER_LINE + MAX_HEADERS * 1024
+
+# reading from a client stops while more than this many bytes wait to be
+# sent to it, and goes on once less than WRITE_BUFFER_LOW are left
+WRITE_BUFFER_HIGH = 1024 * 1024
+WRITE_BUFFER_LOW = 256 * 1024
+
+
+class AsyncConnection(object):
+
+    """A non-blocking client socket owned by an `AsyncServer`.
+
+    Subclasses parse incoming data in `on_data` and queue output with
+    `send`. While `busy` is true (a request is being handled) the idle
+    timeout does not close the connection.
+
+    Received data is kept as a list of chunks, joined when `_read_buffer`
+    is read. A subclass waiting for a known amount of data sets
+    `_read_wanted`, `on_data` is not called before that many bytes are
+    buffered, so a large body is joined once rather than on every read.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.io_loop = server.io_loop
+        self.socket = sock
+        self.address = address
+        self.busy = False
+        self._read_chunks = []
+        self._read_size = 0
+        self._read_wanted = 0
+        self._write_buffer = collections.deque()
+        self._write_size = 0
+        self._reading = True
+        # paused by send, see WRITE_BUFFER_HIGH
+        self._write_blocked = False
+        self._closed = False
+        self._timeout = None
+
+        self.socket.setblocking(False)
+        self.io_loop.add_handler(self.socket.fileno(), self._handle_events,
+                                 IOLoop.READ)
+        self._reset_timeout()
+
+    @property
+    def _read_buffer(self):
+        if len(self._read_chunks) > 1:
+            self._read_chunks = ["".join(self._read_chunks)]
+        return self._read_chunks[0] if self._read_chunks else ""
+
+    @_read_buffer.setter
+    def _read_buffer(self, data):
+        self._read_chunks = [data] if data else []
+        self._read_size = len(data)
+
+    def on_data(self):
+        """Called when new data was appended to ``self._read_buffer``."""
+        raise NotImplementedError()
+
+    def on_drained(self):
+        """Called when everything queued with `send` has been written."""
+        pass
+
+    def pause_reading(self):
+        self._reading = False
+        self._update_events()
+
+    def resume_reading(self):
+        self._reading = True
+        self._update_events()
+
+    def send(self, data):
+        if self._closed or not data:
+            return
+        self._write_buffer.append(data)
+        self._write_size += len(data)
+        self._on_writable()
+        if self._write_size > WRITE_BUFFER_HIGH and not self._write_blocked:
+            # the client does not read its responses as fast as it sends
+            # requests
+            self._write_blocked = True
+            self._update_events()
+
+    def _update_events(self):
+        if self._closed:
+            return
+        events = IOLoop.READ if self._reading and not self._write_blocked \
+            else IOLoop.NONE
+        if self._write_buffer:
+            events |= IOLoop.WRITE
+        self.io_loop.update_handler(self.socket.fileno(), events)
+
+    def _reset_timeout(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+        self._timeout = self.io_loop.call_later(self.server.idle_timeout,
+                                                self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        if self.busy:
+            self._reset_timeout()
+        else:
+            self.close()
+
+    def _handle_events(self, fd, events):
+        if events & IOLoop.READ:
+            self._on_readable()
+        if self._closed:
+            return
+        if events & IOLoop.WRITE:
+            self._on_writable()
+        if events & IOLoop.ERROR and not self._closed:
+            self.close()
+
+    def _on_readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in _ERRNO_WOULDBLOCK:
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self._read_chunks.append(data)
+        self._read_size += len(data)
+        self._reset_timeout()
+        if self._read_size >= self._read_wanted:
+            self.on_data()
+
+    def _on_writable(self):
+        while self._write_buffer:
+            try:
+                sent = self.socket.send(self._write_buffer[0])
+            except socket.error as e:
+                if e.args[0] in _ERRNO_WOULDBLOCK:
+                    break
+                if e.args[0] not in _ERRNO_CONNRESET:
+                    app_log.warning("write error on %s: %s",
+                                    self.address[0], e)
+                self.close()
+                return
+            self._write_size -= sent
+            if sent < len(self._write_buffer[0]):
+                self._write_buffer[0] = self._write_buffer[0][sent:]
+                break
+            self._write_buffer.popleft()
+
+        if self._write_blocked and self._write_size < WRITE_BUFFER_LOW:
+            self._write_blocked = False
+        self._update_events()
+        if not self._write_buffer:
+            self.on_drained()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self.io_loop.remove_handler(self.socket.fileno())
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        self.server.on_connection_closed(self)
+
+
+class AsyncHTTPConnection(AsyncConnection):
+
+    """One HTTP client, serving its requests one after another.
+
+    A response without Content-Length is sent with chunked encoding to
+    HTTP/1.1 clients and ends by closing the connection for HTTP/1.0 ones.
+    """
+
+    def __init__(self, server, sock, address):
+        super(AsyncHTTPConnection, self).__init__(server, sock, address)
+        self._keep_alive = False
+        self._method = None
+        self._version = None
+        self._chunked = False
+        self._response_finished = False
+
+    def on_data(self):
+        if self.busy or self._closed:
+            return
+        head_end = self._read_buffer.find("\r\n\r\n")
+        if head_end == -1:
+            if len(self._read_buffer) > MAX_HEADER_SIZE:
+                self._send_error(431, "Request Header Fields Too Large")
+            return
+        try:
+            head = read_request_head(
+                StringIO(self._read_buffer[:head_end + 4]))
+        except HTTPParseError as e:
+            app_log.info("bad request from %s: %s", self.address[0], e)
+            self._send_error(400, "Bad Request")
+            return
+        method, uri, version, headers = head
+        environ = make_environ(method, uri, version, headers,
+                               self.address[0])
+        if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+            self._send_error(411, "Length Required")
+            return
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            self._send_error(400, "Bad Request")
+            return
+        if length > self.server.max_body_size:
+            self._send_error(413, "Request Entity Too Large")
+            return
+        body_start = head_end + 4
+        if self._read_size < body_start + length:
+            self._read_wanted = body_start + length
+            return
+
+        self._read_wanted = 0
+        body = self._read_buffer[body_start:body_start + length]
+        self._read_buffer = self._read_buffer[body_start + length:]
+        self._method, self._version = method, version
+        connection_header = environ.get("HTTP_CONNECTION", "").lower()
+        if version == "HTTP/1.1":
+            self._keep_alive = connection_header != "close"
+        else:
+            self._keep_alive = connection_header == "keep-alive"
+
+        # stop reading until this request is answered
+        self.busy = True
+        self.pause_reading()
+        request = request_from_environ(environ, self, time.time(),
+                                       body_file=StringIO(body))
+        self.server.execute(request)
+
+    def _send_error(self, status_code, reason):
+        self._keep_alive = False
+        self.busy = True
+        self.write_headers(status_code, reason, [("Content-Length", "0")])
+        self.finish()
+
+    # methods called by RequestHandler through the request
+
+    def write_headers(self, status_code, reason, headers):
+        header_lines = ["HTTP/1.1 {0} {1}".format(status_code, reason)]
+        has_length = False
+        for k, v in headers:
+            if k.lower() == "content-length":
+                has_length = True
+            elif k.lower() == "connection":
+                continue
+            header_lines.append("{0}: {1}".format(k, v))
+        has_body = self._method != "HEAD" and status_code >= 200 and \
+            status_code not in (204, 304)
+        self._chunked = False
+        if has_body and not has_length:
+            if self._version == "HTTP/1.1":
+                self._chunked = True
+                header_lines.append("Transfer-Encoding: chunked")
+            else:
+                self._keep_alive = False
+        header_lines.append(
+            "Connection: " + ("keep-alive" if self._keep_alive else "close"))
+        self._response_finished = False
+        self.send("\r\n".join(header_lines) + "\r\n\r\n")
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        if self._chunked:
+            chunk = "{0:x}\r\n{1}\r\n".format(len(chunk), chunk)
+        self.send(chunk)
+
+    def finish(self):
+        if self._closed:
+            return
+        self._response_finished = True
+        self.server.on_request_finished()
+        if self._chunked:
+            self._chunked = False
+            self.send("0\r\n\r\n")
+        elif not self._write_buffer:
+            self.on_drained()
+
+    def on_drained(self):
+        if not self.busy or not self._response_finished:
+            return
+        self.busy = False
+        if not self._keep_alive or self.server.stopping:
+            self.close()
+            return
+        self.resume_reading()
+        # a pipelined request may already be buffered
+        self.io_loop.add_callback(self.on_data)
+
+
+class AsyncServer(object):
+
+    """Accepts connections of ``connection_class`` on one `IOLoop`.
+
+    Takes the same arguments as `typhoon.httpserver.HTTPServer`, so every
+    subclass can be run by `typhoon.httpserver.serve_prefork`.
+    """
+
+    connection_class = None
+
+    def __init__(self, application, max_requests=0, idle_timeout=60.0,
+                 max_body_size=10 * 1024 * 1024):
+        self.application = application
+        self.max_requests = max_requests
+        self.idle_timeout = idle_timeout
+        self.max_body_size = max_body_size
+        self.handled = 0
+        self.stopping = False
+        self.io_loop = None
+        self._socket = None
+        self._connections = set()
+
+    def serve_forever(self, sock):
+        self.io_loop = IOLoop.instance()
+        self._socket = sock
+        sock.setblocking(False)
+        self.io_loop.add_handler(sock.fileno(), self._on_accept,
+                                 IOLoop.READ)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: self.io_loop.add_callback(
+                          self.stop))
+        self.io_loop.start()
+
+    def _on_accept(self, fd, events):
+        while True:
+            try:
+                conn, address = self._socket.accept()
+            except socket.error as e:
+                if e.args[0] in _ERRNO_WOULDBLOCK + (errno.ECONNABORTED,):
+                    return
+                raise
+            self._connections.add(self.connection_class(self, conn, address))
+
+    def execute(self, request):
+        try:
+            self.application.execute(request)
+        except Exception:
+            app_log.exception("uncaught exception serving %s", request.uri)
+            request.connection.close()
+
+    def on_request_finished(self):
+        self.handled += 1
+        if self.max_requests and self.handled >= self.max_requests:
+            self.stop()
+
+    def on_connection_closed(self, connection):
+        self._connections.discard(connection)
+        if self.stopping and not self._connections:
+            self.io_loop.stop()
+
+    def stop(self):
+        """Stops accepting and stops the loop once open requests are done.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.io_loop.remove_handler(self._socket.fileno())
+        for connection in list(self._connections):
+            if not connection.busy:
+                connection.close()
+        if not self._connections:
+            self.io_loop.stop()
+
+
+class AsyncHTTPServer(AsyncServer):
+
+    connection_class = AsyncHTTPConnection
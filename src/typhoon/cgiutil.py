@@ -2,9 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import cgi
 import time
-import Cookie
 from urlparse import parse_qs
 
 from typhoon.util import utf8
@@ -15,9 +13,22 @@ class CGIConnection(object):
     def __init__(self, stream):
         self.stream = stream
 
+    def write_headers(self, status_code, reason, headers):
+        """Writes the response status and headers in CGI format.
+
+        ``headers`` is a list of (name, value) pairs, names may repeat.
+        """
+        header_lines = ['Status: {0} {1}'.format(status_code, reason)]
+        for k, v in headers:
+            header_lines.append('{0}: {1}'.format(k, v))
+        self.write('\r\n'.join(header_lines) + '\r\n\r\n')
+
     def write(self, chunk):
         self.stream.write(chunk)
 
+    def finish(self):
+        pass
+
     def close(self):
         if self.stream is not None:
             self.stream.close()
@@ -26,9 +37,8 @@ class CGIConnection(object):
 class CGIRequest(object):
 
     def __init__(self, method=None, uri=None, version=None, headers=None,
-                 body=None, host=None, remote_addr=None, connection=None,
-                 start_time=None
-                 ):
+                 host=None, remote_addr=None, connection=None,
+                 start_time=None, body_file=None):
         self.method = method
         self.uri = uri
         self.version = version
@@ -41,33 +51,78 @@ class CGIRequest(object):
         self._finish_time = None
 
         self.path, sep, self.query = uri.partition('?')
-        self.arguments = parse_qs(self.query, keep_blank_values=True)
-        self.upload_files = {}
-
-        form = cgi.FieldStorage()
-        """FIXME: post request contentType can't be application/json,
-        maybe a drawback of python cgi library? Some references:
-        https://groups.google.com/forum/#!topic/google-appengine-python/D_Gdp0Svtyg
-        http://stackoverflow.com/questions/17247347/why-do-post-file-uploads-in-gae-not-have-access-to-the-cgi-fieldstorage-methods
-
-        post with application/json as content type has bug as following:
-            if form.keys():
-            raise TypeError, "not indexable"
+        # The query string and the body are parsed the first time
+        # `arguments`, `upload_files` or `body` is used, most requests (like
+        # avatar GETs) never need them.
+        self._arguments = None
+        self._upload_files = {}
+        self._body = None
+
+        # Where uploaded files are streamed to and the size they may have,
+        # `Application.execute` sets both from its settings before the
+        # handler gets to read the body.
+        self.upload_dir = None
+        self.max_upload_size = None
+
+        # body_file defaults to sys.stdin, which is what a plain CGI process
+        # gets from the web server.
+        self._body_file = body_file
+
+    def _parse_arguments(self):
+        self._arguments = parse_qs(self.query, keep_blank_values=True)
+        self._body = ""
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return
+        from typhoon.multipart import parse_body
+        fp = self._body_file if self._body_file is not None else sys.stdin
+        self._body = parse_body(self.headers.get("Content-Type"), fp, length,
+                                self._arguments, self._upload_files,
+                                self.upload_dir, self.max_upload_size)
+
+    @property
+    def arguments(self):
+        """Query and form arguments, a dict of lists of strings."""
+        if self._arguments is None:
+            self._parse_arguments()
+        return self._arguments
+
+    @property
+    def upload_files(self):
+        """Uploaded files by field name, see `typhoon.multipart.UploadedFile`.
+        """
+        if self._arguments is None:
+            self._parse_arguments()
+        return self._upload_files
+
+    @property
+    def body(self):
+        """The raw request body, empty for form bodies which are parsed into
+        `arguments` and `upload_files`.
         """
-        for k in form.keys():
-            if form[k].file:
-                self.upload_files[k] = form[k]
-            # here we also set form.getlist(k) to arguments, eg.
-            # form['_xsrf'=.file is True
-            self.arguments.setdefault(k, []).extend(form.getlist(k))
+        if self._arguments is None:
+            self._parse_arguments()
+        return self._body
 
     def write(self, chunk):
         self.connection.write(chunk)
 
+    def finish(self):
+        """Finishes this request on the underlying connection."""
+        self._finish_time = time.time()
+        # uploads the handler did not save
+        for upload_file in self._upload_files.values():
+            upload_file.discard()
+        self.connection.finish()
+
     @property
     def cookies(self):
         """A dictionary of Cookie.Morsel objects."""
         if not hasattr(self, "_cookies"):
+            import Cookie
             self._cookies = Cookie.SimpleCookie()
             if "Cookie" in self.headers:
                 try:
@@ -77,8 +132,59 @@ class CGIRequest(object):
         return self._cookies
 
 
+def request_from_environ(environ, connection, start_time=None,
+                         body_file=None):
+    """Builds a `CGIRequest` from a CGI/WSGI style environ dict."""
+    uri = environ.get("REQUEST_URI")
+    if not uri:
+        # REQUEST_URI is an Apache extension, WSGI servers are only required
+        # to provide the decoded SCRIPT_NAME and PATH_INFO.
+        import urllib
+        uri = urllib.quote(environ.get("SCRIPT_NAME", "") +
+                           environ.get("PATH_INFO", ""))
+        if environ.get("QUERY_STRING"):
+            uri += "?" + environ["QUERY_STRING"]
+    headers = HTTPHeaders()
+    for key, value in environ.iteritems():
+        if key.startswith("HTTP_"):
+            headers[key[5:].replace("_", "-")] = value
+        elif key in ("CONTENT_TYPE", "CONTENT_LENGTH") and value:
+            headers[key.replace("_", "-")] = value
+    return CGIRequest(
+        method=environ.get("REQUEST_METHOD"),
+        uri=uri,
+        version=environ.get('SERVER_PROTOCOL'),
+        headers=headers,
+        host=environ.get("HTTP_HOST"),
+        remote_addr=environ.get('REMOTE_ADDR'),
+        connection=connection,
+        start_time=start_time,
+        body_file=body_file,
+    )
+
+
+class _NormalizedHeaderCache(dict):
+
+    """Maps header names to their "Http-Header-Case" form."""
+
+    def __missing__(self, key):
+        normalized = "-".join(w.capitalize() for w in key.split("-"))
+        if len(self) < 1000:
+            self[key] = normalized
+        return normalized
+
+
+_normalized_headers = _NormalizedHeaderCache()
+
+
 class HTTPHeaders(dict):
 
+    """A dict of headers with case-insensitive names.
+
+    A header sent several times is joined with commas, `get_list` returns
+    its values one by one.
+    """
+
     def __init__(self, *args, **kwargs):
         # Don't pass args or kwargs to dict.__init__, as it will bypass
         # our __setitem__
@@ -96,7 +202,7 @@ class HTTPHeaders(dict):
 
     def get_list(self, name):
         """Returns all values for the given header as a list."""
-        return self._as_list.get(name, [])
+        return self._as_list.get(_normalized_headers[name], [])
 
     def get_all(self):
         """Returns an iterable of all (name, value) pairs.
@@ -107,3 +213,44 @@ class HTTPHeaders(dict):
         for name, values in self._as_list.items():
             for value in values:
                 yield (name, value)
+
+    def add(self, name, value):
+        """Adds a new value for the given header."""
+        norm_name = _normalized_headers[name]
+        self._last_key = norm_name
+        if norm_name in self:
+            dict.__setitem__(self, norm_name, self[norm_name] + "," + value)
+            self._as_list[norm_name].append(value)
+        else:
+            self[norm_name] = value
+
+    def __setitem__(self, name, value):
+        norm_name = _normalized_headers[name]
+        dict.__setitem__(self, norm_name, value)
+        self._as_list[norm_name] = [value]
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, _normalized_headers[name])
+
+    def __delitem__(self, name):
+        norm_name = _normalized_headers[name]
+        dict.__delitem__(self, norm_name)
+        del self._as_list[norm_name]
+
+    def __contains__(self, name):
+        return dict.__contains__(self, _normalized_headers[name])
+
+    def get(self, name, default=None):
+        return dict.get(self, _normalized_headers[name], default)
+
+    def pop(self, name, *default):
+        self._as_list.pop(_normalized_headers[name], None)
+        return dict.pop(self, _normalized_headers[name], *default)
+
+    def update(self, *args, **kwargs):
+        # dict.update bypasses __setitem__
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def copy(self):
+        return HTTPHeaders(self)
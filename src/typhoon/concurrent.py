@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Futures and a thread pool executor for the typhoon event loop.
+
+Python 2 has neither asyncio nor concurrent.futures, this module provides
+the small subset of both that `typhoon.gen` and `typhoon.ioloop` need.
+"""
+
+import sys
+import threading
+
+
+class Future(object):
+
+    """Placeholder for the result of an asynchronous operation.
+
+    Callbacks added with `add_done_callback` are run as soon as the result
+    is set, in the thread that sets it. `ThreadPoolExecutor` always sets
+    results on the IOLoop thread, so callbacks never run concurrently.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("result() called on a pending future")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def set_exception(self, exception):
+        self.set_exc_info((exception.__class__, exception, None))
+
+    def _set_done(self):
+        if self._done:
+            raise RuntimeError("future already done")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            cb(self)
+
+
+def is_future(x):
+    return isinstance(x, Future)
+
+
+class ThreadPoolExecutor(object):
+
+    """Runs blocking functions on a pool of threads.
+
+    `submit` returns a `Future` which is resolved on ``io_loop``, so
+    coroutines can ``yield`` it without blocking the event loop.
+    """
+
+    def __init__(self, max_workers, io_loop=None, initializer=None):
+        self.max_workers = max_workers
+        self.io_loop = io_loop
+        self.initializer = initializer
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # created on first use, so the threads are started in the process
+        # that uses them and never before a fork
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.max_workers,
+                                        initializer=self.initializer)
+        return self._pool
+
+    def submit(self, fn, *args, **kwargs):
+        from typhoon.ioloop import IOLoop
+        io_loop = self.io_loop or IOLoop.instance()
+        future = Future()
+
+        def run():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+
+        self._get_pool().apply_async(run)
+        return future
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""FastCGI and SCGI responders for typhoon applications.
+
+Both protocols carry the CGI environ a web server like nginx would pass to
+main.py, so requests go through the same `request_from_environ`,
+`Application.execute` and CGI style response (``Status:`` header) as the
+CGI entry point, only the process stays resident::
+
+    location / {
+        include fastcgi_params;
+        fastcgi_keep_conn on;
+        fastcgi_pass 127.0.0.1:9000;
+    }
+
+The servers run on the `IOLoop` like `typhoon.asyncserver.AsyncHTTPServer`
+so a worker can keep many persistent FastCGI connections, and several
+requests multiplexed on one of them, open at once.
+"""
+
+import time
+import struct
+from StringIO import StringIO
+
+from typhoon.log import app_log
+from typhoon.cgiutil import CGIConnection, request_from_environ
+from typhoon.asyncserver import AsyncConnection, AsyncServer
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_KEEP_CONN = 1
+
+FCGI_RESPONDER = 1
+
+FCGI_REQUEST_COMPLETE = 0
+FCGI_UNKNOWN_ROLE = 3
+
+FCGI_HEADER = struct.Struct("!BBHHBx")
+FCGI_BEGIN_REQUEST_BODY = struct.Struct("!HB5x")
+FCGI_END_REQUEST_BODY = struct.Struct("!LB3x")
+
+FCGI_MAX_CONTENT = 65535
+
+
+def encode_record(record_type, request_id, content=""):
+    """Encodes one record, ``content`` must fit in a single record."""
+    padding = -len(content) % 8
+    return (FCGI_HEADER.pack(FCGI_VERSION_1, record_type, request_id,
+                             len(content), padding) +
+            content + "\x00" * padding)
+
+
+def encode_stream(record_type, request_id, data):
+    """Encodes ``data`` as as many records as needed."""
+    records = []
+    for offset in range(0, len(data), FCGI_MAX_CONTENT):
+        records.append(encode_record(
+            record_type, request_id,
+            data[offset:offset + FCGI_MAX_CONTENT]))
+    return "".join(records)
+
+
+def _encode_length(length):
+    if length < 128:
+        return chr(length)
+    return struct.pack("!L", length | 0x80000000)
+
+
+def encode_pairs(pairs):
+    return "".join(_encode_length(len(name)) + _encode_length(len(value)) +
+                   name + value for name, value in pairs)
+
+
+def decode_pairs(data):
+    """Decodes FastCGI name-value pairs into a list of tuples."""
+    pairs = []
+    pos = 0
+    while pos < len(data):
+        lengths = []
+        for _ in range(2):
+            if ord(data[pos]) & 0x80:
+                lengths.append(
+                    struct.unpack("!L", data[pos:pos + 4])[0] & 0x7fffffff)
+                pos += 4
+            else:
+                lengths.append(ord(data[pos]))
+                pos += 1
+        name_length, value_length = lengths
+        name = data[pos:pos + name_length]
+        pos += name_length
+        value = data[pos:pos + value_length]
+        pos += value_length
+        pairs.append((name, value))
+    return pairs
+
+
+class _FastCGIStdout(object):
+
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+
+    def write(self, chunk):
+        if chunk:
+            self.connection.send(
+                encode_stream(FCGI_STDOUT, self.request_id, chunk))
+
+
+class FastCGIResponse(CGIConnection):
+
+    """The response side of one FastCGI request.
+
+    Output is CGI formatted like in `CGIConnection` and sent as FCGI_STDOUT
+    records, `finish` ends the request.
+    """
+
+    def __init__(self, connection, request_id, keep_conn):
+        super(FastCGIResponse, self).__init__(
+            _FastCGIStdout(connection, request_id))
+        self.connection = connection
+        self.io_loop = connection.io_loop
+        self.request_id = request_id
+        self.keep_conn = keep_conn
+
+    def finish(self):
+        self.connection.end_request(self.request_id, self.keep_conn)
+
+    def close(self):
+        self.connection.close()
+
+
+class _FastCGIRequestState(object):
+
+    def __init__(self, keep_conn):
+        self.keep_conn = keep_conn
+        self.params = []
+        self.stdin = []
+        self.stdin_length = 0
+        self.started = False
+
+
+class FastCGIConnection(AsyncConnection):
+
+    """One FastCGI connection from the web server.
+
+    Requests are started as soon as their FCGI_STDIN stream is complete,
+    several of them may be in flight on the same connection.
+    """
+
+    def __init__(self, server, sock, address):
+        super(FastCGIConnection, self).__init__(server, sock, address)
+        self._requests = {}
+        self._close_when_drained = False
+
+    def on_data(self):
+        buf = self._read_buffer
+        pos = 0
+        while len(buf) - pos >= FCGI_HEADER.size:
+            version, record_type, request_id, length, padding = \
+                FCGI_HEADER.unpack_from(buf, pos)
+            end = pos + FCGI_HEADER.size + length + padding
+            if len(buf) < end:
+                self._read_wanted = end - pos
+                break
+            content = buf[pos + FCGI_HEADER.size:
+                          pos + FCGI_HEADER.size + length]
+            pos = end
+            if version != FCGI_VERSION_1:
+                app_log.warning("unsupported FastCGI version %d", version)
+                self.close()
+                return
+            self._handle_record(record_type, request_id, content)
+            if self._closed:
+                return
+        else:
+            self._read_wanted = 0
+        self._read_buffer = buf[pos:]
+
+    def _handle_record(self, record_type, request_id, content):
+        if record_type == FCGI_GET_VALUES:
+            values = {
+                "FCGI_MAX_CONNS": "1000",
+                "FCGI_MAX_REQS": "1000",
+                "FCGI_MPXS_CONNS": "1",
+            }
+            result = [(name, values[name])
+                      for name, _ in decode_pairs(content) if name in values]
+            self.send(encode_record(FCGI_GET_VALUES_RESULT, 0,
+                                    encode_pairs(result)))
+        elif record_type == FCGI_BEGIN_REQUEST:
+            role, flags = FCGI_BEGIN_REQUEST_BODY.unpack(content)
+            if role != FCGI_RESPONDER:
+                self.send(encode_record(
+                    FCGI_END_REQUEST, request_id,
+                    FCGI_END_REQUEST_BODY.pack(0, FCGI_UNKNOWN_ROLE)))
+                return
+            self._requests[request_id] = _FastCGIRequestState(
+                bool(flags & FCGI_KEEP_CONN))
+        elif record_type == FCGI_ABORT_REQUEST:
+            state = self._requests.get(request_id)
+            if state is not None and not state.started:
+                self.end_request(request_id, state.keep_conn)
+        elif record_type == FCGI_PARAMS:
+            state = self._requests.get(request_id)
+            if state is not None:
+                state.params.append(content)
+        elif record_type == FCGI_STDIN:
+            state = self._requests.get(request_id)
+            if state is None or state.started:
+                return
+            if content:
+                state.stdin.append(content)
+                state.stdin_length += len(content)
+                if state.stdin_length > self.server.max_body_size:
+                    app_log.warning("request body too large from %s",
+                                    self.address[0])
+                    self.close()
+            else:
+                self._start_request(request_id, state)
+        elif record_type not in (FCGI_DATA, ):
+            self.send(encode_record(FCGI_UNKNOWN_TYPE, 0,
+                                    chr(record_type) + "\x00" * 7))
+
+    def _start_request(self, request_id, state):
+        state.started = True
+        self.busy = True
+        environ = dict(decode_pairs("".join(state.params)))
+        body = StringIO("".join(state.stdin))
+        state.params = state.stdin = None
+        response = FastCGIResponse(self, request_id, state.keep_conn)
+        request = request_from_environ(environ, response, time.time(),
+                                       body_file=body)
+        self.server.execute(request)
+
+    def end_request(self, request_id, keep_conn):
+        if self._requests.pop(request_id, None) is None:
+            return
+        self.send(encode_record(FCGI_STDOUT, request_id) +
+                  encode_record(FCGI_END_REQUEST, request_id,
+                                FCGI_END_REQUEST_BODY.pack(
+                                    0, FCGI_REQUEST_COMPLETE)))
+        self.server.on_request_finished()
+        self.busy = bool(self._requests)
+        if not keep_conn or self.server.stopping:
+            self._close_when_drained = True
+            self.on_drained()
+
+    def on_drained(self):
+        if self._close_when_drained and not self._write_buffer:
+            self.close()
+
+
+class FastCGIServer(AsyncServer):
+
+    connection_class = FastCGIConnection
+
+
+class SCGIResponse(CGIConnection):
+
+    """CGI formatted output of an SCGI request, closed when finished."""
+
+    def __init__(self, connection):
+        super(SCGIResponse, self).__init__(connection)
+        self.connection = connection
+        self.io_loop = connection.io_loop
+
+    def write(self, chunk):
+        self.connection.send(chunk)
+
+    def finish(self):
+        self.connection.end_request()
+
+    def close(self):
+        self.connection.close()
+
+
+class SCGIConnection(AsyncConnection):
+
+    """One SCGI request: a netstring of headers followed by the body."""
+
+    def __init__(self, server, sock, address):
+        super(SCGIConnection, self).__init__(server, sock, address)
+        self._finished = False
+
+    def on_data(self):
+        if self.busy or self._closed:
+            return
+        length_end = self._read_buffer.find(":")
+        if length_end == -1:
+            if len(self._read_buffer) > 10:
+                self.close()
+            return
+        try:
+            headers_length = int(self._read_buffer[:length_end])
+        except ValueError:
+            self.close()
+            return
+        headers_end = length_end + 1 + headers_length
+        if len(self._read_buffer) < headers_end + 1:
+            return
+        if self._read_buffer[headers_end] != ",":
+            self.close()
+            return
+        items = self._read_buffer[length_end + 1:headers_end].split("\x00")
+        environ = dict(zip(items[0::2], items[1::2]))
+        try:
+            body_length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            self.close()
+            return
+        if body_length > self.server.max_body_size:
+            self.close()
+            return
+        body_start = headers_end + 1
+        if self._read_size < body_start + body_length:
+            self._read_wanted = body_start + body_length
+            return
+
+        self._read_wanted = 0
+        body = self._read_buffer[body_start:body_start + body_length]
+        self._read_buffer = ""
+        self.busy = True
+        self.pause_reading()
+        request = request_from_environ(environ, SCGIResponse(self),
+                                       time.time(), body_file=StringIO(body))
+        self.server.execute(request)
+
+    def end_request(self):
+        self._finished = True
+        self.server.on_request_finished()
+        self.on_drained()
+
+    def on_drained(self):
+        if self._finished and not self._write_buffer:
+            self.close()
+
+
+class SCGIServer(AsyncServer):
+
+    connection_class = SCGIConnection
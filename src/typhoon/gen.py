@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Generator based coroutines.
+
+Python 2 has no ``async def``, a coroutine is a generator decorated with
+`coroutine` that yields `Future` objects (or lists of them) and gets their
+results back::
+
+    class AvatarHandler(RequestHandler):
+
+        @gen.coroutine
+        def get(self, email_md5):
+            image = yield async_dao.get_image_by_emailmd5(email_md5)
+            ...
+
+Generators can not return a value, use ``raise gen.Return(value)``.
+"""
+
+import sys
+import types
+from functools import wraps
+
+from typhoon.concurrent import Future, is_future
+
+
+class Return(Exception):
+
+    """Special exception to return a value from a `coroutine`."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class BadYieldError(Exception):
+    pass
+
+
+def coroutine(func):
+    """Decorator for generator based coroutines, which return a `Future`."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return as e:
+            future.set_result(e.value)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        else:
+            if isinstance(result, types.GeneratorType):
+                Runner(result, future).run(None)
+            else:
+                future.set_result(result)
+        return future
+    return wrapper
+
+
+def multi_future(children):
+    """Wraps a list of futures in a single one resolving to their results."""
+    future = Future()
+    if not children:
+        future.set_result([])
+        return future
+    pending = set(range(len(children)))
+
+    def on_done(i, f):
+        pending.discard(i)
+        if future.done():
+            return
+        if f.exc_info() is not None:
+            future.set_exc_info(f.exc_info())
+        elif not pending:
+            future.set_result([child.result() for child in children])
+
+    for i, child in enumerate(children):
+        child.add_done_callback(lambda f, i=i: on_done(i, f))
+    return future
+
+
+class Runner(object):
+
+    """Drives a generator until it finishes, resolving ``result_future``."""
+
+    def __init__(self, gen, result_future):
+        self.gen = gen
+        self.result_future = result_future
+
+    def run(self, yielded):
+        # The loop keeps the stack flat while yielded futures are already
+        # done, a pending one resumes us from its done callback.
+        while True:
+            try:
+                if yielded is None:
+                    value = self.gen.send(None)
+                else:
+                    exc_info = yielded.exc_info()
+                    if exc_info is not None:
+                        value = self.gen.throw(*exc_info)
+                    else:
+                        value = self.gen.send(yielded.result())
+            except (StopIteration, Return) as e:
+                self.result_future.set_result(getattr(e, "value", None))
+                return
+            except Exception:
+                self.result_future.set_exc_info(sys.exc_info())
+                return
+
+            if isinstance(value, list):
+                value = multi_future(value)
+            if not is_future(value):
+                yielded = Future()
+                yielded.set_exc_info(self._bad_yield(value))
+                continue
+            if not value.done():
+                value.add_done_callback(self.run)
+                return
+            yielded = value
+
+    def _bad_yield(self, value):
+        try:
+            raise BadYieldError("yielded unknown object %r" % (value,))
+        except BadYieldError:
+            return sys.exc_info()
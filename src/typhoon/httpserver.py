@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A blocking HTTP/1.1 server for typhoon applications.
+
+Each worker accepts connections one at a time and serves a single request
+per connection (``Connection: close``), like a synchronous gunicorn
+worker. It is meant to run behind nginx in several preforked processes,
+see `typhoon.process.run_prefork` and ``main.py serve``.
+"""
+
+import sys
+import time
+import errno
+import signal
+import socket
+
+from typhoon.log import app_log
+from typhoon.cgiutil import request_from_environ
+
+# Not exported by the python 2 socket module, the value is the one used by
+# Linux (and only meaningful there).
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT",
+                       15 if sys.platform.startswith("linux") else None)
+
+MAX_HEADER_LINE = 65536
+MAX_HEADERS = 100
+
+
+def bind_socket(port, address="", backlog=128, reuse_port=False):
+    """Creates a listening socket bound to the given port and address.
+
+    With ``reuse_port`` every worker may bind its own socket to the same
+    port and the kernel balances new connections between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
+
+
+class HTTPParseError(Exception):
+    pass
+
+
+class BodyReader(object):
+
+    """File-like object that reads at most ``length`` bytes of a body."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else ""
+        self.remaining -= len(data)
+        return data
+
+
+def read_request_head(rfile):
+    """Reads the request line and headers from ``rfile``.
+
+    Returns ``(method, uri, version, headers)`` where headers is a list of
+    (name, value) pairs, or None if the client closed the connection.
+    """
+    line = rfile.readline(MAX_HEADER_LINE + 1)
+    if not line:
+        return None
+    if len(line) > MAX_HEADER_LINE:
+        raise HTTPParseError("request line too long")
+    try:
+        method, uri, version = line.split()
+    except ValueError:
+        raise HTTPParseError("malformed request line %r" % line)
+    if not version.startswith("HTTP/"):
+        raise HTTPParseError("malformed HTTP version %r" % version)
+
+    headers = []
+    while True:
+        line = rfile.readline(MAX_HEADER_LINE + 1)
+        if len(line) > MAX_HEADER_LINE:
+            raise HTTPParseError("header line too long")
+        if line in ("\r\n", "\n", ""):
+            break
+        if line[0] in " \t" and headers:
+            # obsolete line folding
+            name, value = headers[-1]
+            headers[-1] = (name, value + " " + line.strip())
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPParseError("malformed header line %r" % line)
+        headers.append((name.strip(), value.strip()))
+        if len(headers) > MAX_HEADERS:
+            raise HTTPParseError("too many headers")
+    return method, uri, version, headers
+
+
+def make_environ(method, uri, version, headers, remote_addr):
+    """Builds a CGI style environ for a parsed HTTP request."""
+    path, _, query = uri.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "REQUEST_URI": uri,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_PROTOCOL": version,
+        "REMOTE_ADDR": remote_addr,
+    }
+    for name, value in headers:
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        if key in environ:
+            environ[key] += "," + value
+        else:
+            environ[key] = value
+    return environ
+
+
+class HTTPConnection(object):
+
+    """Writes a response to an HTTP client as it is produced.
+
+    The connection is closed after every response, so a body streamed
+    without Content-Length simply ends with it.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write_headers(self, status_code, reason, headers):
+        header_lines = ["HTTP/1.1 {0} {1}".format(status_code, reason)]
+        for k, v in headers:
+            if k.lower() != "connection":
+                header_lines.append("{0}: {1}".format(k, v))
+        header_lines.append("Connection: close")
+        self.wfile.write("\r\n".join(header_lines) + "\r\n\r\n")
+
+    def write(self, chunk):
+        if chunk:
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+    def finish(self):
+        self.wfile.flush()
+
+    def close(self):
+        pass
+
+
+class HTTPServer(object):
+
+    """Serves ``application`` on an already bound listening socket.
+
+    ``max_requests`` makes `serve_forever` return after that many requests
+    so the process can be replaced by a fresh one, 0 means never.
+    """
+
+    def __init__(self, application, max_requests=0, timeout=30.0):
+        self.application = application
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.handled = 0
+        self._stopped = False
+
+    def stop(self, *args):
+        self._stopped = True
+
+    def serve_forever(self, sock):
+        signal.signal(signal.SIGTERM, self.stop)
+        while not self._stopped:
+            if self.max_requests and self.handled >= self.max_requests:
+                break
+            try:
+                conn, address = sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN,
+                                 errno.ECONNABORTED):
+                    continue
+                raise
+            try:
+                self.handle_connection(conn, address)
+            except Exception:
+                app_log.exception("error handling connection from %s",
+                                  address[0])
+            finally:
+                conn.close()
+
+    def handle_connection(self, conn, address):
+        conn.settimeout(self.timeout)
+        rfile = conn.makefile("rb", -1)
+        wfile = conn.makefile("wb", -1)
+        try:
+            try:
+                head = read_request_head(rfile)
+            except (HTTPParseError, socket.timeout) as e:
+                app_log.info("bad request from %s: %s", address[0], e)
+                wfile.write("HTTP/1.1 400 Bad Request\r\n"
+                            "Content-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            if head is None:
+                return
+            start_time = time.time()
+            method, uri, version, headers = head
+            environ = make_environ(method, uri, version, headers, address[0])
+            try:
+                length = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                length = 0
+            connection = HTTPConnection(wfile)
+            request = request_from_environ(
+                environ, connection, start_time,
+                body_file=BodyReader(rfile, length))
+            self.application.execute(request)
+            self.handled += 1
+        finally:
+            try:
+                wfile.close()
+            except socket.error:
+                pass
+            rfile.close()
+
+
+def serve_prefork(application, port, address="", num_processes=None,
+                  max_requests=0, reuse_port=False, server_class=None):
+    """Serves ``application`` from ``num_processes`` forked workers.
+
+    Without ``reuse_port`` the listening socket is bound once here and
+    inherited by every worker, with it each worker binds its own socket.
+    ``server_class`` defaults to `HTTPServer`, any class taking the same
+    arguments and providing ``serve_forever(sock)`` can be used.
+    """
+    from typhoon.process import run_prefork
+
+    sock = None
+    if not reuse_port:
+        sock = bind_socket(port, address)
+
+    def worker(task_id):
+        listener = sock or bind_socket(port, address, reuse_port=True)
+        app_log.info("worker %d listening on %s:%d", task_id, address, port)
+        server = (server_class or HTTPServer)(application,
+                                              max_requests=max_requests)
+        server.serve_forever(listener)
+
+    app_log.info("typhoon serving on %s:%d", address or "*", port)
+    run_prefork(num_processes, worker)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A level-triggered I/O event loop.
+
+Uses epoll where available and falls back to select. There is one loop
+per process, see `IOLoop.instance`; create it after forking.
+"""
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import select
+import threading
+
+from typhoon.log import app_log
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Select(object):
+
+    """An epoll-compatible interface built on select.select."""
+
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+
+    def register(self, fd, events):
+        if events & IOLoop.READ:
+            self.read_fds.add(fd)
+        if events & IOLoop.WRITE:
+            self.write_fds.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self.read_fds.discard(fd)
+        self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        readable, writeable, _ = select.select(
+            self.read_fds, self.write_fds, [], timeout)
+        events = {}
+        for fd in readable:
+            events[fd] = events.get(fd, 0) | IOLoop.READ
+        for fd in writeable:
+            events[fd] = events.get(fd, 0) | IOLoop.WRITE
+        return events.items()
+
+
+class _Timeout(object):
+
+    __slots__ = ["deadline", "callback", "cancelled"]
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class IOLoop(object):
+
+    # constants from the epoll module, _Select uses the same values
+    NONE = 0
+    READ = 0x001
+    WRITE = 0x004
+    ERROR = 0x008 | 0x010
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """Returns the IOLoop of this process, creating it if needed."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self._impl = select.epoll() if hasattr(select, "epoll") \
+            else _Select()
+        self._handlers = {}
+        self._callbacks = []
+        # reentrant, so a signal handler may call add_callback
+        self._callback_lock = threading.RLock()
+        self._timeouts = []
+        self._running = False
+        self._stopped = False
+
+        # a pipe written to by add_callback to wake up a blocking poll
+        self._waker_r, self._waker_w = os.pipe()
+        _set_nonblocking(self._waker_r)
+        _set_nonblocking(self._waker_w)
+        self.add_handler(self._waker_r, self._consume_waker, self.READ)
+
+    def _consume_waker(self, fd, events):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _wake(self):
+        try:
+            os.write(self._waker_w, "x")
+        except OSError:
+            pass
+
+    def add_handler(self, fd, handler, events):
+        """Calls ``handler(fd, events)`` whenever ``fd`` has ``events``."""
+        self._handlers[fd] = handler
+        self._impl.register(fd, events | self.ERROR)
+
+    def update_handler(self, fd, events):
+        self._impl.modify(fd, events | self.ERROR)
+
+    def remove_handler(self, fd):
+        self._handlers.pop(fd, None)
+        try:
+            self._impl.unregister(fd)
+        except (OSError, IOError):
+            app_log.debug("error removing fd %d from IOLoop", fd)
+
+    def add_callback(self, callback, *args):
+        """Runs ``callback`` on the next loop iteration.
+
+        This is the only method that is safe to call from other threads.
+        """
+        with self._callback_lock:
+            self._callbacks.append((callback, args))
+        self._wake()
+
+    def call_later(self, delay, callback, *args):
+        """Runs ``callback`` after ``delay`` seconds, returns a handle for
+        `remove_timeout`.
+        """
+        timeout = _Timeout(time.time() + delay,
+                           lambda: callback(*args))
+        heapq.heappush(self._timeouts, timeout)
+        return timeout
+
+    def remove_timeout(self, timeout):
+        timeout.cancelled = True
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            app_log.exception("exception in callback %r", callback)
+
+    def start(self):
+        self._running = True
+        self._stopped = False
+        try:
+            while not self._stopped:
+                with self._callback_lock:
+                    callbacks, self._callbacks = self._callbacks, []
+                for callback, args in callbacks:
+                    self._run_callback(callback, *args)
+
+                poll_timeout = 3600.0
+                now = time.time()
+                while self._timeouts:
+                    if self._timeouts[0].cancelled:
+                        heapq.heappop(self._timeouts)
+                    elif self._timeouts[0].deadline <= now:
+                        timeout = heapq.heappop(self._timeouts)
+                        self._run_callback(timeout.callback)
+                    else:
+                        poll_timeout = min(poll_timeout,
+                                           self._timeouts[0].deadline - now)
+                        break
+                if self._callbacks or self._stopped:
+                    poll_timeout = 0.0
+
+                try:
+                    events = self._impl.poll(poll_timeout)
+                except (OSError, IOError, select.error) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd, fd_events in events:
+                    handler = self._handlers.get(fd)
+                    if handler is not None:
+                        self._run_callback(handler, fd, fd_events)
+        finally:
+            self._running = False
+
+    def stop(self):
+        """Stops the loop after the current iteration."""
+        self._stopped = True
+        self._wake()
+
+    def run_sync(self, func):
+        """Starts the loop, runs ``func`` and stops once its future is done.
+
+        ``func`` may return a `Future` or a plain value. This lets blocking
+        server modes serve coroutine handlers one request at a time.
+        """
+        from typhoon.concurrent import is_future
+
+        result = func()
+        if not is_future(result):
+            return result
+        if not result.done():
+            result.add_done_callback(lambda f: self.stop())
+            self.start()
+        return result.result()
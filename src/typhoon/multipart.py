@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Streaming request body parsing, replacing cgi.FieldStorage.
+
+The body is read in chunks of ``CHUNK_SIZE`` bytes. Uploaded files go
+straight into a temporary file in the upload directory while their MD5
+is computed, so memory use does not depend on the size of the upload, and
+`UploadedFile.save` only has to rename the file into place.
+"""
+
+import os
+import hashlib
+import tempfile
+from StringIO import StringIO
+from urlparse import parse_qs
+
+from typhoon.log import app_log
+from typhoon.util import default_file_mode
+
+CHUNK_SIZE = 64 * 1024
+
+# bytes of each upload kept in UploadedFile.head to sniff its type
+HEAD_SIZE = 64
+
+MAX_PART_HEADER_SIZE = 16 * 1024
+
+
+def parse_header(line):
+    """Parses a header like Content-Type into its value and parameters.
+
+    >>> parse_header('form-data; name="upload"; filename="a.png"')
+    ('form-data', {'name': 'upload', 'filename': 'a.png'})
+    """
+    parts = []
+    rest = line
+    while rest:
+        # split on ';' outside of quoted strings
+        end, quoted, i = None, False, 0
+        while i < len(rest):
+            c = rest[i]
+            if c == "\\" and quoted:
+                i += 1
+            elif c == '"':
+                quoted = not quoted
+            elif c == ";" and not quoted:
+                end = i
+                break
+            i += 1
+        if end is None:
+            parts.append(rest)
+            break
+        parts.append(rest[:end])
+        rest = rest[end + 1:]
+
+    value = parts[0].strip().lower()
+    params = {}
+    for part in parts[1:]:
+        name, sep, param = part.partition("=")
+        if not sep:
+            continue
+        param = param.strip()
+        if len(param) >= 2 and param[0] == param[-1] == '"':
+            param = param[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        params[name.strip().lower()] = param
+    return value, params
+
+
+class UploadedFile(object):
+
+    """A file field of a multipart/form-data body.
+
+    ``md5`` is the hex digest and ``head`` the first `HEAD_SIZE` bytes of the
+    content, which is in ``file``. If the upload was bigger than the
+    allowed size ``too_large`` is set and ``file`` is empty.
+    """
+
+    def __init__(self, name, filename, content_type, upload_dir=None):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.head = ""
+        self.too_large = False
+        self._md5 = hashlib.md5()
+        self.md5 = None
+        if upload_dir and filename:
+            fd, self.path = tempfile.mkstemp(prefix=".upload-",
+                                             dir=upload_dir)
+            self.file = os.fdopen(fd, "w+b")
+        else:
+            self.path = None
+            self.file = StringIO()
+
+    def _append(self, data, max_size):
+        if self.too_large:
+            return
+        if max_size and self.size + len(data) > max_size:
+            self.too_large = True
+            self.discard()
+            self.file = StringIO()
+            return
+        if len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+        self._md5.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def _done(self):
+        self.md5 = self._md5.hexdigest()
+        self.file.flush()
+        self.file.seek(0)
+
+    def read(self):
+        """Returns the whole content, prefer `save` for big files."""
+        self.file.seek(0)
+        return self.file.read()
+
+    def save(self, path):
+        """Moves the upload to ``path``.
+
+        A rename when the file is in a temporary file in the same directory,
+        so ``path`` never holds a partial file.
+        """
+        if self.path is not None:
+            self.file.close()
+            os.chmod(self.path, default_file_mode())
+            os.rename(self.path, path)
+            self.path = None
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.read())
+        os.rename(tmp_path, path)
+
+    def discard(self):
+        """Closes the upload and removes its temporary file, if any."""
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+def _read_chunks(fp, length):
+    while length > 0:
+        chunk = fp.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+def parse_multipart(fp, length, boundary, arguments, files, upload_dir=None,
+                    max_file_size=None):
+    """Parses ``length`` bytes of a multipart/form-data body from ``fp``.
+
+    Fields are added to the ``arguments`` dict of lists, uploads to the
+    ``files`` dict as `UploadedFile`. A malformed body is logged and
+    whatever was parsed before is kept. ``max_file_size`` bounds the values
+    of plain fields too, bigger ones are left out.
+    """
+    delimiter = "\r\n--" + boundary
+    # the first delimiter does not follow a CRLF
+    buf = "\r\n"
+    chunks = _read_chunks(fp, length)
+    part = None
+    field = None
+    state = "preamble"
+
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            if state == "preamble" or state == "data":
+                pos = buf.find(delimiter)
+                if pos == -1:
+                    # keep what could be the start of a delimiter
+                    keep = len(delimiter) - 1
+                    if len(buf) > keep:
+                        if state == "data":
+                            _part_data(part, field, buf[:-keep],
+                                       max_file_size)
+                        buf = buf[-keep:]
+                    break
+                if state == "data":
+                    _part_data(part, field, buf[:pos], max_file_size)
+                    _part_done(part, field, arguments, files)
+                    part = field = None
+                buf = buf[pos + len(delimiter):]
+                state = "delimiter"
+            if state == "delimiter":
+                # "--" after the last delimiter, a line break otherwise
+                if len(buf) < 2:
+                    break
+                if buf.startswith("--"):
+                    return
+                state = "headers"
+            if state == "headers":
+                pos = buf.find("\r\n\r\n")
+                if pos == -1:
+                    if len(buf) > MAX_PART_HEADER_SIZE:
+                        app_log.warning("multipart part headers too long")
+                        return
+                    break
+                part, field = _part_start(buf[:pos], upload_dir)
+                if part is None and field is None:
+                    return
+                buf = buf[pos + 4:]
+                state = "data"
+    if state != "preamble":
+        app_log.warning("multipart body ended without final boundary")
+        if part is not None:
+            part.discard()
+
+
+def _part_start(head, upload_dir):
+    disposition, content_type = None, "application/octet-stream"
+    for line in head.split("\r\n"):
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        name = name.strip().lower()
+        if name == "content-disposition":
+            disposition = parse_header(value)
+        elif name == "content-type":
+            content_type = value.strip()
+    if disposition is None or disposition[0] != "form-data" or \
+            "name" not in disposition[1]:
+        app_log.warning("invalid multipart/form-data part")
+        return None, None
+    params = disposition[1]
+    if "filename" in params:
+        return UploadedFile(params["name"], params["filename"], content_type,
+                            upload_dir), None
+    # name, chunks of the value (None once too large), size
+    return None, [params["name"], [], 0]
+
+
+def _part_data(part, field, data, max_file_size):
+    if not data:
+        return
+    if part is not None:
+        part._append(data, max_file_size)
+    elif field[1] is not None:
+        field[2] += len(data)
+        if max_file_size and field[2] > max_file_size:
+            field[1] = None
+        else:
+            field[1].append(data)
+
+
+def _part_done(part, field, arguments, files):
+    if part is not None:
+        part._done()
+        if part.name in files:
+            files[part.name].discard()
+        files[part.name] = part
+    else:
+        name, chunks, size = field
+        if chunks is None:
+            app_log.warning("multipart field %s too large: %d bytes", name,
+                            size)
+            return
+        arguments.setdefault(name, []).append("".join(chunks))
+
+
+def parse_body(content_type, fp, length, arguments, files, upload_dir=None,
+               max_file_size=None):
+    """Parses a request body according to its Content-Type.
+
+    Form bodies are added to ``arguments`` and ``files``, see
+    `parse_multipart`. Returns the raw body for any other type, eg.
+    application/json, and "" for forms.
+    """
+    if length <= 0:
+        return ""
+    ctype, params = parse_header(content_type or "")
+    if ctype == "multipart/form-data":
+        boundary = params.get("boundary")
+        if not boundary:
+            app_log.warning("multipart/form-data without boundary")
+            return ""
+        parse_multipart(fp, length, boundary, arguments, files, upload_dir,
+                        max_file_size)
+        return ""
+    body = "".join(_read_chunks(fp, length))
+    if ctype == "application/x-www-form-urlencoded":
+        for name, values in parse_qs(body, keep_blank_values=True).items():
+            arguments.setdefault(name, []).extend(values)
+        return ""
+    return body
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Utilities for working with multiple processes."""
+
+import os
+import sys
+import time
+import errno
+import signal
+
+from typhoon.log import app_log
+
+# A worker that exits sooner than this after being forked is considered to be
+# crashing at startup, the master then waits before forking it again.
+MIN_WORKER_LIFETIME = 1.0
+
+
+def cpu_count():
+    """Returns the number of processors on this machine."""
+    try:
+        return os.sysconf("SC_NPROCESSORS_CONF")
+    except (AttributeError, ValueError):
+        pass
+    app_log.error("Could not detect number of processors; assuming 1")
+    return 1
+
+
+def run_prefork(num_processes, worker_func):
+    """Runs ``worker_func(task_id)`` in ``num_processes`` child processes.
+
+    The calling process becomes the master: whenever a worker exits, either
+    because it crashed or because it was recycled after serving its share of
+    requests, a new one is forked with the same task id. On SIGTERM or SIGINT
+    the master forwards SIGTERM to the workers, waits for them to finish
+    their current request and exits.
+
+    Everything set up before this call (handlers, settings, compiled
+    templates) is shared copy-on-write with the workers, while anything
+    bound to a connection (eg. the database) must be created in the worker.
+    """
+    if num_processes is None or num_processes <= 0:
+        num_processes = cpu_count()
+
+    children = {}
+    state = {"stopping": False}
+
+    def start_child(task_id):
+        pid = os.fork()
+        if pid == 0:
+            # child process
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            status = 0
+            try:
+                worker_func(task_id)
+            except Exception:
+                app_log.exception("worker %d failed", task_id)
+                status = 1
+            finally:
+                os._exit(status)
+        children[pid] = (task_id, time.time())
+
+    def stop(signum, frame):
+        state["stopping"] = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(num_processes):
+        start_child(i)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        task_id, started = children.pop(pid)
+        if state["stopping"]:
+            continue
+        if os.WIFSIGNALED(status):
+            app_log.warning("worker %d (pid %d) killed by signal %d, "
+                            "restarting", task_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            app_log.warning("worker %d (pid %d) exited with status %d, "
+                            "restarting", task_id, pid,
+                            os.WEXITSTATUS(status))
+        else:
+            app_log.info("worker %d (pid %d) recycled", task_id, pid)
+        if time.time() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+            if state["stopping"]:
+                continue
+        start_child(task_id)
+    sys.exit(0)
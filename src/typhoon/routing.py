@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compiled URL dispatch for `typhoon.web.Application`.
+
+`Router` gives the same result as trying every `URLSpec` regex in order,
+but the cost of a lookup does not grow with the number of routes:
+
+* patterns without any regex syntax are found with one dict lookup;
+* the other patterns are grouped by their first path segment when it is a
+  plain string (``/image/...`` goes to the "image" bucket) and the routes of
+  a bucket are joined into one alternation regex, so a request runs a
+  single ``match`` against the few routes that share its first segment.
+"""
+
+import re
+
+from typhoon.util import unquote_or_none
+
+_REGEX_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+
+# Python 2's re module supports at most 100 groups per pattern.
+_MAX_GROUPS = 99
+
+_NAMED_GROUP_RE = re.compile(r"(?<!\\)\(\?P<\w+>")
+# backreferences and global inline flags change meaning once combined
+_UNCOMBINABLE_RE = re.compile(r"\(\?P=|\\[1-9]|\(\?[iLmsux]+\)")
+
+
+def _strip_anchor(pattern):
+    """Removes the trailing '$' that `URLSpec` adds, unless it is escaped."""
+    if pattern.endswith("$"):
+        backslashes = len(pattern[:-1]) - len(pattern[:-1].rstrip("\\"))
+        if backslashes % 2 == 0:
+            return pattern[:-1]
+    return pattern
+
+
+def _scan_literal(pattern, start, stop_at_slash):
+    """Reads plain characters of ``pattern`` from ``start``.
+
+    Returns ``(text, end)``, where ``end`` is where reading stopped: at the
+    end of the pattern, or at a literal '/' if ``stop_at_slash``. Returns
+    None as soon as a regex feature is found.
+    """
+    chars = []
+    i = start
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                c = pattern[i + 1]
+                i += 1
+            else:
+                return None
+        elif c in _REGEX_SPECIAL:
+            return None
+        if c == "/" and stop_at_slash:
+            return "".join(chars), i
+        chars.append(c)
+        i += 1
+    return "".join(chars), i
+
+
+def literal_path(pattern):
+    """Returns the only path ``pattern`` matches, or None if it is a real
+    regex.
+    """
+    scanned = _scan_literal(_strip_anchor(pattern), 0, False)
+    return scanned[0] if scanned else None
+
+
+def first_segment(pattern):
+    """Returns the first path segment every match of ``pattern`` has, eg.
+    "image" for ``/image/([0-9a-f]{32})$``, or None if it can vary.
+    """
+    pattern = _strip_anchor(pattern)
+    if not pattern.startswith("/") or "|" in pattern:
+        return None
+    scanned = _scan_literal(pattern, 1, True)
+    if scanned is None:
+        return None
+    segment, end = scanned
+    # "/image/?" would also match "/imagex", make sure the slash is required
+    if end + 1 < len(pattern) and pattern[end + 1] in "?*{":
+        return None
+    return segment
+
+
+def path_segment(path):
+    if not path.startswith("/"):
+        return None
+    return path[1:].split("/", 1)[0]
+
+
+class _CombinedMatcher(object):
+
+    """Matches a run of `URLSpec` patterns with a single regex.
+
+    Every pattern is wrapped in a group of its own; the group that closed
+    last (``match.lastindex``) tells which one matched.
+    """
+
+    def __init__(self, specs):
+        parts = []
+        self._targets = {}
+        group = 0
+        for spec in specs:
+            group += 1
+            self._targets[group] = (spec, group)
+            parts.append("(" + _NAMED_GROUP_RE.sub("(", spec.regex.pattern) +
+                         ")")
+            group += spec.regex.groups
+        self.regex = re.compile("|".join(parts))
+
+    def match(self, path):
+        match = self.regex.match(path)
+        if match is None:
+            return None
+        spec, offset = self._targets[match.lastindex]
+        groups = match.groups()[offset:offset + spec.regex.groups]
+        if spec.regex.groupindex:
+            kwargs = dict(
+                (name, unquote_or_none(groups[index - 1]))
+                for name, index in spec.regex.groupindex.iteritems())
+            return spec, [], kwargs
+        return spec, [unquote_or_none(s) for s in groups], {}
+
+
+class _SingleMatcher(object):
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def match(self, path):
+        match = self.spec.regex.match(path)
+        if match is None:
+            return None
+        if self.spec.regex.groupindex:
+            kwargs = dict((str(k), unquote_or_none(v))
+                          for k, v in match.groupdict().iteritems())
+            return self.spec, [], kwargs
+        return self.spec, [unquote_or_none(s) for s in match.groups()], {}
+
+
+def _build_matchers(specs):
+    """Joins consecutive combinable specs, keeping their order."""
+    matchers = []
+    run = []
+    run_groups = 0
+    for spec in specs:
+        groups = spec.regex.groups + 1
+        if _UNCOMBINABLE_RE.search(spec.regex.pattern) or \
+                groups > _MAX_GROUPS:
+            if run:
+                matchers.append(_CombinedMatcher(run))
+                run, run_groups = [], 0
+            matchers.append(_SingleMatcher(spec))
+            continue
+        if run_groups + groups > _MAX_GROUPS:
+            matchers.append(_CombinedMatcher(run))
+            run, run_groups = [], 0
+        run.append(spec)
+        run_groups += groups
+    if run:
+        matchers.append(_CombinedMatcher(run))
+    return matchers
+
+
+class Router(object):
+
+    """Finds the first `URLSpec` of ``specs`` matching a path."""
+
+    def __init__(self, specs):
+        self._literals = {}
+        buckets = {}
+        wildcard = []
+        literal_specs = []
+        for index, spec in enumerate(specs):
+            path = literal_path(spec.regex.pattern)
+            if path is not None:
+                literal_specs.append((path, spec))
+                continue
+            segment = first_segment(spec.regex.pattern)
+            if segment is None:
+                wildcard.append((index, spec))
+            else:
+                buckets.setdefault(segment, []).append((index, spec))
+
+        # Each bucket also gets the wildcard routes, merged in table order.
+        self._buckets = {}
+        for segment, entries in buckets.iteritems():
+            entries = sorted(entries + wildcard)
+            self._buckets[segment] = _build_matchers(
+                [spec for _, spec in entries])
+        self._wildcard = _build_matchers([spec for _, spec in wildcard])
+
+        # An earlier regex route may shadow a literal one, so resolve every
+        # literal path with the full table once, now.
+        for path, _ in literal_specs:
+            for spec in specs:
+                if spec.regex.match(path):
+                    self._literals[path] = _SingleMatcher(spec).match(path)
+                    break
+
+    def find_handler(self, path):
+        """Returns ``(spec, path_args, path_kwargs)`` or None."""
+        if path in self._literals:
+            return self._literals[path]
+        matchers = self._buckets.get(path_segment(path), self._wildcard)
+        for matcher in matchers:
+            result = matcher.match(path)
+            if result is not None:
+                return result
+        return None
@@ -46,6 +46,17 @@ class Template(TemplateBlock):
         self.render_value_in_context(context)
         return context.render()
 
+    def stream(self, write, chunk_size=16384, **params):
+        """Renders the template, passing the output to ``write`` in pieces
+        of about ``chunk_size`` bytes as it is produced.
+        """
+        context_params = self._params.copy()
+        context_params.update(params)
+        buffer = StreamBuffer(write, chunk_size)
+        self.render_value_in_context(Context(context_params, self._meta,
+                                             buffer))
+        buffer.flush()
+
     def render_in_sub_context(self, context, meta):
         """Renders the template in sub context."""
         sub_params = self._params.copy()
@@ -244,6 +255,31 @@ class Context:
         return Context(sub_params, sub_meta, self.buffer)
 
 
+class StreamBuffer(object):
+
+    """A `Context` buffer that hands its content to ``write`` whenever it
+    holds ``chunk_size`` bytes.
+    """
+
+    def __init__(self, write, chunk_size):
+        self._write = write
+        self._chunk_size = chunk_size
+        self._pieces = []
+        self._size = 0
+
+    def append(self, value):
+        self._pieces.append(value)
+        self._size += len(value)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._pieces:
+            self._write("".join(self._pieces))
+            self._pieces = []
+            self._size = 0
+
+
 def _val_evaluate(expression):
     expression = compile(expression, "<string>", "eval")
     """use eval to get the result of the evaluated expression, for example
@@ -410,6 +446,10 @@ class BaseSource(object):
     def load(self, template_name):
         raise NotImplementedError
 
+    def list_templates(self):
+        """Returns the names of all templates this source can load."""
+        return []
+
 
 class MemorySource(BaseSource):
 
@@ -420,6 +460,9 @@ class MemorySource(BaseSource):
     def load(self, template_name):
         return self.templates.get(template_name, None)
 
+    def list_templates(self):
+        return list(self.templates)
+
     def __str__(self):
         return "__memory__"
 
@@ -436,6 +479,14 @@ class DirectorySource(BaseSource):
                 return template_file.read()
         return None
 
+    def list_templates(self):
+        names = []
+        for root, _, files in os.walk(self.dirname):
+            for filename in files:
+                names.append(os.path.relpath(os.path.join(root, filename),
+                                             self.dirname))
+        return names
+
     def __str__(self):
         return self.dirname
 
@@ -480,6 +531,15 @@ class Loader(object):
     def render(self, template_name, **params):
         return self.load(template_name).render(**params)
 
+    def preload(self):
+        """Compiles every template of every source into the cache.
+
+        Used before forking workers so they share the compiled templates.
+        """
+        for source in self._sources:
+            for template_name in source.list_templates():
+                self.load(template_name)
+
 
 # Public Interface #######################################################
 
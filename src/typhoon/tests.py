@@ -1,9 +1,46 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import zlib
+import json
+import timeit
+import shutil
+import socket
+import struct
+import hashlib
+import datetime
+import tempfile
+import mimetypes
+import httplib
 import unittest
+import threading
+import multiprocessing
+import multiprocessing.dummy
+from StringIO import StringIO
 
-from typhoon import template
+from typhoon import template, gen, web
+from typhoon.log import app_log
+from typhoon.ioloop import IOLoop
+from typhoon.concurrent import ThreadPoolExecutor
+from typhoon.web import (Application, RequestHandler, URLSpec,
+                         CompressionTransform, StaticFileHandler,
+                         HTTPError)
+from typhoon.cgiutil import HTTPHeaders, request_from_environ
+from typhoon.multipart import UploadedFile
+from typhoon.util import LRUCache
+from typhoon.routing import Router
+from typhoon.wsgi import WSGIAdapter
+from typhoon.httpserver import HTTPServer, bind_socket
+from typhoon.asyncserver import AsyncHTTPServer
+from typhoon import asyncserver, fastcgi
+import common.db
+import model.image
+from common import (variants, derivatives, jobqueue, emailfilter, storage,
+                    hashfile, packstore, avatarindex, avatartree)
+import handler.image as image_handler
 
 
 class TestRender(unittest.TestCase):
@@ -112,6 +149,15 @@ test_loader = template.Loader(
 )
 
 
+class TestStream(unittest.TestCase):
+
+    def testChunks(self):
+        chunks = []
+        template.compiler("{% for i in range(4) %}ab{% endfor %}").stream(
+            chunks.append, chunk_size=4)
+        self.assertEqual(chunks, ["abab", "abab"])
+
+
 class TestLoader(unittest.TestCase):
 
     def setUp(self):
@@ -132,5 +178,1704 @@ class TestLoader(unittest.TestCase):
                          "<body><div>hello</div></body>")
 
 
+class HelloHandler(RequestHandler):
+
+    def get(self, name):
+        self.write("hello " + name)
+
+    def post(self, name):
+        self.write({"name": name, "value": self.get_argument("value")})
+
+
+executor = ThreadPoolExecutor(2)
+
+
+class CoroutineHandler(RequestHandler):
+
+    @gen.coroutine
+    def get(self, name):
+        greeting = yield executor.submit(lambda: "hello " + name)
+        self.write(greeting)
+
+
+class CoroutineErrorHandler(RequestHandler):
+
+    @gen.coroutine
+    def get(self, when):
+        if when == "before":
+            raise HTTPError(404)
+        yield executor.submit(lambda: None)
+        raise HTTPError(404)
+
+
+class StreamHandler(RequestHandler):
+
+    def get(self):
+        self.write_iter(["a", "b", "c"])
+
+
+class ConditionalHandler(RequestHandler):
+
+    def get(self):
+        etag, last_modified = '"v1"', 1400000000
+        self.set_header("ETag", etag)
+        if self.should_return_304(etag, last_modified):
+            return self.set_status(304)
+        self.write("body")
+
+
+def make_environ(method, uri, body="", headers=None):
+    path, _, query = uri.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": StringIO(body),
+    }
+    for name, value in (headers or {}).iteritems():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+    return environ
+
+
+def quiet_app_log(test_case):
+    """Keeps what the expected failures of ``test_case`` log out of the test
+    output, until it ends.
+    """
+    app_log.disabled = True
+    test_case.addCleanup(setattr, app_log, "disabled", False)
+
+
+def wsgi_fetch(wsgi_app, method, uri, body="", headers=None):
+    response = {}
+    written = []
+
+    def start_response(status, headers):
+        response["status"] = status
+        response["headers"] = dict(headers)
+        return written.append
+    chunks = wsgi_app(make_environ(method, uri, body, headers),
+                      start_response)
+    return (response["status"], response["headers"],
+            "".join(written) + "".join(chunks))
+
+
+class TestWSGI(unittest.TestCase):
+
+    def setUp(self):
+        self.wsgi_app = WSGIAdapter(Application([
+            (r"/hello/(\w+)", HelloHandler),
+            (r"/coroutine/(\w+)", CoroutineHandler),
+            (r"/coroutine-error/(\w+)", CoroutineErrorHandler),
+            (r"/conditional", ConditionalHandler),
+            (r"/stream", StreamHandler),
+        ]))
+
+    def fetch(self, method, uri, body="", headers=None):
+        return wsgi_fetch(self.wsgi_app, method, uri, body, headers)
+
+    def testGet(self):
+        status, headers, body = self.fetch("GET", "/hello/world")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, "hello world")
+
+    def testHead(self):
+        status, headers, body = self.fetch("HEAD", "/hello/world")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Length"], "11")
+        self.assertEqual(body, "")
+
+    def testCoroutine(self):
+        status, headers, body = self.fetch("GET", "/coroutine/world")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, "hello world")
+
+    def testCoroutineError(self):
+        # raised before and after the first yield, answered once
+        for when in ("before", "after"):
+            status, headers, body = self.fetch("GET",
+                                               "/coroutine-error/" + when)
+            self.assertEqual(status, "404 Not Found")
+
+    def testManyRequests(self):
+        for name in ("foo", "bar"):
+            self.assertEqual(self.fetch("GET", "/hello/" + name)[2],
+                             "hello " + name)
+
+    def testPost(self):
+        status, headers, body = self.fetch("POST", "/hello/foo", "value=bar")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(headers["Content-Type"],
+                         "application/json; charset=UTF-8")
+        self.assertEqual(json.loads(body), {"name": "foo", "value": "bar"})
+
+    def testNotFound(self):
+        self.assertEqual(self.fetch("GET", "/nowhere")[0], "404 Not Found")
+
+    def testStream(self):
+        written = []
+        environ = make_environ("GET", "/stream")
+
+        def start_response(status, headers):
+            self.assertNotIn("Content-Length", dict(headers))
+            return written.append
+        chunks = self.wsgi_app(environ, start_response)
+        self.assertEqual(written + list(chunks), ["a", "b", "c"])
+
+    def testIfNoneMatch(self):
+        for value, status in (('"v1"', "304"), ('W/"v0", "v1"', "304"),
+                              ("*", "304"), ('"v0"', "200")):
+            self.assertEqual(self.fetch("GET", "/conditional", headers={
+                "If-None-Match": value})[0][:3], status)
+
+    def testIfModifiedSince(self):
+        for value, status in (("Tue, 13 May 2014 16:53:20 GMT", "304"),
+                              ("Tuesday, 13-May-14 16:53:20 GMT", "304"),
+                              ("Tue, 13 May 2014 16:53:19 GMT", "200"),
+                              ("garbage", "200")):
+            self.assertEqual(self.fetch("GET", "/conditional", headers={
+                "If-Modified-Since": value})[0][:3], status)
+        # If-None-Match wins when both are sent
+        self.assertEqual(self.fetch("GET", "/conditional", headers={
+            "If-None-Match": '"v0"',
+            "If-Modified-Since": "Tue, 13 May 2014 16:53:20 GMT"})[0][:3],
+            "200")
+
+
+class TextHandler(RequestHandler):
+
+    def get(self, size):
+        self.write("x" * int(size))
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.wsgi_app = WSGIAdapter(Application([
+            (r"/text/(\d+)", TextHandler),
+            (r"/stream", StreamHandler),
+        ], compress_response=True))
+
+    def fetch(self, uri, accept_encoding="gzip, deflate"):
+        return wsgi_fetch(self.wsgi_app, "GET", uri,
+                          headers={"Accept-Encoding": accept_encoding})
+
+    def testGzip(self):
+        status, headers, body = self.fetch("/text/2000")
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         "x" * 2000)
+
+    def testNotCompressed(self):
+        for uri, accept_encoding in (("/text/10", "gzip"),
+                                     ("/text/2000", "identity"),
+                                     ("/text/2000", "gzip;q=0")):
+            status, headers, body = self.fetch(uri, accept_encoding)
+            self.assertNotIn("Content-Encoding", headers)
+            self.assertEqual(headers["Vary"], "Accept-Encoding")
+
+    def testCache(self):
+        CompressionTransform._cache.clear()
+        first = self.fetch("/text/3000")[2]
+        self.assertEqual(self.fetch("/text/3000")[2], first)
+        self.assertEqual(len(CompressionTransform._cache), 1)
+
+    def testStream(self):
+        written = []
+
+        def start_response(status, headers):
+            self.assertEqual(dict(headers)["Content-Encoding"], "gzip")
+            return written.append
+        environ = make_environ("GET", "/stream",
+                               headers={"Accept-Encoding": "gzip"})
+        chunks = self.wsgi_app(environ, start_response)
+        self.assertEqual(zlib.decompress("".join(written + list(chunks)),
+                                         16 + zlib.MAX_WBITS), "abc")
+
+
+class StaticURLHandler(RequestHandler):
+
+    def get(self):
+        self.write(self.static_url("app.js"))
+
+
+class TestStaticFile(unittest.TestCase):
+
+    def setUp(self):
+        self.static_path = tempfile.mkdtemp()
+        with open(os.path.join(self.static_path, "app.js"), "wb") as f:
+            f.write("0123456789")
+        self.wsgi_app = WSGIAdapter(Application([
+            (r"/url", StaticURLHandler),
+        ], static_path=self.static_path))
+
+    def tearDown(self):
+        shutil.rmtree(self.static_path)
+
+    def fetch(self, uri, **headers):
+        return wsgi_fetch(self.wsgi_app, "GET", uri, headers=headers)
+
+    def testGet(self):
+        status, headers, body = self.fetch("/static/app.js")
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, "0123456789")
+        self.assertEqual(headers["Etag"],
+                         '"' + hashlib.md5(body).hexdigest() + '"')
+        self.assertEqual(headers["Content-Type"],
+                         mimetypes.guess_type("app.js")[0])
+        self.assertNotIn("Cache-Control", headers)
+        self.assertEqual(self.fetch("/static/app.js", If_None_Match=headers[
+            "Etag"])[0], "304 Not Modified")
+
+    def testRange(self):
+        for value, status, content_range, body in (
+                ("bytes=2-4", "206", "bytes 2-4/10", "234"),
+                ("bytes=7-", "206", "bytes 7-9/10", "789"),
+                ("bytes=-2", "206", "bytes 8-9/10", "89"),
+                ("bytes=20-", "416", "bytes */10", ""),
+                ("bytes=0-1,4-5", "200", None, "0123456789")):
+            response = self.fetch("/static/app.js", Range=value)
+            self.assertEqual(response[0][:3], status)
+            self.assertEqual(response[1].get("Content-Range"), content_range)
+            self.assertEqual(response[2], body)
+
+    def testNotFound(self):
+        self.assertEqual(self.fetch("/static/missing.js")[0][:3], "404")
+        self.assertEqual(self.fetch("/static/../etc/passwd")[0][:3], "403")
+
+    def testStaticURL(self):
+        url = self.fetch("/url")[2]
+        st = os.stat(os.path.join(self.static_path, "app.js"))
+        self.assertEqual(url, "/static/app.js?v=%x%x" % (int(st.st_mtime),
+                                                          st.st_size))
+        headers = self.fetch(url)[1]
+        self.assertEqual(headers["Cache-Control"], "public, max-age=31536000")
+
+    def testStaticVersions(self):
+        self.assertEqual(web.write_static_versions(self.static_path), 1)
+        self.assertEqual(self.fetch("/url")[2], "/static/app.js?v=" +
+                         hashlib.md5("0123456789").hexdigest()[:8])
+        # changed since the versions were written
+        path = os.path.join(self.static_path, "app.js")
+        with open(path, "wb") as f:
+            f.write("changed")
+        st = os.stat(path)
+        self.assertEqual(self.fetch("/url")[2], "/static/app.js?v=%x%x" % (
+            int(st.st_mtime), st.st_size))
+
+    def testCompressed(self):
+        content = "var x = 1;\n" * 1000
+        with open(os.path.join(self.static_path, "big.js"), "wb") as f:
+            f.write(content)
+        wsgi_app = WSGIAdapter(Application(
+            [], static_path=self.static_path, compress_response=True))
+        status, headers, body = wsgi_fetch(
+            wsgi_app, "GET", "/static/big.js",
+            headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), content)
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+        # compressed once
+        entry = StaticFileHandler.get_entry(
+            os.path.join(self.static_path, "big.js"))
+        self.assertEqual(entry.compressed, {"gzip": body})
+        head_headers = wsgi_fetch(wsgi_app, "HEAD", "/static/big.js",
+                                  headers={"Accept-Encoding": "gzip"})[1]
+        self.assertEqual(head_headers["Content-Length"], str(len(body)))
+        self.assertEqual(head_headers["Etag"], headers["Etag"])
+        self.assertNotEqual(headers["Etag"], entry.etag)
+        # ranges are of the file itself
+        status, headers, body = wsgi_fetch(
+            wsgi_app, "GET", "/static/big.js",
+            headers={"Accept-Encoding": "gzip", "Range": "bytes=0-2"})
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(body, "var")
+
+
+class UploadTestHandler(RequestHandler):
+
+    def post(self):
+        upload_file = self.request.upload_files.get("upload")
+        result = {"title": self.get_argument("title", None),
+                  "body": self.request.body}
+        if upload_file is not None:
+            result.update(filename=upload_file.filename, md5=upload_file.md5,
+                          head=upload_file.head[1:4],
+                          too_large=upload_file.too_large,
+                          in_upload_dir=upload_file.path is not None)
+            if not upload_file.too_large:
+                upload_file.save(os.path.join(self.request.upload_dir,
+                                              "saved"))
+        self.write(result)
+
+
+def encode_multipart(boundary, fields, files):
+    lines = []
+    for name, value in fields:
+        lines.extend(["--" + boundary,
+                      'Content-Disposition: form-data; name="%s"' % name,
+                      "", value])
+    for name, filename, content in files:
+        lines.extend(["--" + boundary,
+                      'Content-Disposition: form-data; name="%s"; '
+                      'filename="%s"' % (name, filename),
+                      "Content-Type: application/octet-stream", "",
+                      content])
+    lines.extend(["--" + boundary + "--", ""])
+    return "\r\n".join(lines)
+
+
+class TestMultipart(unittest.TestCase):
+
+    def setUp(self):
+        self.upload_path = tempfile.mkdtemp()
+        self.wsgi_app = WSGIAdapter(Application([
+            (r"/upload", UploadTestHandler),
+        ], upload_path=self.upload_path, max_upload_size=200 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.upload_path)
+
+    def post(self, body, content_type):
+        environ = make_environ("POST", "/upload", body)
+        environ["CONTENT_TYPE"] = content_type
+        result = {}
+
+        def start_response(status, headers):
+            result["status"] = status
+        body = "".join(self.wsgi_app(environ, start_response))
+        self.assertEqual(result["status"], "200 OK")
+        return json.loads(body)
+
+    def testUpload(self):
+        # bigger than a read chunk, with a boundary like sequence inside
+        content = "\x89PNG\r\n--XY" + os.urandom(150 * 1024)
+        body = encode_multipart("XYZ", [("title", "avatar")],
+                                [("upload", "a.png", content)])
+        result = self.post(body, "multipart/form-data; boundary=XYZ")
+        self.assertEqual(result["title"], "avatar")
+        self.assertEqual(result["filename"], "a.png")
+        self.assertEqual(result["md5"], hashlib.md5(content).hexdigest())
+        self.assertEqual(result["head"], "PNG")
+        self.assertTrue(result["in_upload_dir"])
+        with open(os.path.join(self.upload_path, "saved"), "rb") as f:
+            self.assertEqual(f.read(), content)
+        # nothing but the saved file is left in the upload directory
+        self.assertEqual(os.listdir(self.upload_path), ["saved"])
+        # readable by the front server like a file made with open()
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(
+            os.stat(os.path.join(self.upload_path, "saved")).st_mode & 0777,
+            0666 & ~umask)
+
+    def testTooLarge(self):
+        body = encode_multipart("XYZ", [], [("upload", "a.png",
+                                             "x" * 300 * 1024)])
+        result = self.post(body, 'multipart/form-data; boundary="XYZ"')
+        self.assertTrue(result["too_large"])
+        self.assertEqual(os.listdir(self.upload_path), [])
+
+    def testFieldTooLarge(self):
+        quiet_app_log(self)
+        body = encode_multipart("XYZ", [("title", "x" * 300 * 1024)], [])
+        result = self.post(body, "multipart/form-data; boundary=XYZ")
+        self.assertEqual(result["title"], None)
+
+    def testJSON(self):
+        result = self.post('{"title": "avatar"}', "application/json")
+        self.assertEqual(json.loads(result["body"]), {"title": "avatar"})
+        self.assertEqual(result["title"], None)
+
+
+class UnreadableBody(object):
+
+    def read(self, size=-1):
+        raise AssertionError("request body read")
+
+
+class TestCGIRequest(unittest.TestCase):
+
+    def testLazyArguments(self):
+        environ = make_environ("POST", "/hello/world?a=1", "value=2")
+        request = request_from_environ(environ, None,
+                                       body_file=UnreadableBody())
+        self.assertEqual(request.path, "/hello/world")
+        request = request_from_environ(environ, None,
+                                       body_file=StringIO("value=2"))
+        self.assertEqual(request.arguments, {"a": ["1"], "value": ["2"]})
+        self.assertEqual(request.body, "")
+
+    def testBodyNotRead(self):
+        wsgi_app = WSGIAdapter(Application([(r"/hello/(\w+)", HelloHandler)]))
+        environ = make_environ("GET", "/hello/world", "value=2")
+        environ["wsgi.input"] = UnreadableBody()
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = status
+        self.assertEqual("".join(wsgi_app(environ, start_response)),
+                         "hello world")
+        self.assertEqual(response["status"], "200 OK")
+
+
+class TestHTTPHeaders(unittest.TestCase):
+
+    def testCaseInsensitive(self):
+        headers = HTTPHeaders({"content-type": "text/plain"})
+        headers.add("X-Forwarded-For", "1.1.1.1")
+        headers.add("x-forwarded-for", "2.2.2.2")
+        self.assertEqual(headers["Content-Type"], "text/plain")
+        self.assertIn("CONTENT-TYPE", headers)
+        self.assertEqual(headers.get("X-Forwarded-For"), "1.1.1.1,2.2.2.2")
+        self.assertEqual(headers.get_list("X-FORWARDED-FOR"),
+                         ["1.1.1.1", "2.2.2.2"])
+        self.assertEqual(sorted(HTTPHeaders(headers).get_all()),
+                         sorted(headers.get_all()))
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def testEviction(self):
+        cache = LRUCache(10)
+        cache.set("a", "A", 4)
+        cache.set("b", "B", 4)
+        self.assertEqual(cache.get("a"), "A")
+        cache.set("c", "C", 4)
+        # "b" is the least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "C")
+        cache.set("d", "D", 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2,
+                                         "evictions": 1, "entries": 2,
+                                         "bytes": 8})
+
+    def testTTL(self):
+        cache = LRUCache(10, ttl=60)
+        cache.set(("a", 1), "A", 1)
+        cache.set(("b", 1), "B", 1)
+        cache._entries[("a", 1)] = ("A", 1, 0)
+        self.assertIsNone(cache.get(("a", 1)))
+        cache.delete_matching(lambda key: key[0] == "b")
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+
+class TestHTTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(Application([
+            (r"/hello/(\w+)", HelloHandler),
+            (r"/stream", StreamHandler),
+        ]))
+
+    def fetch(self, raw_request):
+        client, server = socket.socketpair()
+        client.sendall(raw_request)
+        self.server.handle_connection(server, ("127.0.0.1", 0))
+        server.close()
+        response = client.makefile("rb").read()
+        client.close()
+        return response
+
+    def testGet(self):
+        response = self.fetch("GET /hello/world HTTP/1.1\r\n"
+                              "Host: localhost\r\n\r\n")
+        head, _, body = response.partition("\r\n\r\n")
+        self.assertTrue(head.startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertIn("Content-Length: 11", head)
+        self.assertIn("Connection: close", head)
+        self.assertEqual(body, "hello world")
+
+    def testPost(self):
+        response = self.fetch(
+            "POST /hello/foo HTTP/1.1\r\n"
+            "Content-Type: application/x-www-form-urlencoded\r\n"
+            "Content-Length: 9\r\n\r\nvalue=bar")
+        body = response.partition("\r\n\r\n")[2]
+        self.assertEqual(json.loads(body), {"name": "foo", "value": "bar"})
+
+    def testStream(self):
+        response = self.fetch("GET /stream HTTP/1.1\r\n\r\n")
+        head, _, body = response.partition("\r\n\r\n")
+        self.assertNotIn("Content-Length", head)
+        self.assertEqual(body, "abc")
+
+    def testBadRequest(self):
+        response = self.fetch("NOT HTTP\r\n\r\n")
+        self.assertTrue(response.startswith("HTTP/1.1 400 Bad Request"))
+
+
+class TestGen(unittest.TestCase):
+
+    def testReturn(self):
+        @gen.coroutine
+        def add(a, b):
+            a = yield executor.submit(lambda: a)
+            raise gen.Return(a + b)
+        self.assertEqual(IOLoop.instance().run_sync(lambda: add(1, 2)), 3)
+
+    def testMulti(self):
+        @gen.coroutine
+        def double_all(values):
+            results = yield [executor.submit(lambda v=v: v * 2)
+                             for v in values]
+            raise gen.Return(results)
+        self.assertEqual(IOLoop.instance().run_sync(
+            lambda: double_all([1, 2, 3])), [2, 4, 6])
+
+    def testException(self):
+        @gen.coroutine
+        def fail():
+            yield executor.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError,
+                          IOLoop.instance().run_sync, fail)
+
+
+def run_server(server_class, client):
+    """Serves the test application with ``server_class`` until ``client``,
+    which runs in another thread and gets the port, returns.
+    """
+    sock = bind_socket(0, "127.0.0.1")
+    port = sock.getsockname()[1]
+    server = server_class(Application([
+        (r"/hello/(\w+)", HelloHandler),
+        (r"/coroutine/(\w+)", CoroutineHandler),
+        (r"/stream", StreamHandler),
+    ]))
+    server.io_loop = IOLoop.instance()
+
+    def run_client():
+        try:
+            client(port)
+        finally:
+            server.io_loop.add_callback(server.stop)
+
+    thread = threading.Thread(target=run_client)
+    thread.start()
+    server.serve_forever(sock)
+    thread.join()
+    sock.close()
+    return server
+
+
+class TestAsyncHTTPServer(unittest.TestCase):
+
+    def testKeepAlive(self):
+        responses = []
+
+        def client(port):
+            conn = httplib.HTTPConnection("127.0.0.1", port, timeout=5)
+            for uri in ("/hello/foo", "/coroutine/bar", "/nowhere"):
+                conn.request("GET", uri)
+                resp = conn.getresponse()
+                responses.append((resp.status, resp.read()))
+            conn.close()
+
+        server = run_server(AsyncHTTPServer, client)
+        self.assertEqual(responses[:2], [(200, "hello foo"),
+                                         (200, "hello bar")])
+        self.assertEqual(responses[2][0], 404)
+        self.assertEqual(server.handled, 3)
+
+    def testChunked(self):
+        responses = []
+
+        def client(port):
+            conn = httplib.HTTPConnection("127.0.0.1", port, timeout=5)
+            for uri in ("/stream", "/hello/foo"):
+                conn.request("GET", uri)
+                resp = conn.getresponse()
+                responses.append((resp.getheader("Transfer-Encoding"),
+                                  resp.read()))
+            conn.close()
+
+        run_server(AsyncHTTPServer, client)
+        self.assertEqual(responses, [("chunked", "abc"), (None, "hello foo")])
+
+    def testLargeBody(self):
+        value = "x" * (3 * 1024 * 1024)
+        responses = []
+
+        def client(port):
+            conn = httplib.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("POST", "/hello/foo", "value=" + value, {
+                "Content-Type": "application/x-www-form-urlencoded"})
+            responses.append(json.loads(conn.getresponse().read()))
+            conn.close()
+
+        run_server(AsyncHTTPServer, client)
+        self.assertEqual(responses, [{"name": "foo", "value": value}])
+
+    def testWriteBackpressure(self):
+        server = AsyncHTTPServer(None)
+        server.io_loop = IOLoop.instance()
+        client, sock = socket.socketpair()
+        connection = asyncserver.AsyncHTTPConnection(server, sock,
+                                                     ("127.0.0.1", 0))
+        try:
+            connection.send("x" * (asyncserver.WRITE_BUFFER_HIGH * 2))
+            # the client reads nothing, its next requests wait
+            self.assertTrue(connection._write_blocked)
+            client.setblocking(False)
+            while connection._write_blocked:
+                try:
+                    client.recv(65536)
+                except socket.error:
+                    pass
+                connection._on_writable()
+            self.assertLess(connection._write_size,
+                            asyncserver.WRITE_BUFFER_LOW)
+        finally:
+            connection.close()
+            client.close()
+
+
+def read_fastcgi_records(sock_file):
+    while True:
+        header = sock_file.read(fastcgi.FCGI_HEADER.size)
+        if not header:
+            return
+        _, record_type, request_id, length, padding = \
+            fastcgi.FCGI_HEADER.unpack(header)
+        content = sock_file.read(length + padding)[:length]
+        yield record_type, request_id, content
+        if record_type == fastcgi.FCGI_END_REQUEST:
+            return
+
+
+class TestFastCGI(unittest.TestCase):
+
+    def fastcgi_request(self, request_id, uri, keep_conn):
+        path, _, query = uri.partition("?")
+        params = fastcgi.encode_pairs([
+            ("REQUEST_METHOD", "GET"), ("REQUEST_URI", uri),
+            ("QUERY_STRING", query), ("SERVER_PROTOCOL", "HTTP/1.1"),
+            ("REMOTE_ADDR", "127.0.0.1"),
+        ])
+        return (fastcgi.encode_record(
+            fastcgi.FCGI_BEGIN_REQUEST, request_id,
+            fastcgi.FCGI_BEGIN_REQUEST_BODY.pack(
+                fastcgi.FCGI_RESPONDER,
+                fastcgi.FCGI_KEEP_CONN if keep_conn else 0)) +
+            fastcgi.encode_stream(fastcgi.FCGI_PARAMS, request_id, params) +
+            fastcgi.encode_record(fastcgi.FCGI_PARAMS, request_id) +
+            fastcgi.encode_record(fastcgi.FCGI_STDIN, request_id))
+
+    def testPersistentConnection(self):
+        responses = []
+
+        def client(port):
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock_file = sock.makefile("rb")
+            for request_id, name in ((1, "foo"), (2, "bar")):
+                sock.sendall(self.fastcgi_request(
+                    request_id, "/hello/" + name, keep_conn=True))
+                stdout = [content for record_type, _, content
+                          in read_fastcgi_records(sock_file)
+                          if record_type == fastcgi.FCGI_STDOUT]
+                responses.append("".join(stdout))
+            sock.close()
+
+        run_server(fastcgi.FastCGIServer, client)
+        self.assertEqual(len(responses), 2)
+        self.assertTrue(responses[0].startswith("Status: 200 OK\r\n"))
+        self.assertTrue(responses[0].endswith("\r\n\r\nhello foo"))
+        self.assertTrue(responses[1].endswith("\r\n\r\nhello bar"))
+
+    def testPairs(self):
+        pairs = [("SHORT", "x"), ("LONG", "y" * 300)]
+        self.assertEqual(
+            fastcgi.decode_pairs(fastcgi.encode_pairs(pairs)), pairs)
+
+
+class TestSCGI(unittest.TestCase):
+
+    def testRequest(self):
+        responses = []
+
+        def client(port):
+            headers = "\x00".join([
+                "CONTENT_LENGTH", "0", "SCGI", "1", "REQUEST_METHOD", "GET",
+                "REQUEST_URI", "/coroutine/scgi", "REMOTE_ADDR", "127.0.0.1",
+            ]) + "\x00"
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall("%d:%s," % (len(headers), headers))
+            responses.append(sock.makefile("rb").read())
+            sock.close()
+
+        run_server(fastcgi.SCGIServer, client)
+        self.assertTrue(responses[0].startswith("Status: 200 OK\r\n"))
+        self.assertTrue(responses[0].endswith("\r\n\r\nhello scgi"))
+
+
+def linear_find_handler(specs, path):
+    """What Application.run did before `Router`: try every spec in order."""
+    for spec in specs:
+        match = spec.regex.match(path)
+        if match:
+            return spec, list(match.groups())
+    return None
+
+
+class TestRouter(unittest.TestCase):
+
+    def testSameAsLinearScan(self):
+        specs = [URLSpec(pattern, RequestHandler) for pattern in [
+            r"/",
+            r"/user/login",
+            r"/image/([a-z]+)",
+            r"/image/upload",
+            r"/image/([0-9a-fA-F]{32})",
+            r"/static/(.*)",
+            r"/st(at)ic/special",
+            r"/a\.b",
+            r"/opt/?",
+            r"/(\d+)/(\d+)",
+        ]]
+        router = Router(specs)
+        for path in ["/", "/user/login", "/user/logout", "/image/upload",
+                     "/image/abc", "/image/" + "a" * 32, "/static/css/x.css",
+                     "/static/special", "/a.b", "/aXb", "/opt", "/opt/",
+                     "/optx", "/1/2", "/1/x", "", "relative"]:
+            expected = linear_find_handler(specs, path)
+            found = router.find_handler(path)
+            if expected is None:
+                self.assertIsNone(found, path)
+            else:
+                self.assertIs(found[0], expected[0], path)
+                self.assertEqual(found[1], expected[1], path)
+
+    def testNamedGroups(self):
+        specs = [
+            URLSpec(r"/image/(?P<email_md5>[0-9a-f]{32})", RequestHandler),
+            URLSpec(r"/user/(?P<uid>\d+)/image/(?P<imgid>\d+)",
+                    RequestHandler),
+        ]
+        router = Router(specs)
+        self.assertEqual(router.find_handler("/image/" + "a" * 32)[1:],
+                         ([], {"email_md5": "a" * 32}))
+        self.assertEqual(router.find_handler("/user/3/image/7")[1:],
+                         ([], {"uid": "3", "imgid": "7"}))
+
+    def testManyGroups(self):
+        specs = [URLSpec(r"/s%d/(\w+)/(\w+)" % i, RequestHandler)
+                 for i in range(100)]
+        specs.append(URLSpec(r"/(\w+)/(.+)", RequestHandler))
+        router = Router(specs)
+        self.assertIs(router.find_handler("/s99/a/b")[0], specs[99])
+        self.assertEqual(router.find_handler("/s99/a/b/c")[:2],
+                         (specs[-1], ["s99", "a/b/c"]))
+        self.assertIs(router.find_handler("/other/a")[0], specs[-1])
+
+
+class TestEmailFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "avatars.bloom")
+        self.md5s = [hashlib.md5(str(i)).hexdigest() for i in range(1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testNoFilter(self):
+        email_filter = emailfilter.EmailFilter(self.path)
+        self.assertTrue(email_filter.might_contain(self.md5s[0]))
+        # not built yet
+        email_filter.add(self.md5s[0])
+        self.assertFalse(os.path.exists(self.path))
+
+    def testBuild(self):
+        self.assertEqual(emailfilter.EmailFilter.build(self.path,
+                                                       self.md5s[:500]), 500)
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+        email_filter = emailfilter.EmailFilter(self.path)
+        for md5 in self.md5s[:500]:
+            self.assertTrue(email_filter.might_contain(md5))
+        # about 1% false positives
+        self.assertLess(sum(email_filter.might_contain(md5)
+                            for md5 in self.md5s[500:]), 25)
+        self.assertFalse(email_filter.might_contain("not a md5"))
+
+    def testAdd(self):
+        emailfilter.EmailFilter.build(self.path, [])
+        reader = emailfilter.EmailFilter(self.path)
+        self.assertFalse(reader.might_contain(self.md5s[0]))
+        emailfilter.EmailFilter(self.path).add(self.md5s[0])
+        # seen through the shared mapping
+        self.assertTrue(reader.might_contain(self.md5s[0]))
+
+    def testRebuilt(self):
+        emailfilter.EmailFilter.build(self.path, [])
+        reader = emailfilter.EmailFilter(self.path)
+        self.assertFalse(reader.might_contain(self.md5s[0]))
+        emailfilter.EmailFilter.build(self.path, self.md5s[:1])
+        self.assertTrue(reader.might_contain(self.md5s[0]))
+        # a writer opened before the rebuild adds to the new filter
+        reader.add(self.md5s[1])
+        self.assertTrue(emailfilter.EmailFilter(self.path).might_contain(
+            self.md5s[1]))
+
+
+def make_upload(upload_dir, data):
+    upload_file = UploadedFile("image", "a.png", "image/png", upload_dir)
+    upload_file._append(data, None)
+    upload_file._done()
+    return upload_file
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testContentSave(self):
+        content = storage.ContentAddressedStorage(self.root)
+        md5 = hashlib.md5("image").hexdigest()
+        name = content.name_for("user", md5, "png")
+        self.assertEqual(name, os.path.join(md5[:2], md5[2:4], md5 + ".png"))
+        content.save(make_upload(self.root, "image"), name)
+        inode = os.stat(content.path(name)).st_ino
+        # the same content uploaded again is not stored twice
+        upload_file = make_upload(self.root, "image")
+        content.save(upload_file, name)
+        self.assertEqual(upload_file.path, None)
+        self.assertEqual(os.stat(content.path(name)).st_ino, inode)
+        self.assertEqual(content.read(name), "image")
+        self.assertEqual(sorted(os.listdir(self.root)), [md5[:2]])
+
+    def testLink(self):
+        content = storage.ContentAddressedStorage(self.root)
+        with open(os.path.join(self.root, "old.png"), "wb") as f:
+            f.write("image")
+        md5 = hashlib.md5("image").hexdigest()
+        name = content.migrated_name("old.png", md5)
+        self.assertTrue(content.link("old.png", name))
+        # a hard link, no copy
+        self.assertEqual(os.stat(content.path(name)).st_ino,
+                         os.stat(content.path("old.png")).st_ino)
+        self.assertFalse(content.link("old.png", name))
+
+    def testPacked(self):
+        packed = storage.PackedStorage(self.root)
+        md5 = hashlib.md5("image").hexdigest()
+        name = packed.name_for("user", md5, "png")
+        self.assertEqual(name, ".pack/" + md5 + ".png")
+        packed.save(make_upload(self.root, "image"), name)
+        self.assertEqual(packed.read(name), "image")
+        self.assertEqual(packed.size(name), 5)
+        self.assertEqual(packed.path(name), None)
+        # unpacked by a migration to the "content" layout
+        content = storage.ContentAddressedStorage(self.root)
+        self.assertTrue(content.link(name, content.migrated_name(name, md5)))
+        self.assertEqual(content.read(content.migrated_name(name, md5)),
+                         "image")
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(content.path(content.migrated_name(
+            name, md5))).st_mode & 0777, 0666 & ~umask)
+        self.assertRaises(IOError, packed.read, ".pack/" + "0" * 32 + ".png")
+
+
+class FakeImageDAO(object):
+
+    """The yagra_image rows used by `common.storage.migrate`."""
+
+    def __init__(self, images):
+        self.images = dict((image.imgid, image) for image in images)
+        self.lock = threading.Lock()
+
+    def get_image_ids(self, after=0, limit=1000):
+        return sorted(imgid for imgid in self.images if imgid > after)[:limit]
+
+    def get_image_by_id(self, imgid):
+        return self.images.get(imgid)
+
+    def set_image_size(self, imgid, size, email_md5=None):
+        self.images[imgid].size = size
+
+    def set_image_filename(self, imgid, filename, email_md5=None):
+        with self.lock:
+            self.images[imgid].filename = filename
+
+    def count_filename_references(self, filename):
+        with self.lock:
+            return sum(image.filename == filename
+                       for image in self.images.values())
+
+
+class TestStorageMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = {"upload_path": self.root, "db": {},
+                         "image_storage": "content", "avatar_index": False}
+        self.dao = None
+        self._saved = (model.image.ImageDAO, common.db.Connection,
+                       multiprocessing.Pool, storage._storage,
+                       storage._image_dao)
+        model.image.ImageDAO = lambda *args, **kwargs: self.dao
+        common.db.Connection = lambda **kwargs: None
+        # the pool threads share the fake DAO
+        multiprocessing.Pool = multiprocessing.dummy.Pool
+
+    def tearDown(self):
+        (model.image.ImageDAO, common.db.Connection, multiprocessing.Pool,
+         storage._storage, storage._image_dao) = self._saved
+        shutil.rmtree(self.root)
+
+    def add_images(self, contents):
+        images = []
+        for imgid, (filename, data) in enumerate(contents, 1):
+            path = os.path.join(self.root, filename)
+            if data is not None and not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(data)
+            images.append(model.image.ImageModel(
+                imgid=imgid, filename=filename, email_md5=None,
+                md5=hashlib.md5(data or "").hexdigest(), size=None))
+        self.dao = FakeImageDAO(images)
+        return images
+
+    def content_name(self, data):
+        md5 = hashlib.md5(data).hexdigest()
+        return os.path.join(md5[:2], md5[2:4], md5 + ".png")
+
+    def testFanout(self):
+        self.assertEqual(storage.FileStorage(self.root)._fanout("abcd.png"),
+                         "abcd.png")
+        self.assertEqual(storage.FileStorage(self.root, 2)._fanout(
+            "abcdef.png"), "ab/cd/abcdef.png")
+        self.assertEqual(storage.ContentAddressedStorage(self.root)._fanout(
+            "abcdef.png"), "ab/cd/abcdef.png")
+        self.assertEqual(storage.ContentAddressedStorage(
+            self.root, 0)._fanout("abcdef.png"), "abcdef.png")
+
+    def testMigratedName(self):
+        md5 = "ab" * 16
+        self.assertEqual(storage.FileStorage(self.root, 1).migrated_name(
+            "cd/cdef.png", md5), "cd/cdef.png")
+        self.assertEqual(storage.FileStorage(self.root).migrated_name(
+            "cd/cdef.png", md5), "cdef.png")
+        self.assertEqual(storage.ContentAddressedStorage(
+            self.root).migrated_name("cdef.png", md5),
+            "ab/ab/" + md5 + ".png")
+        self.assertEqual(storage.PackedStorage(self.root).migrated_name(
+            "cdef.png", md5), ".pack/" + md5 + ".png")
+
+    def testMigrate(self):
+        images = self.add_images([("a.png", "one"), ("b.png", "two"),
+                                  ("c.png", "one")])
+        self.assertEqual(storage.migrate(self.settings, 2, 2), 0)
+        self.assertEqual([image.filename for image in images],
+                         [self.content_name("one"), self.content_name("two"),
+                          self.content_name("one")])
+        self.assertEqual([image.size for image in images], [3, 3, 3])
+        self.assertEqual(sorted(os.listdir(self.root)), sorted(
+            set(self.content_name(data)[:2] for data in ("one", "two"))))
+
+    def testCheckpoint(self):
+        quiet_app_log(self)
+        images = self.add_images([("a.png", "one"), ("b.png", "two"),
+                                  ("c.png", None), ("d.png", "four")])
+        checkpoint = os.path.join(self.root, ".storage-migration")
+        # c.png is missing, the migration stops at the batch before it
+        self.assertEqual(storage.migrate(self.settings, 1, 2), 1)
+        with open(checkpoint) as f:
+            self.assertEqual(f.read(), "2")
+        self.assertEqual(images[3].filename, self.content_name("four"))
+
+        with open(os.path.join(self.root, "c.png"), "wb") as f:
+            f.write("three")
+        images[2].md5 = hashlib.md5("three").hexdigest()
+        # moved back by hand, not seen by a migration going on after the
+        # checkpoint
+        images[0].filename = "a.png"
+        with open(os.path.join(self.root, "a.png"), "wb") as f:
+            f.write("one")
+        self.assertEqual(storage.migrate(self.settings, 1, 2), 0)
+        self.assertEqual(images[0].filename, "a.png")
+        self.assertEqual(images[2].filename, self.content_name("three"))
+        self.assertFalse(os.path.exists(checkpoint))
+
+        with open(checkpoint, "w") as f:
+            f.write("3")
+        self.assertEqual(storage.migrate(self.settings, 1, 2,
+                                         restart=True), 0)
+        self.assertEqual(images[0].filename, self.content_name("one"))
+
+    def testReferences(self):
+        # two rows of the same file, like the "content" layout makes
+        self.add_images([("shared.png", "one"), ("shared.png", "one")])
+        storage._storage = storage.PackedStorage(self.root)
+        storage._image_dao = self.dao
+        path = os.path.join(self.root, "shared.png")
+        self.assertTrue(storage.migrate_image(1))
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(storage.migrate_image(2))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage._storage.read(
+            self.dao.images[2].filename), "one")
+
+
+class TestHashFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "index")
+        self.md5s = [hashlib.md5(str(i)).hexdigest() for i in range(2000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testNotBuilt(self):
+        index = packstore.PackIndex(self.path)
+        self.assertRaises(hashfile.HashFileError, index.get, self.md5s[0])
+        index.put(self.md5s[0], (1, 2, 3, 4))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(index.items(), [])
+
+    def testPutGetDelete(self):
+        index = packstore.PackIndex(self.path)
+        self.assertEqual(index.build([(self.md5s[0], (1, 0, 10, 5))]), 1)
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+        self.assertEqual(index.get(self.md5s[0]), (1, 0, 10, 5))
+        self.assertEqual(index.get(self.md5s[1]), None)
+        self.assertEqual(index.get("not a md5"), None)
+        index.put(self.md5s[1], (1, 10, 20, 5))
+        index.put(self.md5s[0], (2, 0, 10, 6))
+        self.assertEqual(index.get(self.md5s[0]), (2, 0, 10, 6))
+        self.assertEqual(index.get(self.md5s[1]), (1, 10, 20, 5))
+        index.put(self.md5s[0], None)
+        self.assertEqual(index.get(self.md5s[0]), None)
+        self.assertEqual(index.items(), [(self.md5s[1], (1, 10, 20, 5))])
+
+    def testGrow(self):
+        packstore.PackIndex(self.path).build([])
+        reader = packstore.PackIndex(self.path)
+        self.assertEqual(reader.get(self.md5s[0]), None)
+        writer = packstore.PackIndex(self.path)
+        for i, md5 in enumerate(self.md5s[:hashfile.MIN_SLOTS]):
+            writer.put(md5, (1, i, 1, 0))
+        # the reader sees the old file flagged as replaced and reopens
+        for i, md5 in enumerate(self.md5s[:hashfile.MIN_SLOTS]):
+            self.assertEqual(reader.get(md5), (1, i, 1, 0))
+        self.assertEqual(reader._slots, hashfile.MIN_SLOTS * 2)
+        self.assertEqual(len(writer.items()), hashfile.MIN_SLOTS)
+
+    def testRebuilt(self):
+        packstore.PackIndex(self.path).build([])
+        reader = packstore.PackIndex(self.path)
+        self.assertEqual(reader.get(self.md5s[0]), None)
+        packstore.PackIndex(self.path).build([(self.md5s[0], (1, 0, 1, 0))])
+        self.assertEqual(reader.get(self.md5s[0]), (1, 0, 1, 0))
+        # another version is rebuilt before it is used
+        with open(self.path, "r+b") as f:
+            f.seek(8)
+            f.write(struct.pack("!I", 99))
+        self.assertRaises(hashfile.HashFileError,
+                          packstore.PackIndex(self.path).get, self.md5s[0])
+        packstore.PackIndex(self.path).put(self.md5s[1], (1, 0, 1, 0))
+        self.assertEqual(reader.items(), [(self.md5s[0], (1, 0, 1, 0))])
+
+
+class TestPackStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._saved = packstore.SEGMENT_SIZE
+        packstore.SEGMENT_SIZE = 1000
+        self.store = packstore.PackStore(self.dir)
+
+    def tearDown(self):
+        packstore.SEGMENT_SIZE = self._saved
+        shutil.rmtree(self.dir)
+
+    def pack(self, store, data):
+        md5 = hashlib.md5(data).hexdigest()
+        store.put(md5, data)
+        return md5
+
+    def age(self, md5):
+        number, offset, size, _ = self.store.index.get(md5)
+        self.store.index.put(md5, (number, offset, size,
+                                   time.time() - packstore.COMPACT_GRACE - 1))
+
+    def testPut(self):
+        md5 = self.pack(self.store, "a" * 600)
+        self.assertEqual(self.store.read(md5), "a" * 600)
+        self.assertEqual(self.store.locate(md5),
+                         (self.store.segment_path(1), 0, 600))
+        # packed once
+        self.pack(self.store, "a" * 600)
+        other = self.pack(self.store, "b" * 600)
+        self.assertEqual(self.store.locate(other),
+                         (self.store.segment_path(2), 0, 600))
+        self.assertEqual(packstore.PackStore(self.dir).read(other), "b" * 600)
+        self.assertEqual(self.store.read("0" * 32), None)
+        self.assertEqual(os.stat(self.store.index.path).st_mode & 0777, 0644)
+
+    def testCompact(self):
+        live = self.pack(self.store, "a" * 300)
+        dead = self.pack(self.store, "b" * 300)
+        recent = self.pack(self.store, "c" * 300)
+        self.pack(self.store, "d" * 300)
+        self.age(live)
+        self.age(dead)
+        reader = packstore.PackStore(self.dir)
+        self.assertEqual(reader.read(live), "a" * 300)
+        # segment 1 is 900 bytes, 300 of them no row uses
+        self.assertEqual(self.store.compact([live], threshold=0.5), 0)
+        self.assertEqual(self.store.compact([live], threshold=0.9), 300)
+        self.assertFalse(os.path.exists(self.store.segment_path(1)))
+        self.assertEqual(self.store.read(dead), None)
+        # kept while its row may still be added
+        self.assertEqual(self.store.read(recent), "c" * 300)
+        self.assertEqual(self.store.locate(live)[0],
+                         self.store.segment_path(2))
+        # a reader mapping the removed segment follows the index
+        self.assertEqual(reader.read(live), "a" * 300)
+
+
+class PackedAvatarHandler(image_handler.AccessHandlerV1):
+
+    record = None
+
+    def find_avatar(self, email_md5):
+        return self.record
+
+
+class TestPackedAvatar(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.app = WSGIAdapter(Application(
+            [(r"/image/([0-9a-f]{32})", PackedAvatarHandler)],
+            upload_path=self.dir, image_storage="packed",
+            static_path=self.dir, avatar_transcode_formats=()))
+        self.storage = storage.get_storage(self.app.application.settings)
+        self._saved = packstore.SEGMENT_SIZE
+        packstore.SEGMENT_SIZE = 200 * 1024
+
+    def tearDown(self):
+        packstore.SEGMENT_SIZE = self._saved
+        PackedAvatarHandler.record = None
+        shutil.rmtree(self.dir)
+
+    def pack(self, data):
+        md5 = hashlib.md5(data).hexdigest()
+        name = self.storage.name_for(None, md5, "png")
+        self.storage.pack.put(md5, data)
+        return avatarindex.AvatarRecord(name, md5, False, 0, len(data))
+
+    def testSegmentRemoved(self):
+        # bigger than AccessHandlerV1.MAX_CACHED_DATA, read from the segment
+        data = "a" * 100 * 1024
+        dead = self.pack("b" * 50 * 1024)
+        PackedAvatarHandler.record = self.pack(data)
+        self.pack("c" * 100 * 1024)
+        self.storage.pack.index.put(dead.md5, (1, 0, 50 * 1024, 0))
+        email_md5 = hashlib.md5("packed@example.com").hexdigest()
+        status, headers, body = wsgi_fetch(self.app, "GET",
+                                           "/image/" + email_md5)
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, data)
+
+        self.storage.pack.compact([PackedAvatarHandler.record.md5], 0.9)
+        self.assertFalse(os.path.exists(self.storage.pack.segment_path(1)))
+        # the cached entry names the removed segment
+        status, headers, body = wsgi_fetch(self.app, "GET",
+                                           "/image/" + email_md5)
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, data)
+
+
+class FakeAvatarDAO(object):
+
+    """The avatars by email_md5 used by `common.avatartree.AvatarTree`."""
+
+    def __init__(self, images):
+        self.avatars = dict((image.email_md5, image) for image in images)
+
+    def get_avatar_images(self, after=0, limit=1000):
+        images = sorted((image for image in self.avatars.values()
+                         if image.imgid > after), key=lambda i: i.imgid)
+        return images[:limit]
+
+    def get_image_by_emailmd5(self, email_md5):
+        return self.avatars.get(email_md5)
+
+
+class TestAvatarTree(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.FileStorage(self.root)
+        self.tree = avatartree.AvatarTree(os.path.join(self.root, "avatars"),
+                                          self.storage)
+        self.email_md5s = [hashlib.md5("%d@example.com" % i).hexdigest()
+                           for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def image(self, imgid, email_md5, filename, data="image"):
+        if not self.storage.is_packed(filename):
+            with open(self.storage.path(filename), "wb") as f:
+                f.write(data)
+        else:
+            self.storage.pack.put(storage._packed_md5(filename), data)
+        return model.image.ImageModel(imgid=imgid, email_md5=email_md5,
+                                      filename=filename)
+
+    def testUpdate(self):
+        email_md5 = self.email_md5s[0]
+        self.tree.update(email_md5, self.image(1, email_md5, "a.png"))
+        path = self.tree.entry_path(email_md5, "png")
+        self.assertEqual(path, os.path.join(self.tree.path, email_md5[:2],
+                                            email_md5 + ".png"))
+        # a relative link to the file
+        self.assertEqual(os.readlink(path), "../../a.png")
+        # another format replaces it
+        self.tree.update(email_md5, self.image(2, email_md5, "b.jpg", "b"))
+        self.assertFalse(os.path.lexists(path))
+        with open(self.tree.entry_path(email_md5, "jpeg")) as f:
+            self.assertEqual(f.read(), "b")
+        self.tree.update(email_md5, None)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def testPacked(self):
+        email_md5 = self.email_md5s[0]
+        name = ".pack/" + hashlib.md5("packed").hexdigest() + ".gif"
+        self.tree.update(email_md5, self.image(1, email_md5, name, "packed"))
+        path = self.tree.entry_path(email_md5, "gif")
+        # a copy, the image has no file of its own
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+        with open(path) as f:
+            self.assertEqual(f.read(), "packed")
+
+    def testRebuild(self):
+        first, second, removed = self.email_md5s
+        dao = FakeAvatarDAO([self.image(1, first, "a.png"),
+                             self.image(2, second, "b.webp")])
+        # entries the database no longer knows of
+        self.tree.update(removed, self.image(3, removed, "c.png"))
+        self.tree.update(first, self.image(4, first, "d.gif"))
+        self.assertEqual(self.tree.rebuild(dao, batch_size=1), 2)
+        entries = sorted(
+            os.path.relpath(os.path.join(dirpath, filename), self.tree.path)
+            for dirpath, _, filenames in os.walk(self.tree.path)
+            for filename in filenames)
+        self.assertEqual(entries, sorted([
+            os.path.relpath(self.tree.entry_path(first, "png"),
+                            self.tree.path),
+            os.path.relpath(self.tree.entry_path(second, "webp"),
+                            self.tree.path)]))
+
+    def testRemoveStale(self):
+        first, second, _ = self.email_md5s
+        self.tree.update(first, self.image(1, first, "a.png"))
+        self.tree.update(second, self.image(2, second, "b.png"))
+        dao = FakeAvatarDAO([self.image(1, first, "a.png")])
+        # set meanwhile, after the walk started
+        self.tree._remove_stale(self.tree.entry_path(first, "png"), dao)
+        self.assertTrue(os.path.lexists(self.tree.entry_path(first, "png")))
+        self.tree._remove_stale(self.tree.entry_path(second, "png"), dao)
+        self.assertFalse(os.path.lexists(self.tree.entry_path(second,
+                                                               "png")))
+        # its avatar is now in another format
+        dao.avatars[first] = self.image(3, first, "c.gif")
+        self.tree._remove_stale(self.tree.entry_path(first, "png"), dao)
+        self.assertFalse(os.path.lexists(self.tree.entry_path(first, "png")))
+
+
+class FakeDB(object):
+
+    """Accepts the statements of `model.image.ImageDAO` writes."""
+
+    def update(self, sql_stmt, params):
+        return 1
+
+    def update_without_commit(self, sql_stmt, params):
+        return 1, 1
+
+    def commit(self):
+        pass
+
+
+class FakeIndexDAO(model.image.ImageDAO):
+
+    """Writes do nothing, the avatars are read from ``avatars``."""
+
+    def __init__(self, avatars):
+        super(FakeIndexDAO, self).__init__(None, db=FakeDB())
+        self.avatars = dict((image.email_md5, image) for image in avatars)
+        # set once the whole table has been read, see get_avatar_images
+        self.late = None
+
+    def get_avatar_images(self, after=0, limit=1000, updated_since=None):
+        images = sorted((image for image in self.avatars.values()
+                         if image.imgid > after and
+                         (updated_since is None or
+                          image.avatar_updated >= updated_since)),
+                        key=lambda image: image.imgid)[:limit]
+        if self.late is not None and updated_since is None and not images:
+            self.avatars[self.late.email_md5] = self.late
+            self.late = None
+        return images
+
+    def get_image_by_emailmd5(self, email_md5):
+        return self.avatars.get(email_md5)
+
+
+class TestAvatarIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = {"upload_path": self.root}
+        self.email_md5s = [hashlib.md5("%d@example.com" % i).hexdigest()
+                           for i in range(3)]
+        self._saved = (avatarindex._avatar_index,
+                       list(model.image._avatar_listeners))
+        avatarindex._avatar_index = None
+
+    def tearDown(self):
+        avatarindex._avatar_index = self._saved[0]
+        model.image._avatar_listeners[:] = self._saved[1]
+        shutil.rmtree(self.root)
+
+    def image(self, imgid, email_md5, updated=None):
+        return model.image.ImageModel(
+            imgid=imgid, email_md5=email_md5, filename="%d.png" % imgid,
+            md5=hashlib.md5(str(imgid)).hexdigest(), ready=1, size=imgid,
+            created=datetime.datetime(2015, 1, 1),
+            avatar_updated=updated or datetime.datetime(2015, 1, 2))
+
+    def testRebuild(self):
+        first, second, late = self.email_md5s
+        dao = FakeIndexDAO([self.image(1, first), self.image(2, second)])
+        # set while the index is built
+        dao.late = self.image(3, late, datetime.datetime.now())
+        self.assertEqual(avatarindex.rebuild(self.settings, dao,
+                                             batch_size=1), 2)
+        index = avatarindex.AvatarIndex(
+            avatarindex.get_avatar_index_path(self.settings))
+        record = index.lookup(first)
+        self.assertEqual((record.filename, record.md5, record.ready,
+                          record.size, record.format),
+                         ("1.png", hashlib.md5("1").hexdigest(), True, 1,
+                          "png"))
+        self.assertEqual(record.last_modified, time.mktime(
+            datetime.datetime(2015, 1, 2).timetuple()))
+        self.assertEqual(index.lookup(second).filename, "2.png")
+        self.assertEqual(index.lookup(late).filename, "3.png")
+        self.assertEqual(index.lookup(hashlib.md5("x").hexdigest()), None)
+        email_filter = emailfilter.EmailFilter(
+            emailfilter.get_email_filter_path(self.settings))
+        self.assertTrue(email_filter.might_contain(late))
+
+    def testListener(self):
+        first, second, _ = self.email_md5s
+        dao = FakeIndexDAO([])
+        avatarindex.rebuild(self.settings, dao)
+        index = avatarindex.get_avatar_index(self.settings)
+        self.assertEqual(index.lookup(first), None)
+
+        dao.avatars[first] = self.image(1, first)
+        dao.create_image(1, "1.png", dao.avatars[first].md5, first, True, 1)
+        self.assertEqual(index.lookup(first).filename, "1.png")
+        dao.avatars[first] = self.image(2, first)
+        dao.update_user_avatar(1, 2, first)
+        self.assertEqual(index.lookup(first).filename, "2.png")
+        # no longer an avatar
+        del dao.avatars[first]
+        dao.update_user_avatar(1, 2, first)
+        self.assertEqual(index.lookup(first), None)
+        self.assertEqual(index.lookup(second), None)
+
+    def testDisabled(self):
+        self.settings["avatar_index"] = False
+        self.assertEqual(avatarindex.get_avatar_index(self.settings), None)
+        self.assertEqual(model.image._avatar_listeners, self._saved[1])
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.queue = jobqueue.JobQueue(os.path.join(self.path, "jobs"),
+                                       lease=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def expire(self, job_id):
+        self.queue._get_connection().execute(
+            "UPDATE jobs SET claimed = ? WHERE id = ?",
+            (time.time() - self.queue.lease - 1, job_id))
+
+    def testClaim(self):
+        self.assertEqual(self.queue.claim(), None)
+        self.queue.put(10)
+        self.queue.put(11)
+        self.assertEqual(self.queue.pending(), 2)
+        job_id, imgid = self.queue.claim()
+        self.assertEqual(imgid, 10)
+        self.assertEqual(self.queue.claim()[1], 11)
+        self.assertEqual(self.queue.claim(), None)
+        self.queue.done(job_id)
+        self.assertEqual(self.queue.pending(), 1)
+
+    def testLeaseExpired(self):
+        self.queue.put(10)
+        job_id, imgid = self.queue.claim()
+        self.assertEqual(self.queue.claim(), None)
+        # its worker died
+        self.expire(job_id)
+        self.assertEqual(self.queue.claim(), (job_id, imgid))
+
+    def testRelease(self):
+        self.queue.put(10)
+        job_id, imgid = self.queue.claim()
+        self.queue.release(job_id)
+        # retried after RETRY_DELAY, not right away
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.pending(), 1)
+        claimed = self.queue._get_connection().execute(
+            "SELECT claimed FROM jobs WHERE id = ?", (job_id, )).fetchone()[0]
+        self.assertAlmostEqual(claimed + self.queue.lease,
+                               time.time() + jobqueue.RETRY_DELAY, delta=5)
+        self.expire(job_id)
+        self.assertEqual(self.queue.claim(), (job_id, imgid))
+
+    def testDropped(self):
+        quiet_app_log(self)
+        self.queue.put(10)
+        self.queue.put(11)
+        for _ in range(jobqueue.MAX_ATTEMPTS):
+            job_id, imgid = self.queue.claim()
+            self.assertEqual(imgid, 10)
+            self.queue.release(job_id)
+            self.expire(job_id)
+        self.assertEqual(self.queue.pending(), 1)
+        self.assertEqual(self.queue.claim()[1], 11)
+        # the worker of the last attempt died
+        self.queue.put(12)
+        for _ in range(jobqueue.MAX_ATTEMPTS):
+            job_id, imgid = self.queue.claim()
+            self.assertEqual(imgid, 12)
+            self.expire(job_id)
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue._get_connection().execute(
+            "SELECT imgid FROM jobs").fetchall(), [(11, )])
+
+
+class TestVariants(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = variants.VariantCache(self.path)
+        self.resized = []
+        self._saved = variants._import_pil, variants.resize_image
+        variants._import_pil = lambda: True
+        variants.resize_image = self.fake_resize
+
+    def tearDown(self):
+        variants._import_pil, variants.resize_image = self._saved
+        shutil.rmtree(self.path)
+
+    def fake_resize(self, source_path, f, size, fmt):
+        self.resized.append((source_path, size, fmt))
+        if source_path == "broken":
+            raise IOError("cannot identify image file")
+        f.write("%s-%s" % (size, fmt))
+
+    def testParseSize(self):
+        sizes = (32, 64, 128)
+        for value, size in (("1", 32), ("32", 32), ("33", 64), ("500", 128),
+                            ("0", None), ("-5", None), ("abc", None),
+                            (None, None)):
+            self.assertEqual(variants.parse_size(value, sizes), size)
+
+    def testAcceptedFormats(self):
+        formats = ("avif", "webp")
+        for accept, accepted in (
+                ("image/avif,image/webp,image/*,*/*;q=0.8", ["avif", "webp"]),
+                ("image/webp;q=0.5, image/png", ["webp"]),
+                ("image/webp;q=0, image/avif;q=0.0", []),
+                ("image/webp;q=x", []),
+                ("image/*,*/*", []),
+                (None, [])):
+            self.assertEqual(variants.accepted_formats(accept, formats),
+                             accepted)
+
+    def testGet(self):
+        path = self.cache.get("a.png", "ab" * 16, 64, "webp")
+        self.assertEqual(path, self.cache.variant_path("ab" * 16, 64,
+                                                       "webp"))
+        with open(path) as f:
+            self.assertEqual(f.read(), "64-webp")
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(path).st_mode & 0777, 0666 & ~umask)
+        # made once, nothing but the variant is left
+        self.assertEqual(self.cache.get("a.png", "ab" * 16, 64, "webp"),
+                         path)
+        self.assertEqual(len(self.resized), 1)
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         [os.path.basename(path)])
+
+    def testForce(self):
+        settings = {"avatar_cache_path": self.path, "avatar_sizes": (32, 64),
+                    "avatar_transcode_formats": ()}
+        self.assertTrue(derivatives.make_derivatives(settings, "a.png",
+                                                     "ab" * 16))
+        self.assertTrue(derivatives.make_derivatives(settings, "a.png",
+                                                     "ab" * 16))
+        self.assertEqual(len(self.resized), 2)
+        # made again, eg. by ``derivatives backfill --force``
+        self.assertTrue(derivatives.make_derivatives(settings, "a.png",
+                                                     "ab" * 16, force=True))
+        self.assertEqual(len(self.resized), 4)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, "ab"))),
+                         ["ab" * 16 + "-32.png", "ab" * 16 + "-64.png"])
+
+    def testGetFailed(self):
+        quiet_app_log(self)
+        self.assertEqual(self.cache.get("broken", "cd" * 16, 64, "png"),
+                         None)
+        self.assertEqual(os.listdir(os.path.join(self.path, "cd")), [])
+
+    def testGetConcurrent(self):
+        started = threading.Event()
+        resize = self.fake_resize
+
+        def slow_resize(*args):
+            started.set()
+            time.sleep(0.2)
+            resize(*args)
+        variants.resize_image = slow_resize
+        paths = []
+        first = threading.Thread(target=lambda: paths.append(
+            self.cache.get("a.png", "ef" * 16, 32, "png")))
+        first.start()
+        started.wait(5)
+        # waits on the lock, then finds the variant made by the first one
+        paths.append(self.cache.get("a.png", "ef" * 16, 32, "png"))
+        first.join()
+        self.assertEqual(len(self.resized), 1)
+        self.assertEqual(paths[0], paths[1])
+
+    def testChooseVariant(self):
+        handler = image_handler.AccessHandlerV1.__new__(
+            image_handler.AccessHandlerV1)
+        handler.application = Application([], avatar_cache_path=self.path)
+        md5 = "12" * 16
+        for size, fmt, length in ((64, "png", 300), (64, "webp", 100),
+                                  (None, "webp", 1000)):
+            path = self.cache.variant_path(md5, size, fmt)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write("x" * length)
+        choose = handler.choose_variant
+        self.assertEqual(choose(md5, 64, "png", ["webp"]), (
+            self.cache.variant_path(md5, 64, "webp"), 100, "webp"))
+        self.assertEqual(choose(md5, 64, "png", []), (
+            self.cache.variant_path(md5, 64, "png"), 300, "png"))
+        # full size: the transcodes only
+        self.assertEqual(choose(md5, None, "png", ["webp"]), (
+            self.cache.variant_path(md5, None, "webp"), 1000, "webp"))
+        self.assertEqual(choose(md5, None, "png", []), None)
+        self.assertEqual(choose(md5, 32, "png", ["webp"]), None)
+
+    def testVariantETag(self):
+        etag = '"' + "12" * 16 + '"'
+        self.assertEqual(image_handler.variant_etag(etag), etag)
+        self.assertEqual(image_handler.variant_etag(etag, 64),
+                         '"' + "12" * 16 + '-s64"')
+        self.assertEqual(image_handler.variant_etag(etag, 64, "webp"),
+                         '"' + "12" * 16 + '-s64-webp"')
+        self.assertEqual(image_handler.variant_etag(etag, None, "webp"),
+                         '"' + "12" * 16 + '-webp"')
+
+
+def make_routes(count):
+    """``count`` routes in front of the avatar route, like a growing app."""
+    routes = []
+    for i in range(count / 2):
+        routes.append(r"/section%d/list" % i)
+        routes.append(r"/section%d/([0-9]+)" % i)
+    routes.append(r"/image/upload")
+    routes.append(r"/image/([0-9a-fA-F]{32})")
+    return [URLSpec(pattern, RequestHandler) for pattern in routes]
+
+
+def benchmark_router(number=20000):
+    """Prints the cost of dispatching an avatar request as routes grow."""
+    path = "/image/" + "0123456789abcdef" * 2
+    print "%8s %16s %16s" % ("routes", "linear (us)", "router (us)")
+    for count in (10, 100, 1000):
+        specs = make_routes(count)
+        router = Router(specs)
+        linear = timeit.timeit(lambda: linear_find_handler(specs, path),
+                               number=number)
+        compiled = timeit.timeit(lambda: router.find_handler(path),
+                                 number=number)
+        print "%8d %16.2f %16.2f" % (len(specs), linear / number * 1e6,
+                                     compiled / number * 1e6)
+
+
+def eager_request(environ):
+    """Builds a request the way CGIRequest did before it parsed lazily."""
+    import cgi
+    from urlparse import parse_qs
+    request = request_from_environ(environ, None, body_file=StringIO(""))
+    request._arguments = parse_qs(request.query, keep_blank_values=True)
+    form = cgi.FieldStorage(fp=StringIO(""), environ=environ)
+    for k in form.keys():
+        request._arguments.setdefault(k, []).extend(form.getlist(k))
+    request._body = ""
+    return request
+
+
+def benchmark_request(number=20000):
+    """Prints the cost of building the request of an avatar GET."""
+    environ = make_environ("GET", "/image/" + "0123456789abcdef" * 2 +
+                           "?s=80&d=identicon", headers={
+                               "Accept": "image/webp,image/*,*/*;q=0.8",
+                               "User-Agent": "Mozilla/5.0",
+                               "Referer": "http://example.com/",
+                           })
+
+    def lazy():
+        return request_from_environ(environ, None, body_file=StringIO(""))
+    print "%16s %16s" % ("eager (us)", "lazy (us)")
+    eager_time = timeit.timeit(lambda: eager_request(environ), number=number)
+    lazy_time = timeit.timeit(lazy, number=number)
+    print "%16.2f %16.2f" % (eager_time / number * 1e6,
+                             lazy_time / number * 1e6)
+
+
+def run_benchmarks():
+    benchmark_router()
+    benchmark_request()
+
+
 if __name__ == '__main__':
-    unittest.main()
+    # python -m typhoon.tests benchmark
+    if sys.argv[1:] == ["benchmark"]:
+        run_benchmarks()
+    else:
+        unittest.main()
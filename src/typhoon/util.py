@@ -2,16 +2,69 @@
 # -*- coding: utf-8 -*-
 
 
+import os
 import re
 import time
-import email.utils
 import datetime
 import numbers
 import calendar
 import json
-import urllib
 import hmac
+import urlparse
 import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Same table as httplib.responses, which is not imported because it pulls in
+# socket, ssl and mimetools on every CGI request.
+responses = {
+    100: "Continue",
+    101: "Switching Protocols",
+    200: "OK",
+    201: "Created",
+    202: "Accepted",
+    203: "Non-Authoritative Information",
+    204: "No Content",
+    205: "Reset Content",
+    206: "Partial Content",
+    300: "Multiple Choices",
+    301: "Moved Permanently",
+    302: "Found",
+    303: "See Other",
+    304: "Not Modified",
+    305: "Use Proxy",
+    306: "(Unused)",
+    307: "Temporary Redirect",
+    400: "Bad Request",
+    401: "Unauthorized",
+    402: "Payment Required",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    407: "Proxy Authentication Required",
+    408: "Request Timeout",
+    409: "Conflict",
+    410: "Gone",
+    411: "Length Required",
+    412: "Precondition Failed",
+    413: "Request Entity Too Large",
+    414: "Request-URI Too Long",
+    415: "Unsupported Media Type",
+    416: "Requested Range Not Satisfiable",
+    417: "Expectation Failed",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+    505: "HTTP Version Not Supported",
+}
+
+_WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+           "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
 
 
 def import_object(name):
@@ -67,7 +120,35 @@ def format_timestamp(ts):
         ts = calendar.timegm(ts.utctimetuple())
     else:
         raise TypeError("unknown timestamp type: %r" % ts)
-    return email.utils.formatdate(ts, usegmt=True)
+    # what email.utils.formatdate(ts, usegmt=True) returns, without the
+    # import of the email package
+    t = time.gmtime(ts)
+    return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+        _WEEKDAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def parse_timestamp(value):
+    """Parses an HTTP date, eg. an ``If-Modified-Since`` header.
+
+    Returns a timestamp, or None if ``value`` is not a valid date.
+    """
+    # the IMF-fixdate format format_timestamp writes and clients send back
+    parts = value.split()
+    if len(parts) == 6 and parts[5] == "GMT" and parts[2] in _MONTHS:
+        try:
+            day, year = int(parts[1]), int(parts[3])
+            hour, minute, second = [int(p) for p in parts[4].split(":")]
+            return calendar.timegm((year, _MONTHS.index(parts[2]) + 1, day,
+                                    hour, minute, second))
+        except ValueError:
+            return None
+    # obsolete RFC 850 and asctime formats
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
 
 
 def json_encode(value):
@@ -81,6 +162,23 @@ def json_encode(value):
     return json.dumps(value).replace("</", "<\\/")
 
 
+_umask = None
+
+
+def default_file_mode():
+    """The mode ``open()`` gives new files in this process, 0666 less the
+    umask. Files made with `tempfile.mkstemp` are 0600 and get it before
+    they are renamed into place, other users (eg. the front server) then
+    read them as they would any other file.
+    """
+    global _umask
+    if _umask is None:
+        # there is no way to read the umask but setting it
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return 0666 & ~_umask
+
+
 def debug_log(log_str, fname='debug.log'):
     with open(fname, 'a+') as f:
         f.write(log_str)
@@ -102,11 +200,14 @@ def url_unescape(value, encoding='utf-8', plus=True):
     reverse of Python's urllib module.
 
     """
-    unquote = (urllib.unquote_plus if plus else urllib.unquote)
+    # urlparse.unquote is urllib.unquote, but urllib imports socket and ssl
+    value = utf8(value)
+    if plus:
+        value = value.replace("+", " ")
     if encoding is None:
-        return unquote(utf8(value))
+        return urlparse.unquote(value)
     else:
-        return unicode_type(unquote(utf8(value)), encoding)
+        return unicode_type(urlparse.unquote(value), encoding)
 
 
 def unquote_or_none(s):
@@ -157,3 +258,80 @@ def digest_equals(a, b):
     for x, y in zip(a, b):
         result |= ord(x) ^ ord(y)
     return result == 0
+
+
+class LRUCache(object):
+
+    """A cache bounded by the total size of its values, least recently used
+    entries are evicted first.
+
+    Entries older than ``ttl`` seconds are not returned anymore. ``hits``,
+    ``misses`` and ``evictions`` count what happened since it was created,
+    see `stats`. It can be shared by threads.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        # key -> (value, size, expiry time)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[2] is not None and entry[2] < time.time():
+                self.bytes -= entry[1]
+                self.misses += 1
+                return default
+            # move it to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """Adds ``value``, whose size in bytes is ``size``, values bigger
+        than the cache are not kept.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            expires = time.time() + self.ttl if self.ttl else None
+            self._entries[key] = (value, size, expires)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self.bytes -= entry[1]
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def delete_matching(self, predicate):
+        """Removes the entries whose key ``predicate(key)`` is true for."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+        }
@@ -5,22 +5,29 @@ import re
 import os
 import sys
 import time
+import zlib
+import json
+import stat
 import base64
-import httplib
+import hashlib
 import numbers
 import datetime
 import traceback
 import urlparse
 import binascii
-import Cookie
 from functools import wraps
+from collections import OrderedDict
 
 import typhoon
 from typhoon.log import default_log_setting, app_log
-from typhoon.util import (import_object, format_timestamp, unicode_type,
-                          json_encode, utf8, unquote_or_none, create_signature,
-                          xhtml_escape, digest_equals)
-from typhoon.cgiutil import CGIConnection, CGIRequest, HTTPHeaders
+from typhoon.concurrent import Future, is_future
+from typhoon.util import (import_object, responses, format_timestamp,
+                          parse_timestamp, unicode_type, json_encode, utf8,
+                          create_signature, xhtml_escape, digest_equals,
+                          LRUCache)
+from typhoon.routing import Router
+from typhoon.template import Loader, DirectorySource, default_parser
+from typhoon.cgiutil import CGIConnection, HTTPHeaders, request_from_environ
 
 
 class StdStream(object):
@@ -38,14 +45,18 @@ class URLSpec(object):
             pattern += '$'
         self.regex = re.compile(pattern)
 
-        if isinstance(handler, str):
-            # import the Module and instantiate the class
-            # Must be a fully qualified name (module.ClassName)
-            handler = import_object(handler)
-
-        self.handler_class = handler
+        # A handler given as a fully qualified name (module.ClassName) is
+        # only imported when a request is routed to it, so a CGI process
+        # does not import the modules of all the other handlers.
+        self._handler = handler
         self.handler_kwargs = kwargs or {}
 
+    @property
+    def handler_class(self):
+        if isinstance(self._handler, str):
+            self._handler = import_object(self._handler)
+        return self._handler
+
 
 class HTTPError(Exception):
 
@@ -60,7 +71,7 @@ class HTTPError(Exception):
     def __str__(self):
         message = "HTTP %d: %s" % (
             self.status_code,
-            self.reason or httplib.responses.get(self.status_code, 'Unknown'))
+            self.reason or responses.get(self.status_code, 'Unknown'))
         if self.log_message:
             return message + " (" + (self.log_message % self.args) + ")"
         else:
@@ -85,6 +96,8 @@ class RequestHandler(object):
         self.application = application
         self.request = request
         self._check_xsrf_cookie = application.settings.get("check_xsrf_cookie")
+        self._headers_written = False
+        self._transforms = [t(request) for t in application.transforms]
 
         self.clear()
         self.initialize(**kwargs)
@@ -109,7 +122,7 @@ class RequestHandler(object):
             self._reason = utf8(reason)
         else:
             try:
-                self._reason = httplib.responses[status_code]
+                self._reason = responses[status_code]
             except KeyError:
                 raise ValueError("unknown status code %d", status_code)
 
@@ -128,7 +141,13 @@ class RequestHandler(object):
         else:
             raise TypeError("Unsupported header value %r" % value)
 
-    # TODO: head support
+    def head(self, *args, **kwargs):
+        """Runs `get` by default, only the headers and the Content-Length
+        the body would have are sent.
+
+        Override it when the headers can be found without building the body.
+        """
+        return self.get(*args, **kwargs)
 
     def get(self, *args, **kwargs):
         raise HTTPError(405)
@@ -170,6 +189,7 @@ class RequestHandler(object):
             # Don't let us accidentally inject bad stuff
             raise ValueError("Invalid cookie %r: %r" % (name, value))
         if not hasattr(self, "_new_cookie"):
+            import Cookie
             self._new_cookie = Cookie.SimpleCookie()
         if name in self._new_cookie:
             del self._new_cookie[name]
@@ -332,24 +352,47 @@ class RequestHandler(object):
         chunk = utf8(chunk)
         self._write_buffer.append(chunk)
 
-    def _gen_resp_header(self):
-        header_lines = [
-            'Status: {0} {1}'.format(
-                self._status_code,
-                httplib.responses.get(
-                    self._status_code,
-                    'METHOD NOT FOUND'))]
-        for k, v in self._headers.iteritems():
-            header_lines.append('{0}: {1}'.format(k, v))
+    def write_iter(self, chunks):
+        """Writes and flushes every chunk of the iterable ``chunks``, eg. a
+        generator reading a file, so only one chunk is held in memory.
+        """
+        for chunk in chunks:
+            self.write(chunk)
+            self.flush()
+
+    def _get_header_list(self):
+        headers = list(self._headers.iteritems())
         if hasattr(self, "_new_cookie"):
             for cookie in self._new_cookie.values():
-                header_lines.append(
-                    'Set-Cookie: {}'.format(cookie.OutputString(None)))
-        return '\r\n'.join(header_lines) + '\r\n\r\n'
+                headers.append(("Set-Cookie", cookie.OutputString(None)))
+        return headers
 
-    def flush(self):
-        self.request.write(self._gen_resp_header())
-        self.request.write("".join(self._write_buffer))
+    def flush(self, include_footers=False):
+        """Sends the headers, the first time, and what was written so far.
+
+        The headers can not be changed any more once flushed. A response
+        flushed before `finish` has no Content-Length unless the handler
+        set one, the server then uses chunked encoding or closes the
+        connection after the body.
+        """
+        chunk = "".join(self._write_buffer)
+        self._write_buffer = []
+        if not self._headers_written:
+            self._headers_written = True
+            for transform in self._transforms:
+                self._status_code, self._headers, chunk = \
+                    transform.transform_first_chunk(
+                        self._status_code, self._headers, chunk,
+                        include_footers)
+            self.request.connection.write_headers(
+                self._status_code,
+                responses.get(self._status_code, 'METHOD NOT FOUND'),
+                self._get_header_list())
+        else:
+            for transform in self._transforms:
+                chunk = transform.transform_chunk(chunk, include_footers)
+        if self.request.method != "HEAD":
+            self.request.write(chunk)
 
     def redirect(self, url, permanent=False, status=None):
         if status is None:
@@ -360,9 +403,50 @@ class RequestHandler(object):
         self.set_header("Location", urlparse.urljoin(utf8(self.request.uri),
                                                      utf8(url)))
 
+    def static_url(self, path):
+        """Returns the URL of the file ``path`` below the "static_path"
+        setting, with a version argument that changes with its content so
+        browsers can cache it for good, see `StaticFileHandler.get_version`.
+        """
+        settings = self.application.settings
+        prefix = settings.get("static_url_prefix", "/static/")
+        version = StaticFileHandler.get_version(
+            os.path.abspath(settings["static_path"]), path)
+        if version is None:
+            return prefix + path
+        return prefix + path + "?v=" + version
+
+    def should_return_304(self, etag=None, last_modified=None):
+        """Returns True if the client's cached copy is still fresh.
+
+        ``etag`` is compared with ``If-None-Match`` and, only if the request
+        has no such header (RFC 7232), the ``last_modified`` timestamp with
+        ``If-Modified-Since``.
+        """
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            if etag is None:
+                return False
+            if if_none_match.strip() == "*":
+                return True
+            etag = etag.strip('"')
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag.strip('"') == etag:
+                    return True
+            return False
+
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since and last_modified is not None:
+            since = parse_timestamp(if_modified_since)
+            return since is not None and int(last_modified) <= since
+        return False
+
     def _handle_requeset_exception(self, e):
         if isinstance(e, HTTPError):
-            if e.status_code not in httplib.responses and not e.reason:
+            if e.status_code not in responses and not e.reason:
                 self.send_error(500, exc_info=sys.exc_info())
             else:
                 self.send_error(e.status_code, exc_info=sys.exc_info())
@@ -377,6 +461,10 @@ class RequestHandler(object):
 
     def send_error(self, status_code=500, **kwargs):
         """Sends the given HTTP error code to the browser."""
+        if self._headers_written:
+            app_log.error("cannot send error %d, the response is already "
+                          "being sent", status_code)
+            return
         self.clear()
         reason = kwargs.get('reason')
         if 'exc_info' in kwargs:
@@ -389,7 +477,12 @@ class RequestHandler(object):
         except Exception as e:
             app_log.error("write error failed %s", e)
 
-    def _execute(self, *args):
+    def _execute(self, *args, **kwargs):
+        """Runs the handler method for this request and finishes it.
+
+        If the method is a coroutine (see `typhoon.gen`) the response is
+        finished once its future resolves and that future is returned.
+        """
         try:
             if self.request.method not in ("GET", "HEAD") and \
                     self.application.settings.get("check_xsrf_cookie") and \
@@ -397,20 +490,41 @@ class RequestHandler(object):
                 self.check_xsrf_cookie()
 
             self.prepare()
-            getattr(self, self.request.method.lower())(*args)
+            result = getattr(self, self.request.method.lower())(
+                *args, **kwargs)
+            if is_future(result):
+                result.add_done_callback(self._on_method_done)
+                return result
         except Exception as e:
             self._handle_requeset_exception(e)
-        finally:
-            self.flush()
+        self.finish()
 
-            self.request._finish_time = time.time()
-            app_log.info(
-                '%s %s %s %s %.0f ms',
-                self._status_code,
-                self.request.method,
-                self.request.uri,
-                self.request.remote_addr,
-                (self.request._finish_time - self.request._start_time) * 1000)
+    def _on_method_done(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            self._handle_requeset_exception(e)
+        finally:
+            self.finish()
+
+    def finish(self):
+        """Writes the response and completes the request."""
+        if not self._headers_written and \
+                "Content-Length" not in self._headers and \
+                self._status_code not in (204, 304):
+            # for HEAD this is the length the body of a GET would have
+            self.set_header("Content-Length",
+                            sum(len(c) for c in self._write_buffer))
+        self.flush(include_footers=True)
+        self.request.finish()
+
+        app_log.info(
+            '%s %s %s %s %.0f ms',
+            self._status_code,
+            self.request.method,
+            self.request.uri,
+            self.request.remote_addr,
+            (self.request._finish_time - self.request._start_time) * 1000)
 
 
 class ErrorHandler(RequestHandler):
@@ -424,16 +538,428 @@ class ErrorHandler(RequestHandler):
         raise HTTPError(self._status_code)
 
 
+class StaticFile(object):
+
+    """A file served by `StaticFileHandler`, with its strong ETag.
+
+    The content is kept in ``data`` for files up to ``max_size`` bytes, and
+    its compressed versions in ``compressed``, by content coding.
+    """
+
+    __slots__ = ["path", "mtime", "size", "etag", "data", "compressed",
+                 "_content_type"]
+
+    def __init__(self, path, st, max_size):
+        self.path = path
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.compressed = {}
+        self._content_type = None
+        md5 = hashlib.md5()
+        chunks = []
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), ""):
+                md5.update(chunk)
+                if self.size <= max_size:
+                    chunks.append(chunk)
+        self.etag = '"' + md5.hexdigest() + '"'
+        self.data = "".join(chunks) if self.size <= max_size else None
+
+    @property
+    def content_type(self):
+        # mimetypes imports urllib and reads the system mime.types, leave
+        # that to the processes actually serving static files
+        if self._content_type is None:
+            import mimetypes
+            self._content_type = mimetypes.guess_type(self.path)[0] or \
+                "application/octet-stream"
+        return self._content_type
+
+
+# in "static_path", see write_static_versions
+STATIC_VERSIONS = ".versions.json"
+
+
+def write_static_versions(static_path):
+    """Writes the versions of the `RequestHandler.static_url` of every file
+    below ``static_path``, the MD5 of their content, to its `STATIC_VERSIONS`
+    file. Run at deploy, every node then builds the same URLs without
+    reading the files. Returns the number of files.
+    """
+    versions = {}
+    for dirpath, _, filenames in os.walk(static_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, static_path)
+            if relpath == STATIC_VERSIONS:
+                continue
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), ""):
+                    md5.update(chunk)
+            st = os.stat(path)
+            versions[relpath.replace(os.sep, "/")] = [
+                md5.hexdigest()[:8], int(st.st_mtime), st.st_size]
+    tmp_path = os.path.join(static_path, STATIC_VERSIONS + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(versions, f, indent=0, sort_keys=True)
+    os.rename(tmp_path, os.path.join(static_path, STATIC_VERSIONS))
+    return len(versions)
+
+
+def _parse_range(value, size):
+    """Parses a single ``bytes=`` range of a Range header.
+
+    Returns ``(start, end)``, end excluded, or None if the header should be
+    ignored. ``start`` is ``size`` when the range can not be satisfied.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            # the last ``last`` bytes
+            return max(size - int(last), 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size:
+        return size, size
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+class StaticFileHandler(RequestHandler):
+
+    """Serves the files below the ``path`` argument.
+
+    `Application` routes "static_url_prefix" (``/static/``) to this handler
+    when the "static_path" setting is given. Files up to ``CACHE_MAX_SIZE``
+    bytes are read once per process and served from memory, bigger ones in
+    chunks; a stat per request notices changed files. Supports 304 and
+    single byte ranges. Requests with a ``v`` argument, see
+    `RequestHandler.static_url`, may be cached by browsers for a year.
+
+    With the "compress_response" setting, text files kept in memory are
+    compressed once per process and content coding, bigger ones and ranges
+    are sent as they are, so HEAD and GET get the same headers.
+    """
+
+    CACHE_MAX_AGE = 86400 * 365
+    CACHE_MAX_SIZE = 512 * 1024
+    CACHE_MAX_BYTES = 16 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+
+    # abspath -> StaticFile, per process
+    _files = LRUCache(CACHE_MAX_BYTES)
+    # static path -> content of its STATIC_VERSIONS file, per process
+    _versions = {}
+
+    @classmethod
+    def get_entry(cls, abspath):
+        """Returns the `StaticFile` of ``abspath``, or None if it is not a
+        regular file.
+        """
+        try:
+            st = os.stat(abspath)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        entry = cls._files.get(abspath)
+        if entry is None or entry.mtime != st.st_mtime or \
+                entry.size != st.st_size:
+            entry = StaticFile(abspath, st, cls.CACHE_MAX_SIZE)
+            # the content and about as much for its compressed versions
+            cls._files.set(abspath, entry, 512 + 2 * len(entry.data or ""))
+        return entry
+
+    @classmethod
+    def get_version(cls, root, path):
+        """Returns the ``v`` argument of the URL of the file ``path`` below
+        ``root``, or None if there is no such file.
+
+        It comes from the `STATIC_VERSIONS` file of ``root`` when that knows
+        the file as it is, see `write_static_versions`. Otherwise it is made
+        of the modification time and size: a page rendered by a CGI process
+        only stats the files it links to.
+        """
+        try:
+            st = os.stat(os.path.join(root, path))
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        versions = cls._versions.get(root)
+        if versions is None:
+            try:
+                with open(os.path.join(root, STATIC_VERSIONS)) as f:
+                    versions = json.load(f)
+            except (IOError, ValueError):
+                versions = {}
+            cls._versions[root] = versions
+        version = versions.get(path)
+        if version is not None and \
+                version[1:] == [int(st.st_mtime), st.st_size]:
+            return version[0]
+        return "{0:x}{1:x}".format(int(st.st_mtime), st.st_size)
+
+    def initialize(self, path):
+        self.root = os.path.abspath(path)
+
+    def get(self, path):
+        abspath = os.path.abspath(os.path.join(self.root, path))
+        if not abspath.startswith(self.root + os.sep):
+            raise HTTPError(403)
+        entry = self.get_entry(abspath)
+        if entry is None:
+            raise HTTPError(404)
+
+        encoding = self._choose_encoding(entry)
+        etag = entry.etag
+        if encoding is not None:
+            # another representation, another strong ETag
+            etag = etag[:-1] + "-" + encoding + '"'
+        self.set_header("ETag", etag)
+        self.set_header("Last-Modified", format_timestamp(entry.mtime))
+        self.set_header("Content-Type", entry.content_type)
+        self.set_header("Accept-Ranges", "bytes")
+        if self.get_argument("v", None):
+            self.set_header("Cache-Control",
+                            "public, max-age=%d" % self.CACHE_MAX_AGE)
+        if self.should_return_304(etag, entry.mtime):
+            return self.set_status(304)
+
+        if encoding is not None:
+            data = entry.compressed.get(encoding)
+            if data is None:
+                data = entry.compressed[encoding] = \
+                    CompressionTransform.compress_body(encoding, entry.data)
+            self.set_header("Content-Encoding", encoding)
+            self.set_header("Content-Length", len(data))
+            if self.request.method != "HEAD":
+                self.write(data)
+            return
+
+        start, end = 0, entry.size
+        range_header = self.request.headers.get("Range")
+        if_range = self.request.headers.get("If-Range")
+        if range_header and (not if_range or if_range == etag):
+            byte_range = _parse_range(range_header, entry.size)
+            if byte_range is not None:
+                start, end = byte_range
+                if start >= entry.size:
+                    self.set_status(416)
+                    self.set_header("Content-Range",
+                                    "bytes */%d" % entry.size)
+                    self.set_header("Content-Length", 0)
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, end - 1, entry.size))
+
+        self.set_header("Content-Length", end - start)
+        if self.request.method == "HEAD":
+            return
+        if entry.data is not None:
+            self.write(entry.data[start:end])
+            return
+        with open(abspath, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                self.flush()
+
+    def _choose_encoding(self, entry):
+        """Takes the compression of the response over from the
+        `CompressionTransform`, returns the content coding ``entry`` is
+        sent with, or None.
+        """
+        for transform in self._transforms:
+            if isinstance(transform, CompressionTransform):
+                break
+        else:
+            return None
+        self._transforms.remove(transform)
+        if not transform._compressible_type(entry.content_type):
+            return None
+        self.set_header("Vary", "Accept-Encoding")
+        if transform.encoding is None or entry.data is None or \
+                entry.size < transform.MIN_LENGTH or \
+                "Range" in self.request.headers:
+            return None
+        return transform.encoding
+
+
+_brotli = None
+
+
+def _import_brotli():
+    """Returns the brotli module, or False if it is not installed."""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli
+
+
+class CompressionTransform(object):
+
+    """Compresses text responses for clients sending ``Accept-Encoding``.
+
+    Uses brotli when the brotli module is installed and accepted, gzip
+    otherwise. Enabled by the "compress_response" application setting.
+
+    Whole bodies of at most ``CACHE_MAX_BODY`` bytes are compressed once
+    per process: identical pages, eg. for anonymous users, are answered
+    from a small cache in the long running server modes.
+    """
+
+    CONTENT_TYPES = set(["application/javascript", "application/json",
+                         "application/xml", "image/svg+xml"])
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+    MIN_LENGTH = 1024
+    CACHE_SIZE = 64
+    CACHE_MAX_BODY = 64 * 1024
+
+    _cache = OrderedDict()
+
+    def __init__(self, request):
+        accepted = set()
+        for coding in request.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            params = params.replace(" ", "")
+            try:
+                q = float(params[2:]) if params.startswith("q=") else 1.0
+            except ValueError:
+                q = 0.0
+            if q > 0:
+                accepted.add(name.strip().lower())
+        if "br" in accepted and _import_brotli():
+            self._encoding = "br"
+        elif "gzip" in accepted:
+            self._encoding = "gzip"
+        else:
+            self._encoding = None
+        self._compressor = None
+
+    @property
+    def encoding(self):
+        """The content coding chosen for this request, or None."""
+        return self._encoding
+
+    def _compressible_type(self, ctype):
+        ctype = ctype.split(";")[0].strip()
+        return ctype.startswith("text/") or ctype in self.CONTENT_TYPES
+
+    @classmethod
+    def compress_body(cls, encoding, body):
+        """Returns the whole ``body`` compressed with ``encoding``."""
+        if encoding == "br":
+            return _import_brotli().compress(body,
+                                             quality=cls.BROTLI_QUALITY)
+        compressor = zlib.compressobj(cls.GZIP_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if not self._compressible_type(headers.get("Content-Type", "")):
+            return status_code, headers, chunk
+        vary = headers.get("Vary")
+        if not vary:
+            headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            headers["Vary"] = vary + ", Accept-Encoding"
+
+        if self._encoding is None or status_code != 200 or \
+                "Content-Encoding" in headers or \
+                (finishing and len(chunk) < self.MIN_LENGTH):
+            return status_code, headers, chunk
+
+        headers["Content-Encoding"] = self._encoding
+        if finishing and len(chunk) <= self.CACHE_MAX_BODY:
+            key = (self._encoding, chunk)
+            compressed = self._cache.pop(key, None)
+            if compressed is None:
+                compressed = self._compress(chunk, True)
+                if len(self._cache) >= self.CACHE_SIZE:
+                    self._cache.popitem(last=False)
+            self._cache[key] = compressed
+            chunk = compressed
+        else:
+            chunk = self._compress(chunk, finishing)
+        if finishing:
+            headers["Content-Length"] = str(len(chunk))
+        else:
+            headers.pop("Content-Length", None)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is None:
+            return chunk
+        return self._compress(chunk, finishing)
+
+    def _compress(self, chunk, finishing):
+        if self._compressor is None:
+            if self._encoding == "br":
+                self._compressor = _import_brotli().Compressor(
+                    quality=self.BROTLI_QUALITY)
+            else:
+                self._compressor = zlib.compressobj(
+                    self.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if self._encoding == "br":
+            data = self._compressor.process(chunk)
+            return data + (self._compressor.finish() if finishing
+                           else self._compressor.flush())
+        return self._compressor.compress(chunk) + self._compressor.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
 class Application(object):
 
+    """A collection of request handlers and settings.
+
+    The handler table, settings, logging and template loader are set up once
+    here, so a single instance can serve any number of requests, either one
+    per process through `run` (CGI) or many through `execute` (see
+    `typhoon.wsgi`).
+    """
+
     def __init__(self, handlers=None, **settings):
         # At this point get true start time for request processing
-        start_time = time.time()
+        self._start_time = time.time()
         self.handlers = []
         self.settings = settings
+        self.transforms = []
+        if settings.get("compress_response"):
+            self.transforms.append(CompressionTransform)
         self.log_setting(**settings)
+        handlers = list(handlers or [])
+        if settings.get("static_path"):
+            handlers.insert(0, (
+                settings.get("static_url_prefix", "/static/") + r"(.*)",
+                StaticFileHandler, {"path": settings["static_path"]}))
         self.add_handlers(handlers)
-        self.prepare_run_context(StdStream(), start_time)
+        self.template_loader = None
+        if settings.get("template_path"):
+            self.template_loader = Loader(
+                sources=[DirectorySource(settings["template_path"])],
+                parser=default_parser,
+            )
 
     def log_setting(self, **settings):
         if 'app_log' in settings:
@@ -450,50 +976,51 @@ class Application(object):
     def add_handlers(self, handlers):
         """Appends the given handlers to our handler list.
 
-        Host patterns are processed sequentially in the order they were
-        added. All matching patterns will be considered.
+        Patterns are matched in the order they were added, the first one
+        matching the request path wins. Named groups in a pattern are passed
+        to the handler as keyword arguments, other groups as positional
+        ones.
         """
         for spec in handlers:
             if isinstance(spec, tuple):
                 assert len(spec) in (2, 3)
             self.handlers.append(URLSpec(*spec))
+        self.router = Router(self.handlers)
 
     def prepare_run_context(self, stream, start_time):
+        """Binds the CGI request described by ``os.environ``."""
         connection = CGIConnection(stream)
-        env = os.environ
-        headers = {
-            "Cookie": env.get("HTTP_COOKIE"),
-            "If-None-Match": env.get("HTTP_IF_NONE_MATCH", ""),
-            "If-Modified-Since": env.get("HTTP_IF_MODIFIED_SINCE", ""),
-        }
-        request = CGIRequest(
-            method=env.get("REQUEST_METHOD"),
-            uri=env.get("REQUEST_URI"),
-            version=env.get('SERVER_PROTOCOL'),
-            headers=headers,
-            host=env.get("HTTP_HOST"),
-            remote_addr=env.get('REMOTE_ADDR'),
-            connection=connection,
-            start_time=start_time,
-        )
-        self._request = request
+        self._request = request_from_environ(os.environ, connection,
+                                             start_time)
+
+    def execute(self, request):
+        """Routes ``request`` to its handler and writes the response."""
+        request.upload_dir = self.settings.get("upload_path")
+        request.max_upload_size = self.settings.get("max_upload_size")
+        found = self.router.find_handler(request.path)
+        if found is not None:
+            spec, path_args, path_kwargs = found
+            handler = spec.handler_class(self, request, **spec.handler_kwargs)
+        else:
+            path_args, path_kwargs = [], {}
+            handler = ErrorHandler(self, request, status_code=404)
+
+        result = handler._execute(*path_args, **path_kwargs)
+        if result is not None and \
+                getattr(request.connection, "io_loop", None) is None:
+            # A coroutine handler under a blocking server mode, which has no
+            # event loop of its own: run one until this request is done.
+            # The errors of the method are already answered by the handler,
+            # so only wait for it, without raising them again.
+            from typhoon.ioloop import IOLoop
+            finished = Future()
+            result.add_done_callback(lambda f: finished.set_result(None))
+            IOLoop.instance().run_sync(lambda: finished)
 
     def run(self):
-        path_args = []
-        handler = None
-
-        for spec in self.handlers:
-            match = spec.regex.match(self._request.path)
-            if match:
-                handler = spec.handler_class(self, self._request)
-                path_args = [unquote_or_none(s) for s in match.groups()]
-                # TODO: path_kwargs
-                break
-        if not handler:
-            handler = ErrorHandler(self, self._request, status_code=404)
-
-        # TODO: named url pattern using path_kwargs
-        handler._execute(*path_args)
+        """Serves the single CGI request of this process."""
+        self.prepare_run_context(StdStream(), self._start_time)
+        self.execute(self._request)
 
 
 def authenticated(method):
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""WSGI support for typhoon applications.
+
+Wrap an `Application` with `WSGIAdapter` and hand it to any WSGI server,
+eg. gunicorn or uWSGI::
+
+    application = WSGIAdapter(Application(handlers, **settings))
+
+The application is built once per worker process, each call then only
+creates the request object for the incoming environ.
+"""
+
+import time
+
+from typhoon.cgiutil import request_from_environ
+
+
+class WSGIConnection(object):
+
+    """Collects the response of a handler for a WSGI server.
+
+    A response written in one piece is returned as the WSGI iterable. Once
+    a handler writes a second chunk (see `RequestHandler.flush`) the body
+    goes to the ``write`` callable of ``start_response`` instead, so the
+    server can send it while the handler is still running.
+    """
+
+    def __init__(self, start_response):
+        self._start_response = start_response
+        self._write = None
+        self._chunks = []
+        self._streaming = False
+
+    def write_headers(self, status_code, reason, headers):
+        self._write = self._start_response(
+            "{0} {1}".format(status_code, reason),
+            [(str(k), str(v)) for k, v in headers])
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        if self._chunks:
+            self._streaming = True
+            for pending in self._chunks:
+                self._write(pending)
+            self._chunks = []
+        if self._streaming:
+            self._write(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def finish(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class WSGIAdapter(object):
+
+    """Converts a `typhoon.web.Application` instance into a WSGI application.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        start_time = time.time()
+        connection = WSGIConnection(start_response)
+        request = request_from_environ(environ, connection, start_time,
+                                       body_file=environ.get("wsgi.input"))
+        self.application.execute(request)
+        return connection._chunks
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""WSGI entry point, eg. ``gunicorn -w 4 wsgi:application``.
+
+Unlike main.py, which serves one request per CGI process, the application
+here is created once per worker and reused for every request.
+"""
+
+from main import make_app
+from typhoon.wsgi import WSGIAdapter
+
+application = WSGIAdapter(make_app())